@@ -82,6 +82,14 @@ PickleableFPAMetadata = Tuple[PickleableIndexer,
                               PickleableFeaturesTokenMap]
 
 
+class FPAMetadata:
+    def __init__(self, pickleable: PickleableFPAMetadata) -> None:
+        ...
+
+    def to_pickleable(self) -> PickleableFPAMetadata:
+        ...
+
+
 def features_to_total_distances_tensors(args: DataloaderArgs,
                                         filename: str) -> \
         Tuple[TokenMap, List[List[int]], List[List[float]],
@@ -138,7 +146,7 @@ def features_polyarg_tensors_with_meta(args: DataloaderArgs, filename: str,
     ...
 
 
-def sample_fpa(args: DataloaderArgs, metadata: PickleableFPAMetadata,
+def sample_fpa(args: DataloaderArgs, metadata: FPAMetadata,
                relevant_lemmas: List[str],
                prev_tactics: List[str],
                hypotheses: List[str],
@@ -154,7 +162,7 @@ def sample_fpa(args: DataloaderArgs, metadata: PickleableFPAMetadata,
     ...
 
 
-def sample_fpa_batch(args: DataloaderArgs, metadata: PickleableFPAMetadata,
+def sample_fpa_batch(args: DataloaderArgs, metadata: FPAMetadata,
                      context_batch: List[TacticContext]) -> \
                      Tuple[
                          List[List[List[int]]],
@@ -171,30 +179,44 @@ def get_fpa_words(s: str) -> List[str]:
     ...
 
 
-def decode_fpa_result(args: DataloaderArgs, metadata: PickleableFPAMetadata,
+def decode_fpa_result(args: DataloaderArgs, metadata: FPAMetadata,
                       hyps: List[str], goal: str, tac_idx: int,
                       arg_idx: int) -> str:
     ...
 
 
+def decode_fpa_predictions(args: DataloaderArgs, metadata: FPAMetadata,
+                           hyps: List[str], goal: str,
+                           idxs: List[Tuple[float, int, int]],
+                           stem_width: int, k: int) \
+                           -> List[Tuple[str, float]]:
+    ...
+
+
+def decode_fpa_predictions_batch(
+        args: DataloaderArgs, metadata: FPAMetadata,
+        batch: List[Tuple[List[str], str, List[Tuple[float, int, int]]]],
+        stem_width: int, k: int) -> List[List[Tuple[str, float]]]:
+    ...
+
+
 def features_vocab_sizes(tmap: TokenMap) -> Tuple[List[int], int]:
     ...
 
 
-def get_num_tokens(metadata: PickleableFPAMetadata) -> int:
+def get_num_tokens(metadata: FPAMetadata) -> int:
     ...
 
 
-def get_num_indices(metadata: PickleableFPAMetadata) -> \
-  Tuple[PickleableFPAMetadata, int]:
+def get_num_indices(metadata: FPAMetadata) -> int:
     ...
 
 
-def get_word_feature_vocab_sizes(metadata: PickleableFPAMetadata) -> List[int]:
+def get_word_feature_vocab_sizes(metadata: FPAMetadata) -> List[int]:
     ...
 
 
-def get_vec_features_size(metadata: PickleableFPAMetadata) -> int:
+def get_vec_features_size(metadata: FPAMetadata) -> int:
     ...
 
 
@@ -221,7 +243,7 @@ def goal_enc_tokenize_goal(args: DataloaderArgs,
     ...
 
 
-def sample_context_features(args: DataloaderArgs, tmap: TokenMap,
+def sample_context_features(args: DataloaderArgs, metadata: FPAMetadata,
                             relevant_lemmas: List[str],
                             prev_tactics: List[str],
                             hypotheses: List[str],
@@ -246,3 +268,33 @@ def tactic_transitions_from_file(args: DataloaderArgs,
 
 def rust_parse_sexp_one_level(sexpstr: str) -> List[str]:
     ...
+
+
+def decode_fpa_stem(args: DataloaderArgs, metadata: FPAMetadata,
+                    tac_idx: int) -> str:
+    ...
+
+
+def encode_fpa_stem(args: DataloaderArgs, metadata: FPAMetadata,
+                    tac_stem: str) -> int:
+    ...
+
+
+def encode_fpa_arg(args: DataloaderArgs, metadata: FPAMetadata,
+                   hyps: List[str], goal: str, arg: str) -> Optional[int]:
+    ...
+
+
+def tokenize(args: DataloaderArgs, metadata: FPAMetadata,
+             term: str) -> List[int]:
+    ...
+
+
+def get_premise_features(args: DataloaderArgs, metadata: FPAMetadata,
+                         goal: str, premise: str) -> List[float]:
+    ...
+
+
+def get_premise_features_size(args: DataloaderArgs,
+                              metadata: FPAMetadata) -> int:
+    ...
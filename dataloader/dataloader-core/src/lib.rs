@@ -126,7 +126,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn sample_fpa_batch(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         context_batch: Vec<TacticContext>,
     ) -> (
         LongUnpaddedTensor3D,
@@ -143,7 +143,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn sample_fpa(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         relevant_lemmas: Vec<String>,
         prev_tactics: Vec<String>,
         hypotheses: Vec<String>,
@@ -170,26 +170,50 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn decode_fpa_result(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         hyps: Vec<String>,
         goal: &str,
         tac_idx: i64,
         arg_idx: i64,
     ) -> String {
-        decode_fpa_result_rs(args, metadata, hyps, goal, tac_idx, arg_idx)
+        decode_fpa_result_rs(&args, metadata, &hyps, goal, tac_idx, arg_idx)
+    }
+    #[pyfn(m)]
+    fn decode_fpa_predictions(
+        _py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadata,
+        hyps: Vec<String>,
+        goal: &str,
+        idxs: Vec<(f64, i64, i64)>,
+        stem_width: usize,
+        k: usize,
+    ) -> Vec<(String, f64)> {
+        decode_fpa_predictions_rs(&args, metadata, &hyps, goal, &idxs, stem_width, k)
+    }
+    #[pyfn(m)]
+    fn decode_fpa_predictions_batch(
+        _py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadata,
+        batch: Vec<(Vec<String>, String, Vec<(f64, i64, i64)>)>,
+        stem_width: usize,
+        k: usize,
+    ) -> Vec<Vec<(String, f64)>> {
+        decode_fpa_predictions_batch_rs(&args, metadata, &batch, stem_width, k)
     }
     #[pyfn(m)]
     fn tokenize(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         term: String) -> LongTensor1D {
         tokenize_fpa(args, metadata, term)
     }
     #[pyfn(m)]
     pub fn get_premise_features(
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         goal: String,
         premise: String) -> FloatTensor1D {
         get_premise_features_rs(args, metadata, goal, premise)
@@ -197,14 +221,14 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     #[pyfn(m)]
     pub fn get_premise_features_size(
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata) -> i64 {
+        metadata: &FPAMetadata) -> i64 {
         get_premise_features_size_rs(args, metadata)
     }
     #[pyfn(m)]
     fn decode_fpa_stem(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         tac_idx: i64,
     ) -> String {
         decode_fpa_stem_rs(&args, metadata, tac_idx)
@@ -213,7 +237,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn encode_fpa_stem(
         _py: Python,
         args: DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         tac_stem: String,
     ) -> i64 {
         encode_fpa_stem_rs(&args, metadata, tac_stem)
@@ -222,18 +246,18 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     fn decode_fpa_arg(
         _py: Python,
         args: DataloaderArgs,
-        _metadata: PickleableFPAMetadata,
+        _metadata: &FPAMetadata,
         hyps: Vec<String>,
         goal: &str,
         arg_idx: i64,
     ) -> String {
-        decode_fpa_arg_rs(&args, hyps, goal, arg_idx)
+        decode_fpa_arg_rs(&args, &hyps, goal, arg_idx)
     }
     #[pyfn(m)]
     fn encode_fpa_arg(
         _py: Python,
         args: DataloaderArgs,
-        _metadata: PickleableFPAMetadata,
+        _metadata: &FPAMetadata,
         hyps: Vec<String>,
         goal: &str,
         arg: &str,
@@ -244,33 +268,28 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         }
     }
     #[pyfn(m)]
-    fn get_num_tokens(_py: Python, metadata: PickleableFPAMetadata) -> i64 {
-        let (_indexer, tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-        tokenizer.num_tokens()
+    fn get_num_tokens(_py: Python, metadata: &FPAMetadata) -> i64 {
+        metadata.tokenizer.num_tokens()
     }
     #[pyfn(m)]
     fn fpa_get_num_possible_args(_py: Python, args: DataloaderArgs) -> i64 {
         fpa_get_num_possible_args_rs(&args)
     }
     #[pyfn(m)]
-    fn get_num_indices(_py: Python, metadata: PickleableFPAMetadata) -> (PickleableFPAMetadata, i64) {
-        let (mut indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
-        indexer.freeze();
-        let num_indices = indexer.num_indices();
-        (fpa_metadata_to_pickleable((indexer, tokenizer, ftmap)), num_indices)
+    fn get_num_indices(_py: Python, metadata: &mut FPAMetadata) -> i64 {
+        metadata.indexer.freeze();
+        metadata.indexer.num_indices()
     }
     #[pyfn(m)]
-    fn get_all_tactics(_py: Python, metadata: PickleableFPAMetadata) -> Vec<String> {
-	let (indexer, _, _) = fpa_metadata_from_pickleable(metadata);
-	indexer.get_all_tactics()
+    fn get_all_tactics(_py: Python, metadata: &FPAMetadata) -> Vec<String> {
+	metadata.indexer.get_all_tactics()
     }
     #[pyfn(m)]
-    fn get_word_feature_vocab_sizes(_py: Python, metadata: PickleableFPAMetadata) -> Vec<i64> {
-        let (_indexer, _tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
-        ftmap.word_features_sizes()
+    fn get_word_feature_vocab_sizes(_py: Python, metadata: &FPAMetadata) -> Vec<i64> {
+        metadata.ftmap.word_features_sizes()
     }
     #[pyfn(m)]
-    fn get_vec_features_size(_py: Python, _metadata: PickleableFPAMetadata) -> i64 {
+    fn get_vec_features_size(_py: Python, _metadata: &FPAMetadata) -> i64 {
         VEC_FEATURES_SIZE
     }
     #[pyfn(m)]
@@ -360,7 +379,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     #[pyfunction]
     pub fn sample_context_features(
         args: &DataloaderArgs,
-        metadata: PickleableFPAMetadata,
+        metadata: &FPAMetadata,
         relevant_lemmas: Vec<String>,
         prev_tactics: Vec<String>,
         hypotheses: Vec<String>,
@@ -368,7 +387,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     ) -> (LongTensor1D, FloatTensor1D) {
         crate::features::sample_context_features_rs(
             args,
-            &TokenMap::from_dicts(metadata.2),
+            &metadata.ftmap,
             &relevant_lemmas,
             &prev_tactics,
             &hypotheses,
@@ -402,6 +421,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_class::<TokenMap>()?;
     m.add_class::<DataloaderArgs>()?;
     m.add_class::<GoalEncMetadata>()?;
+    m.add_class::<FPAMetadata>()?;
     m.add_class::<ScrapedTactic>()?;
     m.add_class::<ProofContext>()?;
     m.add_class::<ScrapedTransition>()?;
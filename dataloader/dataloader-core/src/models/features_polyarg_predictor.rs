@@ -6,6 +6,7 @@ use rand::Rng;
 use rayon::prelude::*;
 use regex::Regex;
 use serde::{Deserialize, Serialize};
+use std::collections::{HashMap, HashSet};
 use std::fs::File;
 
 use crate::context_filter::{parse_filter, apply_filter};
@@ -43,23 +44,65 @@ pub struct FPAOutput {
     argument: TacticArgument,
 }
 
-pub type FPAMetadata = (OpenIndexer<String>, Tokenizer, FeaturesTokenMap);
 pub type PickleableFPAMetadata = (
     PickleableIndexer<String>,
     PickleableTokenizer,
     PickleableFeaturesTokenMap,
 );
 
-pub fn fpa_metadata_to_pickleable(metadata: FPAMetadata) -> PickleableFPAMetadata {
+// The metadata is built once from its pickleable form and then handed to
+// the dataloader functions by reference, instead of being converted back
+// and forth on every call.
+#[pyclass(module = "dataloader")]
+pub struct FPAMetadata {
+    pub indexer: OpenIndexer<String>,
+    pub tokenizer: Tokenizer,
+    pub ftmap: FeaturesTokenMap,
+    // The indexer only maps stems to indices, so keep the other direction
+    // around for decoding.
+    stems: HashMap<i64, String>,
+}
+
+impl FPAMetadata {
+    pub fn from_parts(
+        indexer: OpenIndexer<String>,
+        tokenizer: Tokenizer,
+        ftmap: FeaturesTokenMap,
+    ) -> Self {
+        let stems = indexer.reversed();
+        FPAMetadata {
+            indexer,
+            tokenizer,
+            ftmap,
+            stems,
+        }
+    }
+}
+
+#[pymethods]
+impl FPAMetadata {
+    #[new]
+    fn new(pick: PickleableFPAMetadata) -> Self {
+        fpa_metadata_from_pickleable(pick)
+    }
+    fn to_pickleable(&self) -> PickleableFPAMetadata {
+        fpa_metadata_to_pickleable(self)
+    }
+    fn __getnewargs__(&self) -> (PickleableFPAMetadata,) {
+        (fpa_metadata_to_pickleable(self),)
+    }
+}
+
+pub fn fpa_metadata_to_pickleable(metadata: &FPAMetadata) -> PickleableFPAMetadata {
     (
-        metadata.0.to_pickleable(),
-        metadata.1.to_pickleable(),
-        metadata.2.to_dicts(),
+        metadata.indexer.clone().to_pickleable(),
+        metadata.tokenizer.clone().to_pickleable(),
+        metadata.ftmap.to_dicts(),
     )
 }
 
 pub fn fpa_metadata_from_pickleable(pick: PickleableFPAMetadata) -> FPAMetadata {
-    (
+    FPAMetadata::from_parts(
         OpenIndexer::from_pickleable(pick.0),
         Tokenizer::from_pickleable(pick.1),
         FeaturesTokenMap::from_dicts(pick.2),
@@ -230,7 +273,11 @@ pub fn features_polyarg_tensors_rs(
         .collect();
     let word_features_sizes = features_token_map.word_features_sizes();
     Ok((
-        fpa_metadata_to_pickleable((indexer, tokenizer, features_token_map)),
+        fpa_metadata_to_pickleable(&FPAMetadata::from_parts(
+            indexer,
+            tokenizer,
+            features_token_map,
+        )),
         (
             tokenized_hyps,
             hyp_features,
@@ -278,18 +325,17 @@ fn get_goal_mask(goal: &str, max_length: usize) -> Vec<bool> {
 
 pub fn tokenize_fpa(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     term: String) -> LongTensor1D {
 
-    let (_indexer, tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
     normalize_sentence_length(
-        tokenizer.tokenize(&term),
+        metadata.tokenizer.tokenize(&term),
         args.max_length, 0)
 }
 
 pub fn get_premise_features_rs(
     _args: DataloaderArgs,
-    _metadata: PickleableFPAMetadata,
+    _metadata: &FPAMetadata,
     goal: String,
     premise: String) -> FloatTensor1D {
     let score = gestalt_ratio(&goal, get_hyp_type(&premise));
@@ -298,13 +344,13 @@ pub fn get_premise_features_rs(
 }
 pub fn get_premise_features_size_rs(
     _args: DataloaderArgs,
-    _metadata: PickleableFPAMetadata) -> i64 {
+    _metadata: &FPAMetadata) -> i64 {
     2
 }
 
 pub fn sample_fpa_batch_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     context_batch: Vec<TacticContext>,
 ) -> (
     LongUnpaddedTensor3D,
@@ -315,13 +361,13 @@ pub fn sample_fpa_batch_rs(
     LongTensor2D,
     FloatTensor2D,
 ) {
-    let (_indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+    let tokenizer = &metadata.tokenizer;
     let (word_features_batch, vec_features_batch) = context_batch
         .iter()
         .map(|ctxt| {
             sample_context_features_rs(
                 &args,
-                &ftmap,
+                &metadata.ftmap,
                 &ctxt.relevant_lemmas,
                 &ctxt.prev_tactics,
                 &ctxt.obligation.hypotheses,
@@ -411,7 +457,7 @@ pub fn sample_fpa_batch_rs(
 
 pub fn sample_fpa_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     relevant_lemmas: Vec<String>,
     prev_tactics: Vec<String>,
     hypotheses: Vec<String>,
@@ -425,10 +471,10 @@ pub fn sample_fpa_rs(
     LongTensor2D,
     FloatTensor2D,
 ) {
-    let (_indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+    let tokenizer = &metadata.tokenizer;
     let (word_features, vec_features) = sample_context_features_rs(
         &args,
-        &ftmap,
+        &metadata.ftmap,
         &relevant_lemmas,
         &prev_tactics,
         &hypotheses,
@@ -471,15 +517,26 @@ pub fn sample_fpa_rs(
 }
 
 pub fn decode_fpa_result_rs(
-    args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
-    premises: Vec<String>,
+    args: &DataloaderArgs,
+    metadata: &FPAMetadata,
+    premises: &[String],
     goal: &str,
     tac_idx: i64,
     arg_idx: i64,
 ) -> String {
-    let stem = decode_fpa_stem_rs(&args, metadata, tac_idx);
-    let arg = decode_fpa_arg_rs(&args, premises, goal, arg_idx);
+    decode_fpa_result_with_words(args, metadata, premises, &get_words(goal), tac_idx, arg_idx)
+}
+
+fn decode_fpa_result_with_words(
+    args: &DataloaderArgs,
+    metadata: &FPAMetadata,
+    premises: &[String],
+    goal_words: &[&str],
+    tac_idx: i64,
+    arg_idx: i64,
+) -> String {
+    let stem = decode_fpa_stem_rs(args, metadata, tac_idx);
+    let arg = decode_fpa_arg_with_words(args, premises, goal_words, arg_idx);
     if arg == "" {
         format!("{}.", stem)
     } else {
@@ -487,29 +544,85 @@ pub fn decode_fpa_result_rs(
     }
 }
 
+// Decodes the (log prob, stem idx, arg idx) triples of a context, best
+// first, into its top k distinct predictions and their log probs.
+pub fn decode_fpa_predictions_rs(
+    args: &DataloaderArgs,
+    metadata: &FPAMetadata,
+    premises: &[String],
+    goal: &str,
+    idxs: &[(f64, i64, i64)],
+    stem_width: usize,
+    k: usize,
+) -> Vec<(String, f64)> {
+    let goal_words = get_words(goal);
+    // Past this point the indices are for arguments that don't exist.
+    let num_valid_idxs = (1 + premises.len() + goal_words.len()) * stem_width;
+    let mut seen: HashSet<String> = HashSet::new();
+    let mut predictions = Vec::new();
+    for (prob, tac_idx, arg_idx) in idxs.iter().take(num_valid_idxs) {
+        if predictions.len() >= k {
+            break;
+        }
+        let prediction =
+            decode_fpa_result_with_words(args, metadata, premises, &goal_words, *tac_idx, *arg_idx);
+        if !seen.contains(&prediction) {
+            seen.insert(prediction.clone());
+            predictions.push((prediction, *prob));
+        }
+    }
+    predictions
+}
+
+pub fn decode_fpa_predictions_batch_rs(
+    args: &DataloaderArgs,
+    metadata: &FPAMetadata,
+    batch: &[(Vec<String>, String, Vec<(f64, i64, i64)>)],
+    stem_width: usize,
+    k: usize,
+) -> Vec<Vec<(String, f64)>> {
+    batch
+        .par_iter()
+        .map(|(premises, goal, idxs)| {
+            decode_fpa_predictions_rs(args, metadata, premises, goal, idxs, stem_width, k)
+        })
+        .collect()
+}
+
 pub fn decode_fpa_stem_rs(
     _args: &DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     tac_idx: i64,
 ) -> String {
-    let (indexer, _tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-    indexer.reverse_lookup(tac_idx)
+    metadata
+        .stems
+        .get(&tac_idx)
+        .expect("That token doesn't exist!")
+        .clone()
 }
 
 pub fn encode_fpa_stem_rs(
     _args: &DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     tac_stem: String,
 ) -> i64 {
-    let (mut indexer, _tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
-    indexer.lookup(tac_stem)
+    metadata.indexer.peek_lookup(&tac_stem)
 }
 
 pub fn decode_fpa_arg_rs(
     args: &DataloaderArgs,
-    premises: Vec<String>,
+    premises: &[String],
     goal: &str,
     arg_idx: i64,
+) -> String {
+    decode_fpa_arg_with_words(args, premises, &get_words(goal), arg_idx)
+}
+
+fn decode_fpa_arg_with_words(
+    args: &DataloaderArgs,
+    premises: &[String],
+    goal_words: &[&str],
+    arg_idx: i64,
 ) -> String {
     let argtype = if arg_idx == 0 {
         TacticArgument::NoArg
@@ -523,10 +636,10 @@ pub fn decode_fpa_arg_rs(
         TacticArgument::Unrecognized => "".to_string(),
         TacticArgument::GoalToken(tidx) => {
             // assert!(tidx < get_words(goal).len(), format!("{}, {:?}, {}", goal, get_words(goal), tidx));
-            if tidx >= get_words(goal).len() {
+            if tidx >= goal_words.len() {
                 "<INVALID>".to_string()
             } else {
-                get_words(goal)[tidx].to_string()
+                goal_words[tidx].to_string()
             }
         }
         TacticArgument::HypVar(hidx) => {
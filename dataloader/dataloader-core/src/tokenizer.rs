@@ -12,6 +12,7 @@ use regex::Regex;
 
 pub type Token = i64;
 
+#[derive(Clone)]
 pub struct OpenIndexer<T>
 where
     T: Eq + Hash + Clone,
@@ -48,6 +49,25 @@ where
         }
         *self.map.get(&v).unwrap()
     }
+    // What lookup would return, without adding anything to the indexer.
+    pub fn peek_lookup(&self, v: &T) -> i64 {
+        match self.map.get(v) {
+            Some(idx) => *idx,
+            None => {
+                if self.frozen {
+                    0
+                } else {
+                    self.next_idx
+                }
+            }
+        }
+    }
+    pub fn reversed(&self) -> HashMap<i64, T> {
+        self.map
+            .iter()
+            .map(|(item, idx)| (*idx, item.clone()))
+            .collect()
+    }
     pub fn reverse_lookup(&self, i: i64) -> T {
         self.map
             .iter()
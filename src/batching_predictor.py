@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import contextlib
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import Prediction, TacticPredictor
+
+
+class _Request:
+    contexts: List[TacticContext]
+    k: int
+    result: Optional[List[List[Prediction]]]
+    error: Optional[Exception]
+    done: bool
+
+    def __init__(self, contexts: List[TacticContext], k: int) -> None:
+        self.contexts = contexts
+        self.k = k
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class BatchingPredictor(TacticPredictor):
+    """
+    Shares one predictor between several searches running in threads of the
+    same process. Requests from the searches are pooled, and run as a single
+    batch once every registered client is waiting on the predictor, or once
+    the oldest request has waited max_wait seconds.
+    """
+    predictor: TacticPredictor
+    max_wait: float
+    num_clients: int
+    _pending: List[_Request]
+    _running: bool
+
+    def __init__(self, predictor: TacticPredictor,
+                 max_wait: float = 0.05) -> None:
+        super().__init__()
+        self.predictor = predictor
+        self.max_wait = max_wait
+        self.num_clients = 0
+        self._pending = []
+        self._running = False
+        self._cond = threading.Condition()
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes we don't have ourselves, like the
+        # training args of the underlying predictor.
+        if name == "predictor":
+            raise AttributeError(name)
+        return getattr(self.predictor, name)
+
+    @contextlib.contextmanager
+    def client(self) -> Iterator[None]:
+        with self._cond:
+            self.num_clients += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.num_clients -= 1
+                self._cond.notify_all()
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return self.predictor.getOptions()
+
+    def predictKTactics(self, in_data: TacticContext, k: int) \
+            -> List[Prediction]:
+        return self._request([in_data], k)[0]
+
+    def predictKTactics_batch(self, in_datas: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        if not in_datas:
+            return []
+        return self._request(in_datas, k)
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) \
+            -> Tuple[List[Prediction], float]:
+        with self._exclusive():
+            return self.predictor.predictKTacticsWithLoss(in_data, k, correct)
+
+    def predictKTacticsWithLoss_batch(self, in_data: List[TacticContext],
+                                      k: int, correct: List[str]) \
+            -> Tuple[List[List[Prediction]], float]:
+        with self._exclusive():
+            return self.predictor.predictKTacticsWithLoss_batch(in_data, k,
+                                                                correct)
+
+    @contextlib.contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        with self._cond:
+            while self._running:
+                self._cond.wait()
+            self._running = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+
+    def _ready(self, deadline: float) -> bool:
+        return not self._running and \
+            (len(self._pending) >= self.num_clients or
+             time.time() >= deadline)
+
+    def _request(self, contexts: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        request = _Request(contexts, k)
+        deadline = time.time() + self.max_wait
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+            try:
+                while not request.done and not self._ready(deadline):
+                    self._cond.wait(max(deadline - time.time(), 0.001))
+            except BaseException:
+                # Interrupted (probably by a lemma timeout) while waiting,
+                # so nobody wants the answer anymore.
+                if request in self._pending:
+                    self._pending.remove(request)
+                raise
+            if not request.done:
+                # Our request is still pending, so we run everything that's
+                # waiting along with it.
+                batch = self._pending
+                self._pending = []
+                self._running = True
+        if not request.done:
+            try:
+                self._run(batch)
+            finally:
+                with self._cond:
+                    # If we were interrupted part way through, hand the
+                    # requests we didn't get to back to the other clients.
+                    self._pending = [r for r in batch if not r.done and
+                                     r is not request] + self._pending
+                    self._running = False
+                    self._cond.notify_all()
+        if request.error:
+            raise request.error
+        return request.result  # type: ignore
+
+    def _run(self, batch: List[_Request]) -> None:
+        by_k: Dict[int, List[_Request]] = {}
+        for request in batch:
+            by_k.setdefault(request.k, []).append(request)
+        for k, requests in by_k.items():
+            contexts = [context for request in requests
+                        for context in request.contexts]
+            try:
+                if len(contexts) == 1:
+                    results = [self.predictor.predictKTactics(contexts[0], k)]
+                else:
+                    results = self.predictor.predictKTactics_batch(contexts,
+                                                                   k)
+                error: Optional[Exception] = None
+            except Exception as e:
+                error = e
+            idx = 0
+            for request in requests:
+                if error:
+                    request.error = error
+                else:
+                    request.result = results[idx:idx + len(request.contexts)]
+                idx += len(request.contexts)
+                request.done = True
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+import os
+import shlex
+import signal
+import subprocess
+import sys
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List
+
+# The cluster coordinator and its workers only talk through files in the
+# output directory, so all a dispatcher has to do is start an array of
+# workers somewhere that can see that directory, tell each one its index in
+# the array, and stop them again.
+
+SRC_DIR = os.path.realpath(os.path.dirname(__file__))
+WORKER_ID_VARIABLES = ["PROVERBOT_WORKER_ID", "SLURM_ARRAY_TASK_ID"]
+
+
+def add_dispatch_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--dispatcher", default="slurm",
+                        choices=["slurm", "local", "ssh", "k8s"],
+                        help="How to start the workers: as a slurm job "
+                        "array, as processes on this machine, or over ssh "
+                        "or kubectl exec on the given hosts or pods")
+    parser.add_argument("--hosts", default=None,
+                        help="Comma-separated hosts to run ssh workers on, "
+                        "in turn")
+    parser.add_argument("--k8s-selector", default="k8s-app=proverbot",
+                        help="Label selector of the pods to run k8s "
+                        "workers on")
+    parser.add_argument("--remote-dir", default=os.getcwd(),
+                        help="Directory to run ssh and k8s workers in")
+    parser.add_argument("--remote-src-dir", default=SRC_DIR,
+                        help="Proverbot's src directory on ssh and k8s "
+                        "hosts")
+
+
+def get_worker_id() -> int:
+    for variable in WORKER_ID_VARIABLES:
+        if variable in os.environ:
+            return int(os.environ[variable])
+    assert False, f"One of {', '.join(WORKER_ID_VARIABLES)} must be set"
+
+
+class Dispatcher(ABC):
+    @abstractmethod
+    def dispatch(self, name: str, script: str, script_args: List[str],
+                 num_workers: int, log_pattern: Path) -> None:
+        """
+        Start num_workers copies of the given script in src (without its
+        extension), each with its own worker id. A %a in log_pattern is
+        replaced with the worker id to get the file its output goes to.
+        """
+        pass
+
+    @abstractmethod
+    def cancel(self, name: str) -> None:
+        pass
+
+
+class SlurmDispatcher(Dispatcher):
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.partition = args.partition
+        self.worker_timeout = args.worker_timeout
+        self.mem = args.mem
+        self.num_threads = args.num_threads
+
+    def dispatch(self, name: str, script: str, script_args: List[str],
+                 num_workers: int, log_pattern: Path) -> None:
+        subprocess.run([f"{SRC_DIR}/sbatch-retry.sh",
+                        "-J", name,
+                        "-p", self.partition,
+                        "-t", str(self.worker_timeout),
+                        "--cpus-per-task", str(self.num_threads),
+                        "-o", str(log_pattern),
+                        "--mem", self.mem,
+                        f"--array=0-{num_workers-1}",
+                        f"{SRC_DIR}/{script}.sh"] + script_args)
+
+    def cancel(self, name: str) -> None:
+        subprocess.run([f"scancel -u $USER -n {name}"], shell=True)
+
+
+class LocalDispatcher(Dispatcher):
+    _workers: Dict[str, List[subprocess.Popen]]
+
+    def __init__(self) -> None:
+        self._workers = {}
+
+    def dispatch(self, name: str, script: str, script_args: List[str],
+                 num_workers: int, log_pattern: Path) -> None:
+        for worker_id in range(num_workers):
+            with open(str(log_pattern).replace("%a", str(worker_id)),
+                      'w') as log:
+                self._workers.setdefault(name, []).append(subprocess.Popen(
+                    [sys.executable, f"{SRC_DIR}/{script}.py"] + script_args,
+                    env=dict(os.environ, PROVERBOT_WORKER_ID=str(worker_id)),
+                    stdout=log, stderr=subprocess.STDOUT,
+                    start_new_session=True))
+
+    def cancel(self, name: str) -> None:
+        # Like scancel, stop everything the worker started too, including
+        # its search processes and their sertops.
+        for worker in self._workers.pop(name, []):
+            try:
+                os.killpg(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            worker.wait()
+
+
+class RemoteShellDispatcher(Dispatcher):
+    """
+    Runs workers through a remote shell on each of a list of hosts in turn,
+    with the output directory on a filesystem they all share.
+    """
+    _workers: Dict[str, List[subprocess.Popen]]
+
+    def __init__(self, args: argparse.Namespace, hosts: List[str]) -> None:
+        assert hosts, "No hosts to run workers on"
+        self.hosts = hosts
+        self.remote_dir = args.remote_dir
+        self.remote_src_dir = args.remote_src_dir
+        self._workers = {}
+
+    @abstractmethod
+    def shell_command(self, host: str, command: str) -> List[str]:
+        pass
+
+    def dispatch(self, name: str, script: str, script_args: List[str],
+                 num_workers: int, log_pattern: Path) -> None:
+        for worker_id in range(num_workers):
+            log = str(log_pattern).replace("%a", str(worker_id))
+            command = ("eval $(opam env); "
+                       f"cd {shlex.quote(self.remote_dir)} && "
+                       f"PROVERBOT_WORKER_ID={worker_id} python3 "
+                       f"{shlex.quote(f'{self.remote_src_dir}/{script}.py')} "
+                       f"{' '.join(shlex.quote(arg) for arg in script_args)} "
+                       f"> {shlex.quote(log)} 2>&1")
+            host = self.hosts[worker_id % len(self.hosts)]
+            self._workers.setdefault(name, []).append(subprocess.Popen(
+                self.shell_command(host, command),
+                stdin=subprocess.DEVNULL))
+
+    def cancel(self, name: str) -> None:
+        # The workers run in a terminal that closes along with the remote
+        # shell, so they get hung up on.
+        for worker in self._workers.pop(name, []):
+            worker.terminate()
+            worker.wait()
+
+
+class SSHDispatcher(RemoteShellDispatcher):
+    def shell_command(self, host: str, command: str) -> List[str]:
+        return ["ssh", "-tt", host, command]
+
+
+class K8sDispatcher(RemoteShellDispatcher):
+    def __init__(self, args: argparse.Namespace) -> None:
+        pods = subprocess.run(["kubectl", "get", "pods",
+                               "-l", args.k8s_selector,
+                               "--field-selector=status.phase=Running",
+                               "-o", "name"],
+                              stdout=subprocess.PIPE, text=True,
+                              check=True).stdout.split()
+        super().__init__(args, pods)
+
+    def shell_command(self, host: str, command: str) -> List[str]:
+        return ["kubectl", "exec", "-t", host, "--", "sh", "-c", command]
+
+
+def get_dispatcher(args: argparse.Namespace) -> Dispatcher:
+    if args.dispatcher == "slurm":
+        return SlurmDispatcher(args)
+    elif args.dispatcher == "local":
+        return LocalDispatcher()
+    elif args.dispatcher == "ssh":
+        assert args.hosts, "The ssh dispatcher needs --hosts"
+        return SSHDispatcher(args, args.hosts.split(","))
+    elif args.dispatcher == "k8s":
+        return K8sDispatcher(args)
+    else:
+        assert False, args.dispatcher
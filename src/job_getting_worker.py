@@ -7,7 +7,7 @@ import multiprocessing
 from pathlib import Path
 
 from search_worker import get_files_jobs
-from util import FileLock
+from util import FileLock, claim_next_index
 
 from typing import List, cast, Tuple
 
@@ -42,15 +42,14 @@ def run_worker(args: argparse.Namespace) -> None:
         all_proj_files = [json.loads(line) for line in f]
 
     while True:
-        with (args.output_dir / args.proj_files_taken_file).open('r+') as f, FileLock(f):
-            taken_proj_files = [json.loads(line) for line in f]
-            to_be_scanned = [tuple(proj_file) for proj_file in all_proj_files
-                             if proj_file not in taken_proj_files]
-            if len(to_be_scanned) > 0:
-                next_proj_file = cast(Tuple[str, str], to_be_scanned[0])
-                print(json.dumps(next_proj_file), file=f, flush=True)
-            else:
-                break
+        # The taken file counts how many of the project files have been
+        # claimed.
+        proj_file_idx = claim_next_index(args.output_dir /
+                                         args.proj_files_taken_file)
+        if proj_file_idx >= len(all_proj_files):
+            break
+        next_proj_file = cast(Tuple[str, str],
+                              tuple(all_proj_files[proj_file_idx]))
         jobs = get_files_jobs(args, [next_proj_file])
         with (args.output_dir / args.jobs_file).open('a') as f, FileLock(f):
             for job in list(dict.fromkeys(jobs)):
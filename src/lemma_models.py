@@ -34,6 +34,9 @@ class ILearner(ABC):
   def predict(self, lemma: Lemma) -> float:
     raise NotImplemented
 
+  def predict_batch(self, lemmas: List[Lemma]) -> List[float]:
+    return [float(self.predict(lemma)) for lemma in lemmas]
+
   @property
   @abstractmethod
   def name(self) -> str:
@@ -55,6 +58,8 @@ class NaiveMeanLearner(ILearner):
 
   def predict(self, lemma): return self._mean
 
+  def predict_batch(self, lemmas): return [self._mean] * len(lemmas)
+
   @property
   def name(self):
     return "naive mean"
@@ -76,6 +81,12 @@ class LinRegressionLearner(ILearner):
   def predict(self, lemma):
     return self._model.predict([[float(nested_size(lemma.type))]])
 
+  def predict_batch(self, lemmas):
+    if not lemmas:
+      return []
+    return [float(y) for y in self._model.predict(
+      [[float(nested_size(l.type))] for l in lemmas])]
+
   @property
   def name(self):
     return "LR size"
@@ -97,6 +108,12 @@ class SVRLength(ILearner):
   def predict(self, lemma):
     return self._model.predict([[float(nested_size(lemma.type))]])
 
+  def predict_batch(self, lemmas):
+    if not lemmas:
+      return []
+    return [float(y) for y in self._model.predict(
+      [[float(nested_size(l.type))] for l in lemmas])]
+
   @property
   def name(self):
     return "SVR size"
@@ -116,6 +133,12 @@ class SVRIdent(ILearner):
   def predict(self, lemma):
     return self._model.predict([[float(ident_size(lemma.type))]])
 
+  def predict_batch(self, lemmas):
+    if not lemmas:
+      return []
+    return [float(y) for y in self._model.predict(
+      [[float(ident_size(l.type))] for l in lemmas])]
+
   @property
   def name(self):
     return "SVR idents"
@@ -135,6 +158,12 @@ class SVRIdentLength(ILearner):
   def predict(self, lemma):
     return self._model.predict([[float(ident_size(lemma.type)), float(nested_size(lemma.type))]])
 
+  def predict_batch(self, lemmas):
+    if not lemmas:
+      return []
+    return [float(y) for y in self._model.predict(
+      [[float(ident_size(l.type)), float(nested_size(l.type))] for l in lemmas])]
+
   @property
   def name(self):
     return "SVR idents + size"
@@ -232,6 +261,19 @@ class KNNIdents(ILearner):
 
     return self._locals[buck].predict(lemma)
 
+  def predict_batch(self, lemmas):
+    if not lemmas:
+      return []
+    bucks = [int(b) for b in self._model.predict(
+      [make_ident_vector(lemma, self._ident_idx) for lemma in lemmas])]
+    results = [0.0] * len(lemmas)
+    for buck in set(bucks):
+      idxs = [i for i, b in enumerate(bucks) if b == buck]
+      for i, y in zip(idxs, self._locals[buck].predict_batch(
+          [lemmas[i] for i in idxs])):
+        results[i] = y
+    return results
+
   @property
   def name(self):
     inner = ",".join([x.name for x in self._locals])
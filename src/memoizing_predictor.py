@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import Prediction, TacticPredictor
+
+
+def weights_fingerprint(weightsfile: Path) -> str:
+    h = hashlib.sha256()
+    with weightsfile.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MemoizingPredictor(TacticPredictor):
+    """
+    Remembers the predictions made for each context, so that states seen
+    again (after backtracking, on a retried lemma, or in a re-run of the same
+    files) don't need the model. Keeps the most recent max_size results in
+    memory, and if cache_dir is given, every result on disk, where other
+    workers and later runs with the same weights can use them.
+    """
+    predictor: TacticPredictor
+    fingerprint: str
+    max_size: int
+    cache_dir: Optional[Path]
+    _predictions: "OrderedDict[str, List[Prediction]]"
+
+    def __init__(self, predictor: TacticPredictor, fingerprint: str,
+                 max_size: int, cache_dir: Optional[Path] = None) -> None:
+        super().__init__()
+        self.predictor = predictor
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self._predictions = OrderedDict()
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes we don't have ourselves. Leave the
+        # pickling hooks alone, so that copying a MemoizingPredictor doesn't
+        # use the wrapped predictor's.
+        if name == "predictor" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.predictor, name)
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return self.predictor.getOptions()
+
+    def predictKTactics(self, in_data: TacticContext, k: int) \
+            -> List[Prediction]:
+        key = self._key(in_data, k)
+        predictions = self._lookup(key)
+        if predictions is None:
+            predictions = self.predictor.predictKTactics(in_data, k)
+            self._store(key, predictions)
+        return predictions
+
+    def predictKTactics_batch(self, in_datas: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        keys = [self._key(in_data, k) for in_data in in_datas]
+        predictions_batch = [self._lookup(key) for key in keys]
+        missing_idxs = [idx for idx, predictions
+                        in enumerate(predictions_batch)
+                        if predictions is None]
+        if len(missing_idxs) == 1:
+            new_predictions = [self.predictor.predictKTactics(
+                in_datas[missing_idxs[0]], k)]
+        elif len(missing_idxs) > 1:
+            new_predictions = self.predictor.predictKTactics_batch(
+                [in_datas[idx] for idx in missing_idxs], k)
+        else:
+            new_predictions = []
+        for idx, predictions in zip(missing_idxs, new_predictions):
+            predictions_batch[idx] = predictions
+            self._store(keys[idx], predictions)
+        return predictions_batch  # type: ignore
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) \
+            -> Tuple[List[Prediction], float]:
+        return self.predictor.predictKTacticsWithLoss(in_data, k, correct)
+
+    def predictKTacticsWithLoss_batch(self, in_data: List[TacticContext],
+                                      k: int, correct: List[str]) \
+            -> Tuple[List[List[Prediction]], float]:
+        return self.predictor.predictKTacticsWithLoss_batch(in_data, k,
+                                                            correct)
+
+    def _key(self, context: TacticContext, k: int) -> str:
+        key_data = json.dumps([self.fingerprint, k, context.relevant_lemmas,
+                               context.prev_tactics, context.hypotheses,
+                               context.goal])
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        assert self.cache_dir
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _lookup(self, key: str) -> Optional[List[Prediction]]:
+        predictions = self._predictions.get(key)
+        if predictions is not None:
+            self._predictions.move_to_end(key)
+            return predictions
+        if self.cache_dir is None:
+            return None
+        try:
+            with self._disk_path(key).open('r') as f:
+                predictions = [Prediction(prediction, certainty)
+                               for prediction, certainty in json.load(f)]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        self._remember(key, predictions)
+        return predictions
+
+    def _store(self, key: str, predictions: List[Prediction]) -> None:
+        self._remember(key, predictions)
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and move it into place, so readers in
+        # other processes never see a partial entry.
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump([list(prediction) for prediction in predictions], f)
+        os.replace(tmp_name, path)
+
+    def _remember(self, key: str, predictions: List[Prediction]) -> None:
+        if self.max_size <= 0:
+            return
+        self._predictions[key] = predictions
+        self._predictions.move_to_end(key)
+        if len(self._predictions) > self.max_size:
+            self._predictions.popitem(last=False)
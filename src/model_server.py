@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+import util
+from util import eprint
+from batching_predictor import BatchingPredictor
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import Prediction, TacticPredictor
+from memoizing_predictor import MemoizingPredictor, weights_fingerprint
+from models.features_polyarg_predictor import (FeaturesPolyargPredictor,
+                                               DEFAULT_ENCODING_CACHE_SIZE)
+from predict_tactic import loadPredictorByFile
+
+# A model server owns the only copy of a predictor on a machine. Search
+# workers in other processes send it their prediction requests over a unix
+# socket, and requests from different workers are run together in batches,
+# the same way BatchingPredictor batches the threads of a single worker.
+
+SERVED_METHODS = {"getOptions", "predictKTactics", "predictKTactics_batch",
+                  "predictKTacticsWithLoss", "predictKTacticsWithLoss_batch"}
+
+
+def serve_predictions(predictor: TacticPredictor, address: str,
+                      max_wait: float = 0.05,
+                      device: Optional[str] = None,
+                      inference_threads: Optional[int] = None,
+                      inference_dtype: str = "float32") -> None:
+    if device is not None and util.use_cuda:
+        torch.cuda.set_device(device) # type: ignore
+        util.cuda_device = device
+        predictor.to_device(device) # type: ignore
+    util.configure_inference(inference_threads, inference_dtype)
+    batching_predictor = BatchingPredictor(predictor, max_wait)
+    with Listener(address, family="AF_UNIX") as listener:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=serve_client,
+                             args=(batching_predictor, conn),
+                             daemon=True).start()
+
+
+def serve_client(predictor: BatchingPredictor, conn: Connection) -> None:
+    with predictor.client(), conn:
+        while True:
+            try:
+                method, method_args = conn.recv()
+            except (EOFError, ConnectionResetError):
+                return
+            if method not in SERVED_METHODS:
+                response: Tuple[bool, Any] = \
+                    (False, ValueError(f"Can't call {method} remotely"))
+            else:
+                try:
+                    response = (True, getattr(predictor, method)(*method_args))
+                except Exception as e:
+                    response = (False, e)
+            try:
+                conn.send(response)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away while we were predicting for it,
+                # probably because its lemma timed out.
+                return
+
+
+class RemotePredictor(TacticPredictor):
+    """
+    Predicts by sending requests to a model server. Connects the first
+    time it's used, so it can be sent to worker processes before then.
+    """
+    address: str
+    connect_timeout: float
+    _conn: Optional[Connection]
+
+    def __init__(self, address: str, connect_timeout: float = 120.0) -> None:
+        super().__init__()
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"address": self.address,
+                "connect_timeout": self.connect_timeout}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.address = state["address"]
+        self.connect_timeout = state["connect_timeout"]
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> Connection:
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                return Client(self.address, family="AF_UNIX")
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The server might still be loading its weights.
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+    def _call(self, method: str, *method_args: Any) -> Any:
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            try:
+                self._conn.send((method, method_args))
+                succeeded, result = self._conn.recv()
+            except BaseException:
+                # If we were interrupted between sending and receiving, the
+                # answer would be read by the next call, so start over with
+                # a new connection instead.
+                self._conn.close()
+                self._conn = None
+                raise
+        if not succeeded:
+            raise result
+        return result
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return self._call("getOptions")
+
+    def predictKTactics(self, in_data: TacticContext, k: int) \
+            -> List[Prediction]:
+        return self._call("predictKTactics", in_data, k)
+
+    def predictKTactics_batch(self, in_datas: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        return self._call("predictKTactics_batch", in_datas, k)
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) \
+            -> Tuple[List[Prediction], float]:
+        return self._call("predictKTacticsWithLoss", in_data, k, correct)
+
+    def predictKTacticsWithLoss_batch(self, in_data: List[TacticContext],
+                                      k: int, correct: List[str]) \
+            -> Tuple[List[List[Prediction]], float]:
+        return self._call("predictKTacticsWithLoss_batch", in_data, k,
+                          correct)
+
+    def to_device(self, device: str) -> None:
+        pass
+
+    def share_memory(self) -> None:
+        pass
+
+
+def main(arg_list: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve predictions to the search workers on this machine")
+    parser.add_argument("weightsfile", type=Path)
+    parser.add_argument("address",
+                        help="Path of the unix socket to listen on")
+    parser.add_argument("--max-wait", type=float, default=0.05,
+                        help="Longest a request waits for others to batch "
+                        "with, in seconds")
+    parser.add_argument("--prediction-cache-size", type=int, default=0,
+                        help="Number of contexts to remember predictions "
+                        "for. 0 to disable.")
+    parser.add_argument("--prediction-cache-dir", type=Path, default=None,
+                        help="Directory to also remember every prediction "
+                        "in, shared between servers and runs")
+    parser.add_argument("--encoding-cache-size", type=int,
+                        default=DEFAULT_ENCODING_CACHE_SIZE,
+                        help="Number of goal and premise encodings a polyarg "
+                        "predictor remembers, for each of the two. 0 to "
+                        "disable.")
+    parser.add_argument("--inference-threads", type=int, default=None)
+    parser.add_argument("--inference-dtype",
+                        choices=list(util.inference_dtypes.keys()),
+                        default="float32")
+    parser.add_argument("--gpu", default=0, type=int)
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    args = parser.parse_args(arg_list)
+
+    predictor: TacticPredictor = loadPredictorByFile(args.weightsfile)
+    if isinstance(predictor, FeaturesPolyargPredictor):
+        predictor.set_encoding_cache_size(args.encoding_cache_size)
+    if args.prediction_cache_size > 0 or args.prediction_cache_dir:
+        predictor = MemoizingPredictor(predictor,
+                                       weights_fingerprint(args.weightsfile),
+                                       args.prediction_cache_size,
+                                       args.prediction_cache_dir)
+    if os.path.exists(args.address):
+        os.remove(args.address)
+    eprint(f"Serving predictions on {args.address}", guard=args.verbose >= 1)
+    serve_predictions(predictor, args.address, args.max_wait,
+                      f"cuda:{args.gpu}", args.inference_threads,
+                      args.inference_dtype)
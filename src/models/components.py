@@ -246,12 +246,10 @@ class EncoderRNN(nn.Module):
         input_var = maybe_cuda(Variable(input_seq))
         batch_size = input_seq.size()[0]
         hidden = maybe_cuda(Variable(torch.zeros(1, batch_size, self.hidden_size)))
-        for i in range(input_seq.size()[1]):
-            token_batch = self._word_embedding(input_var[:,i])\
-                .view(1, batch_size, self.hidden_size)
-            token_batch = F.relu(token_batch)
-            token_out, hidden = self._gru(token_batch, hidden)
-        result = self._out_layer(token_out.view(batch_size, self.hidden_size))
+        tokens_embedded = F.relu(self._word_embedding(input_var))\
+            .transpose(0, 1).contiguous()
+        token_outs, hidden = self._gru(tokens_embedded, hidden)
+        result = self._out_layer(token_outs[-1].view(batch_size, self.hidden_size))
         return result
 
 
@@ -19,7 +19,6 @@
 #
 ##########################################################################
 
-from tqdm import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -47,7 +46,8 @@ from dataloader import (features_polyarg_tensors,
                         features_polyarg_tensors_with_meta,
                         sample_fpa,
                         sample_fpa_batch,
-                        decode_fpa_result,
+                        decode_fpa_predictions,
+                        decode_fpa_predictions_batch,
                         encode_fpa_stem,
                         encode_fpa_arg,
                         decode_fpa_stem,
@@ -58,13 +58,14 @@ from dataloader import (features_polyarg_tensors,
                         get_word_feature_vocab_sizes,
                         get_vec_features_size,
                         DataloaderArgs,
-                        get_fpa_words)
+                        FPAMetadata)
 
 import coq_serapy as serapi_instance
 
 import argparse
 import sys
 from argparse import Namespace
+from collections import OrderedDict
 from typing import (List, Tuple, NamedTuple, Optional, Sequence, Dict,
                     cast, Union, Set, Type, Any, Iterable)
 
@@ -106,6 +107,45 @@ class FeaturesPolyArgDataset(ListDataset[FeaturesPolyArgSample]):
 
 FeaturesPolyargState = Tuple[Any, NeuralPredictorState]
 
+# How many times k prediction indices to decode at first, to leave room for
+# the duplicates among them. If that isn't enough we come back for more.
+PREDICTION_OVERFETCH = 4
+
+# How many goal and premise encodings a predictor remembers between
+# predictions, by default. Each is one hidden_size vector.
+DEFAULT_ENCODING_CACHE_SIZE = 10000
+
+
+class EncodingCache:
+    """
+    A least-recently-used cache of encoder outputs. States near each other
+    in a search share most of their hypotheses and relevant lemmas, so
+    most of their premises only need to be encoded once.
+    """
+    max_size: int
+    _encodings: "OrderedDict[Any, torch.FloatTensor]"
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._encodings = OrderedDict()
+
+    def get(self, key: Any) -> Optional[torch.FloatTensor]:
+        encoding = self._encodings.get(key)
+        if encoding is not None:
+            self._encodings.move_to_end(key)
+        return encoding
+
+    def put(self, key: Any, encoding: torch.FloatTensor) -> None:
+        if self.max_size <= 0:
+            return
+        self._encodings[key] = encoding
+        self._encodings.move_to_end(key)
+        if len(self._encodings) > self.max_size:
+            self._encodings.popitem(last=False)
+
+    def clear(self) -> None:
+        self._encodings.clear()
+
 
 class GoalTokenEncoderModel(nn.Module):
     def __init__(self, stem_vocab_size: int,
@@ -127,20 +167,17 @@ class GoalTokenEncoderModel(nn.Module):
         assert stem_batch.size()[0] == batch_size
         initial_hidden = self._stem_embedding(stem_var)\
                              .view(1, batch_size, self.hidden_size)
-        hidden = initial_hidden
-        encoded_tokens: List[torch.FloatTensor] = []
-        for i in range(goal_batch.size()[1]):
-            token_batch = self._token_embedding(goal_var[:, i])\
-                              .view(1, batch_size, self.hidden_size)
-            token_batch2 = F.relu(token_batch)
-            token_out, hidden = self._gru(token_batch2, hidden)
-            encoded_tokens.append(token_out.squeeze(dim=0).unsqueeze(1))
-        end_token_embedded = self._token_embedding(LongTensor([EOS_token])
-                                                   .expand(batch_size))\
-            .view(1, batch_size, self.hidden_size)
-        final_out, _final_hidden = self._gru(F.relu(end_token_embedded), hidden)
-        encoded_tokens.insert(0, final_out.squeeze(dim=0).unsqueeze(1))
-        catted = torch.cat(encoded_tokens, dim=1)
+        # Run the goal tokens and then the end token through the GRU in one
+        # call, over the whole padded sequence like the model was trained.
+        tokens_with_end = torch.cat(
+            (goal_var, LongTensor([EOS_token]).expand(batch_size, 1)), dim=1)
+        tokens_embedded = F.relu(self._token_embedding(tokens_with_end))\
+            .transpose(0, 1)
+        token_outs, _final_hidden = self._gru(tokens_embedded.contiguous(),
+                                              initial_hidden)
+        # The output for the end token goes first, then one per goal token.
+        catted = torch.cat((token_outs[-1:], token_outs[:-1]), dim=0)\
+            .transpose(0, 1)
         return catted
 
 
@@ -196,14 +233,12 @@ class HypArgEncoder(nn.Module):
         initial_hidden = self._in_hidden(torch.cat(
             (stem_encoded, goals_encoded_batch), dim=1))\
             .view(1, batch_size, self.hidden_size)
-        hidden = initial_hidden
-        for i in range(hyps_batch.size()[1]):
-            token_batch = self._token_embedding(hyps_var[:, i])\
-                .view(1, batch_size, self.hidden_size)
-            token_batch = F.relu(token_batch)
-            token_out, hidden = self._hyp_gru(token_batch, hidden)
+        tokens_embedded = F.relu(self._token_embedding(hyps_var))\
+            .transpose(0, 1)
+        token_outs, _final_hidden = self._hyp_gru(tokens_embedded.contiguous(),
+                                                  initial_hidden)
 
-        return token_out.squeeze()
+        return token_outs[-1].squeeze()
 
 class HypArgModel(nn.Module):
     def __init__(self, goal_data_size: int,
@@ -227,8 +262,13 @@ class HypArgModel(nn.Module):
         batch_size = stems_batch.size()[0]
         encoded = self.arg_encoder(stems_batch, goals_encoded_batch,
                                    hyps_batch)
+        return self.decode(encoded, hypfeatures_batch)
+
+    def decode(self, encoded_hyps_batch: torch.FloatTensor,
+               hypfeatures_batch: torch.FloatTensor) -> torch.FloatTensor:
         hyp_likelyhoods = self._likelyhood_decoder(
-            torch.cat((encoded, Variable(hypfeatures_batch)), dim=1))
+            torch.cat((encoded_hyps_batch, Variable(hypfeatures_batch)),
+                      dim=1))
         return hyp_likelyhoods
 
 
@@ -290,6 +330,14 @@ class FeaturesPolyargPredictor(
         # self._tokenizer : Optional[Tokenizer] = None
         # self._embedding : Optional[Embedding] = None
         self._model: Optional[FeaturesPolyArgModel] = None
+        # Goal encodings keyed on the tokenized goal, and premise encodings
+        # keyed on (stem, tokenized goal, tokenized premise).
+        self._goal_encodings = EncodingCache(DEFAULT_ENCODING_CACHE_SIZE)
+        self._premise_encodings = EncodingCache(DEFAULT_ENCODING_CACHE_SIZE)
+
+    def set_encoding_cache_size(self, size: int) -> None:
+        self._goal_encodings = EncodingCache(size)
+        self._premise_encodings = EncodingCache(size)
 
     @property
     def goal_token_encoder(self) -> GoalTokenEncoderModel:
@@ -318,19 +366,40 @@ class FeaturesPolyargPredictor(
 
     def predictKTactics_batch(self, contexts: List[TacticContext], k: int,
                               verbosity:int = 0) -> List[List[Prediction]]:
-        with torch.no_grad():
-            all_predictions_batch = self.getAllPredictionIdxs_batch(contexts,
-                                                                    verbosity=verbosity)
-
-        def generate():
-            for context, prediction_idxs in zip(
-                    contexts, all_predictions_batch):
-                predictions = self.decodeNonDuplicatePredictions(
-                    context, prediction_idxs, k)
-
-                yield predictions
+        assert self.training_args
+        num_stem_poss = get_num_tokens(self.metadata)
+        stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
-        predictions = list(generate())
+        num_predictions = k * PREDICTION_OVERFETCH
+        predictions_batch: List[Optional[List[Prediction]]] = \
+            [None] * len(contexts)
+        todo_idxs = list(range(len(contexts)))
+        while todo_idxs:
+            todo_contexts = [contexts[idx] for idx in todo_idxs]
+            with util.inference_context():
+                all_predictions_batch = self.getAllPredictionIdxs_batch(
+                    todo_contexts, verbosity=verbosity,
+                    num_predictions=num_predictions)
+            decoded_batch = decode_fpa_predictions_batch(
+                extract_dataloader_args(self.training_args),
+                self.metadata,
+                [(self._decoding_hyps(context), context.goal, prediction_idxs)
+                 for context, prediction_idxs
+                 in zip(todo_contexts, all_predictions_batch)],
+                stem_width, k)
+            next_todo_idxs = []
+            for idx, prediction_idxs, decoded in zip(
+                    todo_idxs, all_predictions_batch, decoded_batch):
+                if len(decoded) < k and \
+                   len(prediction_idxs) >= num_predictions:
+                    # Too many duplicates, and there are more to look at.
+                    next_todo_idxs.append(idx)
+                else:
+                    predictions_batch[idx] = [Prediction(s, math.exp(prob))
+                                              for s, prob in decoded]
+            todo_idxs = next_todo_idxs
+            num_predictions *= 2
+        predictions = cast(List[List[Prediction]], predictions_batch)
 
         # for context, pred_list in zip(contexts, predictions):
         #     for batch_pred, single_pred in zip(
@@ -339,7 +408,8 @@ class FeaturesPolyargPredictor(
         #             (batch_pred, single_pred)
         return predictions
 
-    def getAllPredictionIdxs(self, context: TacticContext
+    def getAllPredictionIdxs(self, context: TacticContext,
+                             num_predictions: Optional[int] = None
                              ) -> List[Tuple[float, int, int]]:
         assert self.training_args
         assert self._model
@@ -374,14 +444,17 @@ class FeaturesPolyargPredictor(
             total_scores = goal_arg_values
 
         final_probs, predicted_stem_idxs, predicted_arg_idxs = \
-            self.predict_args(total_scores, stem_certainties, stem_idxs)
+            self.predict_args(total_scores, stem_certainties, stem_idxs,
+                              num_predictions)
 
-        result = list(zip(list(final_probs), list(predicted_stem_idxs),
-                          list(predicted_arg_idxs)))
+        result = list(zip(final_probs.tolist(), predicted_stem_idxs.tolist(),
+                          predicted_arg_idxs.tolist()))
         return result
 
     def getAllPredictionIdxs_batch(self, contexts: List[TacticContext],
-                                   verbosity:int = 0) -> List[List[Tuple[float, int, int]]]:
+                                   verbosity:int = 0,
+                                   num_predictions: Optional[int] = None
+                                   ) -> List[List[Tuple[float, int, int]]]:
         assert self.training_args
         assert self._model
 
@@ -403,33 +476,28 @@ class FeaturesPolyargPredictor(
         goal_arg_values_batch = self.goal_token_scores(
             stem_idxs_batch, tokenized_goal_batch, goal_mask)
 
-        idxs_batch = []
+        # Contexts with fewer premises are padded with impossible ones, so
+        # the whole batch is scored and sorted together.
+        premise_arg_values_batch = self.hyp_name_scores_batch(
+            stem_idxs_batch, tokenized_goal_batch,
+            tokenized_premises_batch, premise_features_batch)
+        total_scores_batch = torch.cat((goal_arg_values_batch,
+                                        premise_arg_values_batch),
+                                       dim=2)
 
-        for (stem_certainties, stem_idxs,
-             goal_arg_values, tokenized_goal,
-             tokenized_premises,
-             premise_features) in \
-            tqdm(zip(stem_certainties_batch, stem_idxs_batch,
-                     goal_arg_values_batch, tokenized_goal_batch,
-                     tokenized_premises_batch, premise_features_batch),
-                 desc="Assessing hyp args and decoding indices",
-                 total=len(contexts),
-                 disable=verbosity <= 1):
-            if len(tokenized_premises) > 0:
-                premise_arg_values = self.hyp_name_scores(
-                    stem_idxs,
-                    tokenized_goal,
-                    tokenized_premises,
-                    premise_features)
-                total_scores = torch.cat((goal_arg_values.unsqueeze(0),
-                                          premise_arg_values),
-                                         dim=2)
-            else:
-                total_scores = goal_arg_values.unsqueeze(0)
+        probs_batch, stems_batch, args_batch = self.predict_args_batch(
+            total_scores_batch, stem_certainties_batch, stem_idxs_batch,
+            num_predictions)
 
-            probs, stems, args = self.predict_args(
-                total_scores, stem_certainties, stem_idxs)
-            idxs_batch.append(list(zip(list(probs), list(stems), list(args))))
+        num_goal_probs = self.training_args.max_length + 1
+        idxs_batch = []
+        for probs, stems, args, tokenized_premises in \
+                zip(probs_batch.tolist(), stems_batch.tolist(),
+                    args_batch.tolist(), tokenized_premises_batch):
+            # Drop the padding, which sorts last.
+            num_valid = stem_width * (num_goal_probs + len(tokenized_premises))
+            idxs_batch.append(list(zip(probs[:num_valid], stems[:num_valid],
+                                       args[:num_valid])))
 
         return idxs_batch
 
@@ -441,53 +509,46 @@ class FeaturesPolyargPredictor(
         num_stem_poss = get_num_tokens(self.metadata)
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
+        decoded = decode_fpa_predictions(
+            extract_dataloader_args(self.training_args),
+            self.metadata,
+            self._decoding_hyps(context), context.goal,
+            all_idxs, stem_width, k)
+
+        return [Prediction(s, math.exp(prob)) for s, prob in decoded]
+
+    def _decoding_hyps(self, context: TacticContext) -> List[str]:
+        assert self.training_args
         if self.training_args.lemma_args:
-            all_hyps = context.hypotheses + context.relevant_lemmas
+            return context.hypotheses + context.relevant_lemmas
         else:
-            all_hyps = context.hypotheses
-
-        prediction_strs: List[str] = []
-        prediction_probs: List[float] = []
-        next_i = 0
-        num_valid_probs = (1 + len(all_hyps) +
-                           len(get_fpa_words(context.goal))) * stem_width
-        while len(prediction_strs) < k and next_i < num_valid_probs:
-            next_pred_str = decode_fpa_result(
-                extract_dataloader_args(self.training_args),
-                self.metadata,
-                all_hyps, context.goal,
-                all_idxs[next_i][1],
-                all_idxs[next_i][2])
-            # next_pred_str = ""
-            if next_pred_str not in prediction_strs:
-                prediction_strs.append(next_pred_str)
-                prediction_probs.append(math.exp(all_idxs[next_i][0]))
-            next_i += 1
-
-        predictions = [Prediction(s, prob) for s, prob in
-                       zip(prediction_strs, prediction_probs)]
-
-        return predictions
+            return context.hypotheses
 
     def predictKTactics(self, context: TacticContext, k: int
                         ) -> List[Prediction]:
         assert self.training_args
         assert self._model
 
-        with torch.no_grad():
-            all_predictions = self.getAllPredictionIdxs(context)
-
-        predictions = self.decodeNonDuplicatePredictions(
-            context, all_predictions, k)
+        num_predictions = k * PREDICTION_OVERFETCH
+        while True:
+            with util.inference_context():
+                all_predictions = self.getAllPredictionIdxs(context,
+                                                            num_predictions)
 
-        return predictions
+            predictions = self.decodeNonDuplicatePredictions(
+                context, all_predictions, k)
+            if len(predictions) >= k or \
+               len(all_predictions) < num_predictions:
+                return predictions
+            # Too many duplicates, and there are more to look at.
+            num_predictions *= 2
 
     def predictionCertainty(self, context: TacticContext, prediction: str) -> float:
 
         assert self.training_args
         assert self._model
 
-        self.metadata, num_stem_poss = get_num_indices(self.metadata)
+        num_stem_poss = get_num_indices(self.metadata)
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
         tokenized_premises, hyp_features, \
@@ -611,47 +672,188 @@ class FeaturesPolyargPredictor(
                         tokenized_premises: List[List[int]],
                         premise_features: List[List[float]]
                         ) -> torch.FloatTensor:
-        assert self._model
         assert len(stem_idxs.size()) == 1
         stem_width = stem_idxs.size()[0]
         num_hyps = len(tokenized_premises)
-        encoded_goals = self._model.goal_encoder(LongTensor([tokenized_goal]))
-        hyp_arg_values = self.runHypModel(stem_idxs.unsqueeze(0),
-                                          encoded_goals,
-                                          LongTensor([tokenized_premises]),
-                                          FloatTensor([premise_features]))
+        hyp_arg_values = self.hyp_name_scores_batch(stem_idxs.unsqueeze(0),
+                                                    [tokenized_goal],
+                                                    [tokenized_premises],
+                                                    [premise_features])
         assert hyp_arg_values.size() == torch.Size([1, stem_width, num_hyps])
         return hyp_arg_values
 
+    def hyp_name_scores_batch(self,
+                              stem_idxs_batch: torch.LongTensor,
+                              tokenized_goals: List[List[int]],
+                              tokenized_premises_batch: List[List[List[int]]],
+                              premise_features_batch: List[List[List[float]]]
+                              ) -> torch.FloatTensor:
+        """
+        Score every premise of every context for each of its stems, giving
+        a (batch_size, stem_width, max_num_premises) tensor. Contexts with
+        fewer premises are padded with -inf scores.
+        """
+        assert self._model
+        assert self.training_args
+        batch_size, stem_width = stem_idxs_batch.size()
+        nhyps_batch = [len(premises) for premises in tokenized_premises_batch]
+        max_hyps = max(nhyps_batch, default=0)
+        if max_hyps == 0:
+            return maybe_cuda(torch.zeros(batch_size, stem_width, 0))
+        hidden_size = self.training_args.hidden_size
+        features_size = hypFeaturesSize()
+        encoded_premises_batch = self.encode_premises_batch(
+            stem_idxs_batch.tolist(), tokenized_goals, tokenized_premises_batch)
+        padded_encoded = pad_sequence(
+            [encoded.view(stem_width, num_hyps, hidden_size).transpose(0, 1)
+             for encoded, num_hyps in zip(encoded_premises_batch,
+                                          nhyps_batch)],
+            batch_first=True)\
+            .transpose(1, 2).contiguous()\
+            .view(batch_size * stem_width * max_hyps, hidden_size)
+        padded_features = pad_sequence(
+            [FloatTensor(features).view(num_hyps, features_size)
+             for features, num_hyps in zip(premise_features_batch,
+                                           nhyps_batch)],
+            batch_first=True)\
+            .view(batch_size, 1, max_hyps, features_size)\
+            .expand(-1, stem_width, -1, -1).contiguous()\
+            .view(batch_size * stem_width * max_hyps, features_size)
+        unmasked_scores = self._model.hyp_model.decode(
+            padded_encoded, padded_features)\
+            .view(batch_size, stem_width, max_hyps)
+        hyps_mask = maybe_cuda(torch.arange(max_hyps)).view(1, max_hyps) < \
+            LongTensor(nhyps_batch).view(batch_size, 1)
+        return torch.where(
+            hyps_mask.view(batch_size, 1, max_hyps)
+            .expand(-1, stem_width, -1),
+            unmasked_scores,
+            torch.full_like(unmasked_scores, -float("Inf")))
+
+    def encode_goals(self, tokenized_goals: List[List[int]]
+                     ) -> torch.FloatTensor:
+        assert self._model
+        keys = [tuple(tokenized_goal) for tokenized_goal in tokenized_goals]
+        encodings = [self._goal_encodings.get(key) for key in keys]
+        missing_idxs = [idx for idx, encoding in enumerate(encodings)
+                        if encoding is None]
+        if missing_idxs:
+            new_encodings = self._model.goal_encoder(
+                LongTensor([tokenized_goals[idx] for idx in missing_idxs]))\
+                .detach()
+            for idx, encoding in zip(missing_idxs, new_encodings):
+                encodings[idx] = encoding
+                # Each row is a view of the whole batch, so only a copy of
+                # it can be kept without keeping the rest of the batch too.
+                self._goal_encodings.put(keys[idx], encoding.clone())
+        return torch.stack(encodings)  # type: ignore
+
+    def encode_premises_batch(self, stem_idxs_batch: List[List[int]],
+                              tokenized_goals: List[List[int]],
+                              tokenized_premises_batch: List[List[List[int]]]
+                              ) -> List[torch.FloatTensor]:
+        """
+        Encode every premise of each context for each of its stems, as a
+        (stem_width * num_premises, hidden_size) tensor per context. Only
+        the pairs we haven't seen recently go through the encoder, all in
+        one batch.
+        """
+        assert self.training_args
+        hidden_size = self.training_args.hidden_size
+        keys_batch = []
+        encodings_batch = []
+        missing: List[Tuple[int, int]] = []
+        for ctx_idx, (stem_idxs, tokenized_goal, tokenized_premises) in \
+                enumerate(zip(stem_idxs_batch, tokenized_goals,
+                              tokenized_premises_batch)):
+            goal_key = tuple(tokenized_goal)
+            premise_keys = [tuple(premise) for premise in tokenized_premises]
+            keys = [(stem_idx, goal_key, premise_key)
+                    for stem_idx in stem_idxs
+                    for premise_key in premise_keys]
+            encodings = [self._premise_encodings.get(key) for key in keys]
+            missing += [(ctx_idx, idx) for idx, encoding
+                        in enumerate(encodings) if encoding is None]
+            keys_batch.append(keys)
+            encodings_batch.append(encodings)
+        if missing:
+            missing_ctxs = sorted({ctx_idx for ctx_idx, _ in missing})
+            encoded_goals = self.encode_goals([tokenized_goals[ctx_idx]
+                                               for ctx_idx in missing_ctxs])
+            goal_rows = {ctx_idx: row for row, ctx_idx
+                         in enumerate(missing_ctxs)}
+            new_encodings = self.hyp_encoder(
+                LongTensor([keys_batch[ctx_idx][idx][0]
+                            for ctx_idx, idx in missing]),
+                encoded_goals.index_select(
+                    0, LongTensor([goal_rows[ctx_idx]
+                                   for ctx_idx, _ in missing])),
+                LongTensor([keys_batch[ctx_idx][idx][2]
+                            for ctx_idx, idx in missing]))\
+                .detach().view(len(missing), hidden_size)
+            for (ctx_idx, idx), encoding in zip(missing, new_encodings):
+                encodings_batch[ctx_idx][idx] = encoding
+                self._premise_encodings.put(keys_batch[ctx_idx][idx],
+                                            encoding.clone())
+        return [torch.stack(encodings) if encodings  # type: ignore
+                else maybe_cuda(torch.zeros(0, hidden_size))
+                for encodings in encodings_batch]
+
     def predict_args(self,
                      total_scores: torch.FloatTensor,
                      stem_certainties: torch.FloatTensor,
-                     stem_idxs: torch.LongTensor
+                     stem_idxs: torch.LongTensor,
+                     num_predictions: Optional[int] = None
                      ) -> Tuple[torch.FloatTensor, torch.LongTensor,
                                 torch.LongTensor]:
+        assert total_scores.size()[0] == 1
+        prediction_probs, predicted_stem_idxs, predicted_arg_idxs = \
+            self.predict_args_batch(total_scores, stem_certainties, stem_idxs,
+                                    num_predictions)
+        return prediction_probs[0], predicted_stem_idxs[0], \
+            predicted_arg_idxs[0]
+
+    def predict_args_batch(self,
+                           total_scores: torch.FloatTensor,
+                           stem_certainties: torch.FloatTensor,
+                           stem_idxs: torch.LongTensor,
+                           num_predictions: Optional[int] = None
+                           ) -> Tuple[torch.FloatTensor, torch.LongTensor,
+                                      torch.LongTensor]:
+        """
+        Rank the (stem, argument) pairs of each context by log probability.
+        If num_predictions is given, only the best num_predictions of them
+        are returned.
+        """
         batch_size = total_scores.size()[0]
-        assert batch_size == 1
         stem_width = total_scores.size()[1]
         num_probs_per_stem = total_scores.size()[2]
-        all_prob_batches = self._softmax(
-            (total_scores +
-             stem_certainties.view(batch_size, stem_width, 1)
-             .expand(-1, -1, num_probs_per_stem))
-            .contiguous()
-            .view(batch_size, stem_width * num_probs_per_stem))
-        prediction_probs, arg_idxs = all_prob_batches.sort(descending=True)
+        num_probs = stem_width * num_probs_per_stem
+        all_scores = (total_scores +
+                      stem_certainties.view(batch_size, stem_width, 1)
+                      .expand(-1, -1, num_probs_per_stem))\
+            .contiguous()\
+            .view(batch_size, num_probs)
+        if num_predictions is None or num_predictions >= num_probs:
+            prediction_probs, arg_idxs = \
+                self._softmax(all_scores).sort(descending=True)
+            num_predictions = num_probs
+        else:
+            # Only normalize the scores we're keeping, instead of
+            # softmaxing and sorting all of them.
+            top_scores, arg_idxs = all_scores.topk(num_predictions)
+            prediction_probs = top_scores - \
+                all_scores.logsumexp(dim=1, keepdim=True)
         assert prediction_probs.size() == torch.Size(
-            [batch_size, stem_width * num_probs_per_stem])
+            [batch_size, num_predictions])
         assert arg_idxs.size() == torch.Size(
-            [batch_size, stem_width * num_probs_per_stem])
+            [batch_size, num_predictions])
         predicted_stem_keys = torch.div(arg_idxs, num_probs_per_stem,
                                         rounding_mode="floor")
-        predicted_stem_idxs = stem_idxs.view(stem_width)\
-                                       .index_select(
-                                           0, predicted_stem_keys.squeeze(
-                                               dim=0))
+        predicted_stem_idxs = stem_idxs.view(batch_size, stem_width)\
+                                       .gather(1, predicted_stem_keys)
         predicted_arg_idxs = arg_idxs % num_probs_per_stem
-        return prediction_probs[0], predicted_stem_idxs, predicted_arg_idxs[0]
+        return prediction_probs, predicted_stem_idxs, predicted_arg_idxs
 
     def predictKTacticsWithLoss(self, in_data: TacticContext, k: int, correct: str) -> \
             Tuple[List[Prediction], float]:
@@ -663,40 +865,6 @@ class FeaturesPolyargPredictor(
             Tuple[List[List[Prediction]], float]:
         return self.predictKTactics_batch(in_datas, k), 0
 
-    def runHypModel(self, stem_idxs: torch.LongTensor, encoded_goals: torch.FloatTensor,
-                    hyps_batch: torch.LongTensor, hypfeatures_batch: torch.FloatTensor):
-        assert self._model
-        assert self.training_args
-        batch_size = encoded_goals.size()[0]
-        assert batch_size == 1
-        num_hyps = hyps_batch.size()[1]
-        beam_width = stem_idxs.size()[1]
-        if hypfeatures_batch.size()[1] == 0:
-            return maybe_cuda(torch.zeros(batch_size, beam_width, 0))
-        features_size = hypfeatures_batch.size()[2]
-        hyp_arg_values = \
-            self._model.hyp_model(stem_idxs.view(batch_size, beam_width, 1)
-                                  .expand(-1, -1, num_hyps).contiguous()
-                                  .view(batch_size * beam_width * num_hyps),
-                                  encoded_goals.view(batch_size, 1,
-                                                     self.training_args.hidden_size)
-                                  .expand(-1, beam_width * num_hyps, -1)
-                                  .contiguous()
-                                  .view(batch_size * beam_width * num_hyps,
-                                        self.training_args.hidden_size),
-                                  hyps_batch.view(batch_size, 1, num_hyps,
-                                                  self.training_args.max_length)
-                                  .expand(-1, beam_width, -1, -1).contiguous()
-                                  .view(batch_size * beam_width * num_hyps,
-                                        self.training_args.max_length),
-                                  hypfeatures_batch
-                                  .view(batch_size, 1, num_hyps, features_size)
-                                  .expand(-1, beam_width, -1, -1).contiguous()
-                                  .view(batch_size * beam_width * num_hyps,
-                                        features_size))\
-            .view(batch_size, beam_width, num_hyps)
-        return hyp_arg_values
-
     def getOptions(self) -> List[Tuple[str, str]]:
         assert self.training_args
         assert self.training_loss
@@ -817,11 +985,12 @@ class FeaturesPolyargPredictor(
                 model = self._model
                 epoch_start = self.num_epochs
             else:
+                metadata_handle = FPAMetadata(metadata)
                 model = self._get_model(arg_values,
                                         word_features_size,
                                         vec_features_size,
-                                        get_num_indices(metadata)[1],
-                                        get_num_tokens(metadata))
+                                        get_num_indices(metadata_handle),
+                                        get_num_tokens(metadata_handle))
                 epoch_start = 1
 
         assert model
@@ -837,11 +1006,15 @@ class FeaturesPolyargPredictor(
                          unparsed_args: List[str],
                          metadata: Any,
                          state: NeuralPredictorState) -> None:
+        # Weights files store the pickleable form of the metadata, but the
+        # dataloader works on a handle to it that we only build once.
+        if not isinstance(metadata, FPAMetadata):
+            metadata = FPAMetadata(metadata)
         model = maybe_cuda(self._get_model(args,
                                            get_word_feature_vocab_sizes(
                                                metadata),
                                            get_vec_features_size(metadata),
-                                           get_num_indices(metadata)[1],
+                                           get_num_indices(metadata),
                                            get_num_tokens(metadata)))
         model.load_state_dict(state.weights)
         self._model = model
@@ -850,6 +1023,8 @@ class FeaturesPolyargPredictor(
         self.training_args = args
         self.unparsed_args = unparsed_args
         self.metadata = metadata
+        self._goal_encodings.clear()
+        self._premise_encodings.clear()
 
     def _get_model(self, arg_values: Namespace,
                    wordf_sizes: List[int],
@@ -978,6 +1153,8 @@ class FeaturesPolyargPredictor(
         self._model.share_memory()
     def to_device(self, device) -> None:
         self._model.to(device=device)
+        self._goal_encodings.clear()
+        self._premise_encodings.clear()
 
 
 def hypFeaturesSize() -> int:
@@ -0,0 +1,206 @@
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+import io
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+
+import util
+from util import eprint
+from dataloader import (FPAMetadata, get_num_indices, get_num_tokens,
+                        get_word_feature_vocab_sizes, get_vec_features_size)
+from models.components import NeuralPredictorState
+from models.features_polyarg_predictor import (FeaturesPolyargPredictor,
+                                               FeaturesPolyArgModel,
+                                               HypArgModel, hypFeaturesSize)
+
+# Search only ever runs the forward passes of these parts of the polyarg
+# model, so they're traced and frozen one at a time.
+FROZEN_MODULES = ["stem_classifier", "goal_args_model", "goal_encoder",
+                  "hyp_arg_encoder", "hyp_likelyhood_decoder"]
+
+
+class FrozenHypArgModel(nn.Module):
+    def __init__(self, arg_encoder: nn.Module,
+                 likelyhood_decoder: nn.Module) -> None:
+        super().__init__()
+        self.arg_encoder = arg_encoder
+        self._likelyhood_decoder = likelyhood_decoder
+
+    decode = HypArgModel.decode
+
+
+def eager_modules(model: FeaturesPolyArgModel) -> Dict[str, nn.Module]:
+    return {"stem_classifier": model.stem_classifier,
+            "goal_args_model": model.goal_args_model,
+            "goal_encoder": model.goal_encoder,
+            "hyp_arg_encoder": model.hyp_model.arg_encoder,
+            "hyp_likelyhood_decoder": model.hyp_model._likelyhood_decoder}
+
+
+def example_inputs(predictor: FeaturesPolyargPredictor, batch_size: int) \
+        -> Dict[str, Tuple[torch.Tensor, ...]]:
+    assert predictor.training_args
+    args = predictor.training_args
+    metadata = predictor.metadata
+    num_stems = get_num_indices(metadata)
+    num_tokens = get_num_tokens(metadata)
+
+    def stems() -> torch.Tensor:
+        return torch.randint(num_stems, (batch_size,))
+
+    def terms() -> torch.Tensor:
+        return torch.randint(num_tokens, (batch_size, args.max_length))
+
+    word_features = torch.stack(
+        [torch.randint(vocab_size, (batch_size,))
+         for vocab_size in get_word_feature_vocab_sizes(metadata)], dim=1)
+    return {"stem_classifier":
+            (word_features,
+             torch.rand(batch_size, get_vec_features_size(metadata))),
+            "goal_args_model": (stems(), terms()),
+            "goal_encoder": (terms(),),
+            "hyp_arg_encoder":
+            (stems(), torch.rand(batch_size, args.hidden_size), terms()),
+            "hyp_likelyhood_decoder":
+            (torch.rand(batch_size, args.hidden_size + hypFeaturesSize()),)}
+
+
+def freeze_polyarg_model(predictor: FeaturesPolyargPredictor,
+                         quantize: bool, verbose: int = 0) -> Dict[str, bytes]:
+    """
+    Trace each part of the model search uses into a frozen TorchScript
+    module, optionally with int8 linear and GRU layers, and return them
+    serialized by name.
+    """
+    assert predictor._model
+    modules = eager_modules(predictor._model)
+    trace_inputs = example_inputs(predictor, 4)
+    # Tracing records the shapes of one batch, so check the result on a
+    # batch of another size.
+    check_inputs = example_inputs(predictor, 3)
+    frozen: Dict[str, bytes] = {}
+    with torch.no_grad():
+        for name in FROZEN_MODULES:
+            module = modules[name].eval()
+            if quantize:
+                module = torch.quantization.quantize_dynamic(
+                    module, {nn.Linear, nn.GRU}, dtype=torch.qint8)
+            traced = torch.jit.freeze(
+                torch.jit.trace(module, trace_inputs[name]))
+            expected = module(*check_inputs[name])
+            actual = traced(*check_inputs[name])
+            assert expected.size() == actual.size() and \
+                torch.allclose(expected, actual, atol=1e-5), \
+                f"Traced {name} doesn't match the original model"
+            buf = io.BytesIO()
+            torch.jit.save(traced, buf)
+            frozen[name] = buf.getvalue()
+            eprint(f"Froze {name} ({len(frozen[name])} bytes)",
+                   guard=verbose >= 1)
+    return frozen
+
+
+def load_frozen_model(frozen: Dict[str, bytes]) -> FeaturesPolyArgModel:
+    modules = {name: torch.jit.load(io.BytesIO(frozen[name]),
+                                    map_location="cpu")
+               for name in FROZEN_MODULES}
+    return FeaturesPolyArgModel(
+        modules["stem_classifier"],
+        modules["goal_args_model"],
+        modules["goal_encoder"],
+        FrozenHypArgModel(modules["hyp_arg_encoder"],
+                          modules["hyp_likelyhood_decoder"]))
+
+
+class FrozenPolyargPredictor(FeaturesPolyargPredictor):
+    """
+    Runs polyarg weights exported by the export-polyarg command. The
+    frozen modules only run on the CPU, and can't be trained further.
+    """
+    _frozen: Dict[str, bytes]
+
+    def load_saved_state(self,
+                         args: argparse.Namespace,
+                         unparsed_args: List[str],
+                         metadata: Any,
+                         state: NeuralPredictorState) -> None:
+        util.use_cuda = False
+        if not isinstance(metadata, FPAMetadata):
+            metadata = FPAMetadata(metadata)
+        self._frozen = state.weights
+        self._model = load_frozen_model(self._frozen)
+        self.training_loss = state.loss
+        self.num_epochs = state.epoch
+        self.training_args = args
+        self.unparsed_args = unparsed_args
+        self.metadata = metadata
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # TorchScript modules can't be pickled, so workers rebuild them
+        # from the serialized copies.
+        state = dict(self.__dict__)
+        state["_model"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        util.use_cuda = False
+        self._model = load_frozen_model(self._frozen)
+
+    def shortname(self) -> str:
+        return "polyarg-frozen"
+
+    def to_device(self, device) -> None:
+        assert device == "cpu", "Frozen polyarg weights only run on the CPU"
+
+    def train(self, args: List[str]) -> None:
+        assert False, "Can't train frozen polyarg weights, " \
+            "train polyarg and export it instead"
+
+
+def export(arg_list: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Freeze polyarg weights for fast inference on the CPU")
+    parser.add_argument("weightsfile", type=Path)
+    parser.add_argument("dest", type=Path)
+    parser.add_argument("--quantize", action="store_true",
+                        help="Run the linear and GRU layers with "
+                        "int8 weights")
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    args = parser.parse_args(arg_list)
+
+    util.use_cuda = False
+    predictor_type, saved_state = torch.load(str(args.weightsfile),
+                                             map_location="cpu")
+    assert predictor_type == "polyarg", \
+        f"Can only export polyarg weights, but got {predictor_type}"
+    training_args, unparsed_args, metadata, state = saved_state
+    predictor = FeaturesPolyargPredictor()
+    predictor.load_saved_state(*saved_state)
+    frozen = freeze_polyarg_model(predictor, args.quantize, args.verbose)
+    with args.dest.open('wb') as f:
+        torch.save(("polyarg-frozen",
+                    (training_args, unparsed_args, metadata,
+                     NeuralPredictorState(state.epoch, state.loss, frozen))),
+                   f)
@@ -29,6 +29,9 @@ class TacticPredictor(metaclass=ABCMeta):
     @abstractmethod
     def predictKTactics(self, in_data : TacticContext, k : int) \
         -> List[Prediction]: pass
+    def predictKTactics_batch(self, in_datas : List[TacticContext], k : int) \
+        -> List[List[Prediction]]:
+        return [self.predictKTactics(in_data, k) for in_data in in_datas]
     @abstractmethod
     def predictKTacticsWithLoss(self, in_data : TacticContext, k : int, correct : str) -> \
         Tuple[List[Prediction], float]: pass
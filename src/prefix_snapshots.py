@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import hashlib
+import json
+import os
+import re
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import coq_serapy
+
+from util import eprint
+
+# A prefix snapshot is the part of a file before some lemma, as a worker ran
+# it (with the proofs it skipped admitted), compiled into a .vo. A worker
+# that needs a lemma deep in a file can Require the snapshot instead of
+# running everything before the lemma again.
+#
+# Only points outside of any section or module of the file can be
+# snapshotted, since a .vo can't end in the middle of one. And what
+# Require Import doesn't bring back (local notations, scopes, options, hints
+# and the imports of the prefix) is brought back by running those commands
+# of the prefix again.
+
+SNAPSHOT_LIBRARY = "ProverbotSnapshots"
+# Don't bother snapshotting a point unless getting there meant skipping at
+# least this many lemmas.
+MIN_SNAPSHOT_SKIP = 10
+# Compiling a snapshot competes with the searches for CPU, so each worker
+# process only compiles this many at once, and gives up on any that take
+# longer than the timeout (in seconds).
+MAX_CONCURRENT_COMPILES = 1
+COMPILE_TIMEOUT = 3600
+
+# Only notations, scopes, options, hints and imports are run again.
+# Definitions are left to the snapshot, since running one again would make
+# a new constant, different from the one the snapshot's lemmas are about.
+ENV_COMMAND_PATTERN = re.compile(
+    r"\s*(#\[\s*\w+\s*\]\s*|(Local|Global)\s+)?"
+    r"(((Reserved|Tactic)\s+)?Notation|Infix|(Open|Close)\s+Scope|"
+    r"Set|Unset|Hint|(From\s+\S+\s+)?Require|Import|Export)\s")
+
+
+class PrefixSnapshot(NamedTuple):
+    module: str
+    # The number of the file's commands the snapshot covers
+    commands_consumed: int
+    lemmas: List[Tuple[str, str, str, str]]
+    local_lemmas: List[str]
+    env_commands: List[str]
+    last_program_statement: Optional[str]
+
+
+def coq_project_flags(project_dir: Path) -> List[str]:
+    try:
+        with (project_dir / "_CoqProject").open('r') as f:
+            tokens = shlex.split(f.read(), comments=True)
+    except FileNotFoundError:
+        return []
+    flags: List[str] = []
+    idx = 0
+    while idx < len(tokens):
+        if tokens[idx] in ["-R", "-Q"]:
+            flags += tokens[idx:idx+3]
+            idx += 3
+        elif tokens[idx] in ["-I", "-arg"]:
+            flags += tokens[idx:idx+2]
+            idx += 2
+        else:
+            # Source files and coq_makefile options
+            idx += 1
+    return flags
+
+
+def lock_is_stale(lock_path: Path) -> bool:
+    try:
+        with lock_path.open('r') as f:
+            owner = json.load(f)
+        if owner["host"] == socket.gethostname():
+            try:
+                os.kill(owner["pid"], 0)
+            except ProcessLookupError:
+                return True
+        started = owner["time"]
+    except FileNotFoundError:
+        return True
+    except (OSError, json.JSONDecodeError, KeyError):
+        # Probably still being written by its owner
+        try:
+            started = lock_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+    # Owners on other machines can't be checked on, but nobody compiles for
+    # longer than the timeout.
+    return time.time() - started > 2 * COMPILE_TIMEOUT
+
+
+class PrefixSnapshots:
+    snapshot_dir: Path
+    prelude: Path
+    verbose: int
+    _compile_slots = threading.BoundedSemaphore(MAX_CONCURRENT_COMPILES)
+
+    def __init__(self, snapshot_dir: Path, prelude: Path,
+                 verbose: int = 0) -> None:
+        self.snapshot_dir = snapshot_dir.resolve()
+        self.prelude = prelude
+        self.verbose = verbose
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+
+    def sertop_flags(self) -> List[str]:
+        return ["-Q", f"{self.snapshot_dir},{SNAPSHOT_LIBRARY}"]
+
+    def _file_dirname(self, project: str, filename: str) -> str:
+        h = hashlib.sha256(f"{project}/{filename}".encode("utf-8"))
+        # Snapshots of an older version of the file won't be found.
+        with (self.prelude / project / filename).open('rb') as f:
+            h.update(f.read())
+        return "F" + h.hexdigest()[:32]
+
+    def find(self, project: str, filename: str,
+             job: Tuple[str, str, str, str]) -> Optional[PrefixSnapshot]:
+        """
+        Find the snapshot that gets furthest into the file without passing
+        the given job.
+        """
+        file_dir = self.snapshot_dir / self._file_dirname(project, filename)
+        best: Optional[PrefixSnapshot] = None
+        for meta_path in file_dir.glob("S*.json"):
+            try:
+                with meta_path.open('r') as f:
+                    snapshot = PrefixSnapshot(**json.load(f))
+            except (OSError, json.JSONDecodeError, TypeError):
+                continue
+            snapshot = snapshot._replace(
+                lemmas=[tuple(lemma) for lemma in snapshot.lemmas])
+            if tuple(job) in snapshot.lemmas:
+                continue
+            if best is None or \
+               snapshot.commands_consumed > best.commands_consumed:
+                best = snapshot
+        return best
+
+    def discard(self, snapshot: PrefixSnapshot) -> None:
+        *_, file_dirname, module_name = snapshot.module.split(".")
+        try:
+            os.remove(self.snapshot_dir / file_dirname
+                      / f"{module_name}.json")
+        except FileNotFoundError:
+            pass
+
+    def save(self, project: str, filename: str, switch: Optional[str],
+             commands_consumed: int, executed_commands: List[str],
+             lemmas: List[Tuple[str, str, str, str]], local_lemmas: List[str],
+             last_program_statement: Optional[str]) -> None:
+        """
+        Compile a snapshot of the given prefix in the background. Nothing
+        happens if this prefix is already snapshotted, being compiled, or
+        failed to compile before, or if this process is already compiling as
+        many snapshots as it may.
+        """
+        file_dirname = self._file_dirname(project, filename)
+        file_dir = self.snapshot_dir / file_dirname
+        file_dir.mkdir(parents=True, exist_ok=True)
+        module_name = "S" + hashlib.sha256(
+            json.dumps(executed_commands).encode("utf-8")).hexdigest()[:32]
+        path = file_dir / module_name
+        if path.with_suffix(".json").exists() or \
+           path.with_suffix(".failed").exists():
+            return
+        if not self._compile_slots.acquire(blocking=False):
+            return
+        if not self._claim(path.with_suffix(".lock")):
+            self._compile_slots.release()
+            return
+        snapshot = PrefixSnapshot(
+            f"{SNAPSHOT_LIBRARY}.{file_dirname}.{module_name}",
+            commands_consumed, lemmas, local_lemmas,
+            [command for command in executed_commands
+             if ENV_COMMAND_PATTERN.match(coq_serapy.kill_comments(command))
+             and not coq_serapy.possibly_starting_proof(command)],
+            last_program_statement)
+        threading.Thread(target=self._compile,
+                         args=(project, switch, path, executed_commands,
+                               snapshot),
+                         daemon=True).start()
+
+    def _claim(self, lock_path: Path) -> bool:
+        # Only one worker compiles each snapshot. Locks left by workers that
+        # died while compiling are taken over.
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not lock_is_stale(lock_path):
+                    return False
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(),
+                           "time": time.time()}, f)
+            return True
+        return False
+
+    def _compile(self, project: str, switch: Optional[str], path: Path,
+                 executed_commands: List[str],
+                 snapshot: PrefixSnapshot) -> None:
+        try:
+            self._compile_locked(project, switch, path, executed_commands,
+                                 snapshot)
+        finally:
+            try:
+                os.remove(path.with_suffix(".lock"))
+            except FileNotFoundError:
+                pass
+            self._compile_slots.release()
+
+    def _compile_locked(self, project: str, switch: Optional[str], path: Path,
+                        executed_commands: List[str],
+                        snapshot: PrefixSnapshot) -> None:
+        with path.with_suffix(".v").open('w') as f:
+            for command in executed_commands:
+                print(command, file=f)
+        coqc = ["coqc"] + coq_project_flags(self.prelude / project) + \
+            ["-Q", str(self.snapshot_dir), SNAPSHOT_LIBRARY,
+             str(path.with_suffix(".v"))]
+        if switch:
+            coqc = ["opam", "exec", "--switch", switch, "--"] + coqc
+        try:
+            result = subprocess.run(coqc, cwd=self.prelude / project,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, text=True,
+                                    timeout=COMPILE_TIMEOUT)
+            failure = result.stdout if result.returncode != 0 else None
+        except subprocess.TimeoutExpired:
+            failure = f"Timed out after {COMPILE_TIMEOUT} seconds"
+        if failure is not None:
+            eprint(f"Couldn't compile snapshot {snapshot.module}:\n"
+                   f"{failure}", guard=self.verbose >= 1)
+            # Remember the failure, so nobody tries this prefix again.
+            with path.with_suffix(".failed").open('w') as f:
+                print(failure, file=f)
+            return
+        # The metadata is written last, and atomically, so that a snapshot
+        # is only found once it's ready.
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot._asdict(), f)
+        os.replace(tmp_name, path.with_suffix(".json"))
+        eprint(f"Compiled snapshot {snapshot.module}",
+               guard=self.verbose >= 2)
@@ -25,6 +25,8 @@ import sys
 from collections import Counter
 from tokenizer import tokenizers
 import search_file
+import search_graphs
+import model_server
 import dynamic_report
 import static_report
 import evaluator_report
@@ -38,6 +40,7 @@ from util import eprint, print_time
 from coq_serapy.contexts import strip_scraped_output
 from models.components import SimpleEmbedding
 import predict_tactic
+from models import frozen_polyarg
 import evaluate_state
 import interactive_predictor
 from pathlib import Path
@@ -255,6 +258,7 @@ def get_tokens(args: List[str]):
 modules = {
     "train": train,
     "search-report": search_file.main,
+    "render-search-graphs": search_graphs.main,
     "dynamic-report": dynamic_report.main,
     "static-report": static_report.main,
     "evaluator-report": evaluator_report.main,
@@ -262,6 +266,8 @@ modules = {
     "tokens": get_tokens,
     "tactics": get_tactics,
     "predict": interactive_predictor.predict,
+    "export-polyarg": frozen_polyarg.export,
+    "model-server": model_server.main,
 }
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+
+class LemmaClock:
+    """
+    Splits the time spent searching a lemma into time waiting on Coq, time
+    running the model, and everything else.
+    """
+    start_time: float
+    times: Dict[str, float]
+    _active: Optional[str]
+
+    def __init__(self) -> None:
+        self.start_time = time.time()
+        self.times = {"coq": 0., "model": 0.}
+        self._active = None
+
+    @contextlib.contextmanager
+    def track(self, category: str) -> Iterator[None]:
+        # Nested tracking (like a trial inside a batch of trials) is
+        # counted once, by the outermost category.
+        if self._active is not None:
+            yield
+            return
+        self._active = category
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[category] += time.time() - start
+            self._active = None
+
+    def breakdown(self) -> Dict[str, float]:
+        total = time.time() - self.start_time
+        return {"coq": self.times["coq"],
+                "model": self.times["model"],
+                "other": max(total - self.times["coq"] - self.times["model"],
+                             0.),
+                "total": total}
+
+
+_local = threading.local()
+
+
+def lemma_clock() -> LemmaClock:
+    if not hasattr(_local, "clock"):
+        _local.clock = LemmaClock()
+    return _local.clock
+
+
+def start_lemma_clock() -> LemmaClock:
+    _local.clock = LemmaClock()
+    return _local.clock
+
+
+class SearchBudget:
+    """
+    Decides how long each lemma may be searched for. With a run time budget,
+    each lemma gets an even share of the time left for the lemmas left, so
+    time that easy lemmas don't use is handed on to later ones.
+    """
+    args: argparse.Namespace
+    num_workers: int
+    jobs_remaining: Optional[Callable[[], int]]
+
+    def __init__(self, args: argparse.Namespace, num_workers: int = 1,
+                 jobs_remaining: Optional[Callable[[], int]] = None) -> None:
+        self.args = args
+        self.num_workers = num_workers
+        self.jobs_remaining = jobs_remaining
+        # Workers that weren't handed a deadline by whatever started them
+        # count the run from when they start.
+        set_run_deadline(args)
+
+    def lemma_time_limit(self) -> Optional[float]:
+        limit = self.args.max_search_time_per_lemma
+        if self.args.run_time_budget is None:
+            return limit
+        time_left = max(self.args.run_deadline - time.time(), 0.)
+        if self.jobs_remaining:
+            # The lemmas still queued, plus the ones every worker is
+            # searching right now.
+            lemmas_left = max(self.jobs_remaining(), 0) + self.num_workers
+            share = min(time_left * self.num_workers / lemmas_left,
+                        time_left)
+        else:
+            share = time_left
+        if limit is None:
+            return share
+        return min(limit, share)
+
+
+def set_run_deadline(args: argparse.Namespace) -> None:
+    if args.run_time_budget is not None and \
+       getattr(args, "run_deadline", None) is None:
+        args.run_deadline = time.time() + args.run_time_budget
@@ -36,11 +36,15 @@ import subprocess
 import cProfile
 import copy
 import functools
+import shutil
+import tempfile
 from typing import (List, Tuple, NamedTuple, Optional, Dict,
                     Union, Callable, cast, IO, TypeVar,
                     Any, Iterator, Iterable)
 
 from models.tactic_predictor import TacticPredictor
+from models.features_polyarg_predictor import (FeaturesPolyargPredictor,
+                                               DEFAULT_ENCODING_CACHE_SIZE)
 from predict_tactic import (static_predictors, loadPredictorByFile,
                             loadPredictorByName)
 import coq_serapy as serapi_instance
@@ -49,6 +53,10 @@ from util import eprint
 import search_report
 from search_results import SearchResult
 from search_worker import ReportJob, Worker, get_files_jobs
+from search_budget import SearchBudget, set_run_deadline
+from batching_predictor import BatchingPredictor
+from model_server import RemotePredictor, serve_predictions
+from memoizing_predictor import MemoizingPredictor, weights_fingerprint
 import multi_project_report
 import util
 
@@ -106,11 +114,73 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--max-attempts", type=int, default=10)
     parser.add_argument("--search-depth", type=int, default=6)
     parser.add_argument("--astar-steps", type=int, default=1024)
+    parser.add_argument("--frontier-batch-size", type=int, default=1,
+                        help="Number of frontier nodes to predict on at once "
+                        "in best-first and A* search")
+    parser.add_argument("--no-transposition-table", action='store_true',
+                        help="Don't share predictions and outcomes between "
+                        "search branches that reach the same proof state")
+    parser.add_argument("--parallel-tactic-workers", type=int, default=0,
+                        help="Number of extra Coq instances each worker "
+                        "keeps at the current lemma, for checking candidate "
+                        "tactics concurrently in best-first and A* search")
+    parser.add_argument("--interleaved-lemmas", type=int, default=1,
+                        help="Number of lemmas each worker searches at once, "
+                        "each with its own Coq instance, pooling their "
+                        "predictor calls into shared batches")
+    parser.add_argument("--inference-threads", type=int, default=None,
+                        help="Number of threads each worker's predictor "
+                        "uses. Defaults to every core, which oversubscribes "
+                        "the machine with more than one worker")
+    parser.add_argument("--inference-dtype",
+                        choices=list(util.inference_dtypes.keys()),
+                        default="float32",
+                        help="Precision to run predictions in. Lower "
+                        "precisions are faster on hardware that supports "
+                        "them")
+    parser.add_argument("--prediction-cache-size", type=int, default=0,
+                        help="Number of contexts to remember predictions for "
+                        "in each predictor, across lemmas. 0 to disable.")
+    parser.add_argument("--prediction-cache-dir", type=Path, default=None,
+                        help="Directory to also remember every prediction "
+                        "in, shared between workers and runs")
+    parser.add_argument("--encoding-cache-size", type=int,
+                        default=DEFAULT_ENCODING_CACHE_SIZE,
+                        help="Number of goal and premise encodings each "
+                        "polyarg predictor remembers, for each of the two. "
+                        "0 to disable.")
+    parser.add_argument("--model-server", action='store_true',
+                        help="Run the predictor in a server process for "
+                        "each device, which batches together the predictions "
+                        "of all the workers on it, instead of giving each "
+                        "worker its own copy")
+    parser.add_argument("--model-server-address", default=None, type=str,
+                        help="Get predictions from an already running model "
+                        "server listening on this unix socket, instead of "
+                        "loading a predictor")
+    parser.add_argument("--model-server-max-wait", type=float, default=0.05,
+                        help="Longest a prediction request waits in the model "
+                        "server for others to batch with, in seconds")
+    parser.add_argument("--search-graphs", choices=["svg", "events", "none"],
+                        default="svg",
+                        help="How to record search graphs. 'svg' renders "
+                        "them at the end of each lemma, 'events' only writes "
+                        "the event log, for rendering later with "
+                        "render-search-graphs")
     parser.add_argument("--beam-width", type=int, default=16)
     parser.add_argument("--hard-depth-limit", dest="hard_depth_limit",
                         type=int, default=100)
     parser.add_argument("--max-subgoals", type=int, default=16)
     parser.add_argument("--no-resume", dest="resume", action='store_false')
+    parser.add_argument("--prefix-snapshot-dir", type=Path, default=None,
+                        help="Directory to keep compiled snapshots of file "
+                        "prefixes in, so that workers can start at lemmas "
+                        "deep in a file without running everything before "
+                        "them. Shared between workers and runs.")
+    parser.add_argument("--prior-results", type=Path, default=None,
+                        help="Output directory of an earlier run on the same "
+                        "files, whose proof times are used to decide which "
+                        "files to search first")
     parser.add_argument("--overwrite-mismatch", dest="overwrite_mismatch",
                         action='store_true')
     parser.add_argument("--max-print-term", dest="max_print_term", type=int,
@@ -143,7 +213,15 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
                         choices=['local', 'hammer', 'searchabout'],
                         default='local')
     parser.add_argument("--command-limit", type=int, default=None)
-    parser.add_argument("--search-type", choices=['dfs', 'beam-bfs', 'astar', 'best-first'], default='dfs')
+    parser.add_argument("--search-type", choices=['dfs', 'beam-bfs', 'astar', 'best-first', 'and-or'], default='dfs')
+    parser.add_argument("--subgoal-steps", type=int, default=64,
+                        help="Number of nodes and-or search expands for each "
+                        "subgoal before giving up on it")
+    parser.add_argument("--subgoal-total-steps", type=int, default=1024,
+                        help="Number of nodes and-or search expands for all "
+                        "the subgoals of a lemma together, since goals that "
+                        "keep splitting could otherwise take exponentially "
+                        "many")
     parser.add_argument("--scoring-function", choices=["lstd", "certainty", "pickled", "const", "norm-certainty"], default="certainty")
     parser.add_argument("--pickled-estimator", type=Path, default=None)
     proofsGroup = parser.add_mutually_exclusive_group()
@@ -156,6 +234,15 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--add-env-lemmas", type=Path, default=None)
     parser.add_argument("--add-axioms", type=Path, default=None)
     parser.add_argument("--max-search-time-per-lemma", default=None, type=float)
+    parser.add_argument("--run-time-budget", default=None, type=float,
+                        help="Seconds for the whole run. Each lemma gets an "
+                        "even share of the time left for the lemmas left, "
+                        "so time easy lemmas don't use goes to later ones")
+    parser.add_argument("--run-deadline", default=None, type=float,
+                        help="Unix time the run has to finish by, instead "
+                        "of --run-time-budget seconds after it starts. The "
+                        "cluster coordinator passes this to its workers, so "
+                        "they share one deadline however late they start")
     parser.add_argument("--tactics-file", type=Path, default=Path("tactics.txt"))
     parser.add_argument("--tokens-file", type=Path, default=Path("tokens.txt"))
     parser.add_argument("--beta-file", type=Path, default=Path("beta.txt"))
@@ -188,7 +275,9 @@ def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
 def get_predictor(parser: argparse.ArgumentParser,
                   args: argparse.Namespace) -> TacticPredictor:
     predictor: TacticPredictor
-    if args.weightsfile:
+    if args.model_server_address:
+        predictor = RemotePredictor(args.model_server_address)
+    elif args.weightsfile:
         predictor = loadPredictorByFile(args.weightsfile)
     elif args.predictor:
         predictor = loadPredictorByName(args.predictor)
@@ -196,6 +285,20 @@ def get_predictor(parser: argparse.ArgumentParser,
         print("You must specify either --weightsfile or --predictor!")
         parser.print_help()
         sys.exit(1)
+    if isinstance(predictor, FeaturesPolyargPredictor):
+        predictor.set_encoding_cache_size(args.encoding_cache_size)
+    if args.model_server_address:
+        # The server is the one to remember predictions, since it doesn't
+        # tell us which weights it's running.
+        return predictor
+    if args.prediction_cache_size > 0 or args.prediction_cache_dir:
+        if args.weightsfile:
+            fingerprint = weights_fingerprint(args.weightsfile)
+        else:
+            fingerprint = args.predictor
+        predictor = MemoizingPredictor(predictor, fingerprint,
+                                       args.prediction_cache_size,
+                                       args.prediction_cache_dir)
     return predictor
 
 
@@ -203,20 +306,23 @@ def search_file_worker_profiled(
         args: argparse.Namespace,
         predictor: TacticPredictor,
         predictor_lock: threading.Lock,
-        jobs: 'multiprocessing.Queue[Tuple[str, str, str]]',
+        jobs: 'multiprocessing.Queue[List[ReportJob]]',
+        jobs_left: 'multiprocessing.sharedctypes.Synchronized[int]',
         done:
         'multiprocessing.Queue['
         '  Tuple[Tuple[str, str, str], SearchResult]]',
         worker_idx: int,
         device: str) -> None:
     cProfile.runctx('search_file_worker(args, predictor, '
-                    'predictor_lock, jobs, done, worker_idx, device)',
+                    'predictor_lock, jobs, jobs_left, done, worker_idx, '
+                    'device)',
                     globals(), locals(), 'searchstats-{}'.format(worker_idx))
 
 def search_file_worker(args: argparse.Namespace,
                        predictor: TacticPredictor,
                        predictor_lock: threading.Lock,
-                       jobs: 'multiprocessing.Queue[ReportJob]',
+                       jobs: 'multiprocessing.Queue[List[ReportJob]]',
+                       jobs_left: 'multiprocessing.sharedctypes.Synchronized[int]',
                        done:
                        'multiprocessing.Queue['
                        '  Tuple[ReportJob, SearchResult]]',
@@ -227,6 +333,7 @@ def search_file_worker(args: argparse.Namespace,
     if util.use_cuda:
         torch.cuda.set_device(device) # type: ignore
     util.cuda_device = device
+    util.configure_inference(args.inference_threads, args.inference_dtype)
 
     if args.splits_file:
         with args.splits_file.open('r') as f:
@@ -239,14 +346,57 @@ def search_file_worker(args: argparse.Namespace,
     else:
         switch_dict = None
 
-    with Worker(args, worker_idx, predictor, switch_dict) as worker:
+    budget = SearchBudget(args, args.num_threads * args.interleaved_lemmas,
+                          lambda: jobs_left.value)
+    if args.interleaved_lemmas <= 1:
+        search_jobs(args, worker_idx, predictor, switch_dict, budget,
+                    jobs, jobs_left, done)
+        return
+
+    # Interleave several lemma searches in this process. Each gets its own
+    # thread and Coq instance, and their predictions are batched together,
+    # so the predictor has work while the searches wait on Coq.
+    batching_predictor = BatchingPredictor(predictor)
+    errors: List[BaseException] = []
+
+    def search_thread(thread_idx: int) -> None:
+        try:
+            with batching_predictor.client():
+                search_jobs(args, worker_idx + thread_idx * args.num_threads,
+                            batching_predictor, switch_dict, budget,
+                            jobs, jobs_left, done)
+        except BaseException as e:
+            traceback.print_exc()
+            errors.append(e)
+
+    threads = [threading.Thread(target=search_thread, args=(thread_idx,))
+               for thread_idx in range(args.interleaved_lemmas)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def search_jobs(args: argparse.Namespace, worker_idx: int,
+                predictor: TacticPredictor,
+                switch_dict: Optional[Dict[str, str]],
+                budget: SearchBudget,
+                jobs: 'multiprocessing.Queue[List[ReportJob]]',
+                jobs_left: 'multiprocessing.sharedctypes.Synchronized[int]',
+                done: 'multiprocessing.Queue[Tuple[ReportJob, SearchResult]]') \
+                -> None:
+    with Worker(args, worker_idx, predictor, switch_dict, budget) as worker:
         while True:
             try:
-                next_job = jobs.get_nowait()
+                next_jobs = jobs.get_nowait()
             except queue.Empty:
                 return
-            solution = worker.run_job(next_job, restart=not args.hardfail)
-            done.put((next_job, solution))
+            for next_job in next_jobs:
+                with jobs_left.get_lock():
+                    jobs_left.value -= 1
+                solution = worker.run_job(next_job, restart=not args.hardfail)
+                done.put((next_job, solution))
 
 def project_dicts_from_args(args: argparse.Namespace) -> List[Dict[str, Any]]:
     if args.splits_file:
@@ -257,27 +407,33 @@ def project_dicts_from_args(args: argparse.Namespace) -> List[Dict[str, Any]]:
                           "test_files": [str(filename) for filename in args.filenames]}]
     return project_dicts
 
+def get_proofs_files(args: argparse.Namespace,
+                     output_dir: Optional[Path] = None) -> List[Path]:
+    project_dicts = project_dicts_from_args(args)
+    if output_dir is None:
+        output_dir = args.output_dir
+    return [output_dir / project_dict["project_name"] /
+            (util.safe_abbrev(Path(filename),
+                              [Path(filename) for filename in
+                               project_dict["test_files"]])
+             + "-proofs.txt")
+            for project_dict in project_dicts
+            for filename in project_dict["test_files"]]
+
 def get_already_done_jobs(args: argparse.Namespace) -> List[ReportJob]:
     already_done_jobs: List[ReportJob] = []
 
-    project_dicts = project_dicts_from_args(args)
-    for project_dict in project_dicts:
-        for filename in project_dict["test_files"]:
-            proofs_file = (args.output_dir / project_dict["project_name"] /
-                           (util.safe_abbrev(Path(filename),
-                                             [Path(filename) for filename in
-                                              project_dict["test_files"]])
-                            + "-proofs.txt"))
-            try:
-                with proofs_file.open('r') as f:
-                    for line in f:
-                        (job_project, job_file, job_module, job_lemma), sol = json.loads(line)
-                        already_done_jobs.append(ReportJob(job_project,
-                                                           job_file,
-                                                           job_module,
-                                                           job_lemma))
-            except FileNotFoundError:
-                pass
+    for proofs_file in get_proofs_files(args):
+        try:
+            with proofs_file.open('r') as f:
+                for line in f:
+                    (job_project, job_file, job_module, job_lemma), sol = json.loads(line)
+                    already_done_jobs.append(ReportJob(job_project,
+                                                       job_file,
+                                                       job_module,
+                                                       job_lemma))
+        except FileNotFoundError:
+            pass
 
     return already_done_jobs
 
@@ -288,24 +444,98 @@ def get_all_jobs(args: argparse.Namespace) -> List[ReportJob]:
                             for filename in project_dict["test_files"]]
     return list(get_files_jobs(args, tqdm(proj_filename_tuples, desc="Getting jobs")))
 
-def remove_already_done_jobs(args: argparse.Namespace) -> None:
-    project_dicts = project_dicts_from_args(args)
-    for project_dict in project_dicts:
-        for filename in project_dict["test_files"]:
-            proofs_file = (args.output_dir / project_dict["project_name"] /
-                           (util.safe_abbrev(Path(filename),
-                                             [Path(filename) for filename in
-                                              project_dict["test_files"]])
-                            + "-proofs.txt"))
+def get_prior_job_times(proofs_files: Iterable[Path]) -> Dict[ReportJob, float]:
+    job_times: Dict[ReportJob, float] = {}
+    for proofs_file in proofs_files:
+        try:
+            with proofs_file.open('r') as f:
+                for line in f:
+                    job, sol = json.loads(line)
+                    if sol.get("time_breakdown"):
+                        job_times[ReportJob(*job)] = \
+                            sol["time_breakdown"]["total"]
+        except FileNotFoundError:
+            pass
+    return job_times
+
+def estimate_job_costs(args: argparse.Namespace, jobs: List[ReportJob],
+                       prior_times: Dict[ReportJob, float]) \
+                       -> Dict[ReportJob, float]:
+    files_jobs: Dict[Tuple[str, str], List[ReportJob]] = {}
+    for job in jobs:
+        files_jobs.setdefault((job.project_dir, job.filename), []).append(job)
+    if not prior_times:
+        # With nothing to go on, assume each file's lemmas take about as long
+        # as each other, and bigger files take longer.
+        costs: Dict[ReportJob, float] = {}
+        for (project, filename), file_jobs in files_jobs.items():
             try:
-                os.remove(proofs_file)
+                file_size = (args.prelude / project / filename).stat().st_size
             except FileNotFoundError:
-                pass
+                file_size = len(file_jobs)
+            for job in file_jobs:
+                costs[job] = file_size / len(file_jobs)
+        return costs
+    # Otherwise, lemmas we don't have a time for are expected to take as
+    # long as the other lemmas in their file did, or as the lemmas in
+    # other files did if none in their file have run.
+    default_time = sum(prior_times.values()) / len(prior_times)
+    costs = {}
+    for file_jobs in files_jobs.values():
+        file_times = [prior_times[job] for job in file_jobs
+                      if job in prior_times]
+        file_time = sum(file_times) / len(file_times) \
+            if file_times else default_time
+        for job in file_jobs:
+            costs[job] = prior_times.get(job, file_time)
+    return costs
+
+def schedule_jobs(jobs: List[ReportJob], job_costs: Dict[ReportJob, float],
+                  num_workers: int) -> List[List[ReportJob]]:
+    """
+    Group jobs into runs of consecutive lemmas from the same file, to be
+    searched in order by one worker so that it only enters the file once,
+    and order the runs costliest first so that the big ones don't finish
+    last. Files that would take more than half of a worker's share of the
+    total are split into several runs.
+    """
+    files_jobs: Dict[Tuple[str, str], List[ReportJob]] = {}
+    for job in jobs:
+        files_jobs.setdefault((job.project_dir, job.filename), []).append(job)
+    max_run_cost = sum(job_costs[job] for job in jobs) / (2 * num_workers)
+    file_runs: Dict[Tuple[str, str], List[List[ReportJob]]] = {}
+    run_costs: List[Tuple[float, Tuple[str, str]]] = []
+    for file_key, file_jobs in files_jobs.items():
+        runs: List[List[ReportJob]] = [[]]
+        run_cost = 0.
+        for job in file_jobs:
+            if runs[-1] and run_cost + job_costs[job] > max_run_cost:
+                run_costs.append((run_cost, file_key))
+                runs.append([])
+                run_cost = 0.
+            runs[-1].append(job)
+            run_cost += job_costs[job]
+        run_costs.append((run_cost, file_key))
+        file_runs[file_key] = runs
+    run_costs.sort(key=lambda cost_file: cost_file[0], reverse=True)
+    # Workers can't go back to a lemma in a file they've already passed, so
+    # each file's runs are still queued in file order, in the places their
+    # costs earned.
+    next_runs = {file_key: iter(runs) for file_key, runs in file_runs.items()}
+    return [next(next_runs[file_key]) for _, file_key in run_costs]
+
+def remove_already_done_jobs(args: argparse.Namespace) -> None:
+    for proofs_file in get_proofs_files(args):
+        try:
+            os.remove(proofs_file)
+        except FileNotFoundError:
+            pass
 
 def search_file_multithreaded(args: argparse.Namespace,
                               predictor: TacticPredictor) -> None:
     global start_time
     start_time = datetime.now()
+    set_run_deadline(args)
     if args.resume:
         solved_jobs = get_already_done_jobs(args)
         try:
@@ -327,18 +557,25 @@ def search_file_multithreaded(args: argparse.Namespace,
     todo_jobs = [job for job in all_jobs if job not in solved_jobs]
     assert len(todo_jobs) == len(all_jobs) - len(solved_jobs),\
       f"{len(todo_jobs)} != {len(all_jobs)} - {len(solved_jobs)}"
+    prior_times = get_prior_job_times(get_proofs_files(args))
+    if args.prior_results:
+        prior_times.update(get_prior_job_times(
+            get_proofs_files(args, args.prior_results)))
+    job_costs = estimate_job_costs(args, todo_jobs, prior_times)
     with multiprocessing.Manager() as manager:
-        jobs: multiprocessing.Queue[ReportJob] = multiprocessing.Queue()
+        jobs: multiprocessing.Queue[List[ReportJob]] = multiprocessing.Queue()
         done: multiprocessing.Queue[
             Tuple[ReportJob, SearchResult]
         ] = multiprocessing.Queue()
-
-
-        for job in todo_jobs:
-            jobs.put(job)
+        # The queue holds runs of lemmas, so the budget needs its own count
+        # of the lemmas not yet started.
+        jobs_left = multiprocessing.Value('i', len(todo_jobs))
 
         num_threads = min(args.num_threads,
                           len(todo_jobs))
+        for run in schedule_jobs(todo_jobs, job_costs,
+                                 max(num_threads, 1) * args.interleaved_lemmas):
+            jobs.put(run)
         if util.use_cuda:
             if args.gpus:
                 gpu_list = args.gpus.split(",")
@@ -349,11 +586,30 @@ def search_file_multithreaded(args: argparse.Namespace,
         else:
             assert args.gpus is None, "Passed --gpus flag, but CUDA is not supported!"
             worker_devices = ["cpu"]
-        worker_predictors = [copy.deepcopy(predictor)
-                             for device in worker_devices]
-        for predictor, device in zip(worker_predictors, worker_devices):
-            predictor.to_device(device) # type: ignore
-            predictor.share_memory() # type: ignore
+        servers: List[multiprocessing.Process] = []
+        if args.model_server and not args.model_server_address:
+            # One server for each device, with the workers spread between
+            # them the same way they would be between local predictors.
+            server_dir = tempfile.mkdtemp(prefix="proverbot-server-")
+            worker_predictors: List[TacticPredictor] = []
+            for device_idx, device in enumerate(worker_devices):
+                server_address = os.path.join(server_dir,
+                                              f"predictor-{device_idx}.sock")
+                server = multiprocessing.Process(
+                    target=serve_predictions,
+                    args=(predictor, server_address,
+                          args.model_server_max_wait, device,
+                          args.inference_threads, args.inference_dtype),
+                    daemon=True)
+                server.start()
+                servers.append(server)
+                worker_predictors.append(RemotePredictor(server_address))
+        else:
+            worker_predictors = [copy.deepcopy(predictor)
+                                 for device in worker_devices]
+        for worker_predictor, device in zip(worker_predictors, worker_devices):
+            worker_predictor.to_device(device) # type: ignore
+            worker_predictor.share_memory() # type: ignore
         # This cast appears to be needed due to a buggy type stub on
         # multiprocessing.Manager()
         predictor_locks = [cast(multiprocessing.managers.SyncManager,
@@ -363,7 +619,7 @@ def search_file_multithreaded(args: argparse.Namespace,
                                            args=(args,
                                                  worker_predictors[widx % len(worker_predictors)],
                                                  predictor_locks[widx % len(worker_predictors)],
-                                                 jobs, done, widx,
+                                                 jobs, jobs_left, done, widx,
                                                  worker_devices[widx % len(worker_predictors)]))
                    for widx in range(num_threads)]
         for worker in workers:
@@ -398,6 +654,10 @@ def search_file_multithreaded(args: argparse.Namespace,
 
             for worker in workers:
                 worker.join()
+        for server in servers:
+            server.terminate()
+        if servers:
+            shutil.rmtree(server_dir)
     time_taken = datetime.now() - start_time
     write_time(args)
     if args.generate_report:
@@ -25,7 +25,6 @@ import os
 import time
 import sys
 import json
-import subprocess
 import signal
 import shutil
 import functools
@@ -33,13 +32,14 @@ from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime, timedelta
 
-from typing import List, NamedTuple
+from typing import Dict, List, NamedTuple
 
 from search_file import (add_args_to_parser, get_predictor,
                          get_already_done_jobs, remove_already_done_jobs,
-                         project_dicts_from_args)
+                         project_dicts_from_args, get_proofs_files)
 from search_worker import ReportJob
 from search_report import generate_report
+from cluster_dispatch import Dispatcher, add_dispatch_args, get_dispatcher
 import coq_serapy
 import util
 
@@ -58,6 +58,7 @@ def main(arg_list: List[str]) -> None:
     arg_parser.add_argument("--worker-timeout", default="6:00:00")
     arg_parser.add_argument("-p", "--partition", default="defq")
     arg_parser.add_argument("--mem", default="2G")
+    add_dispatch_args(arg_parser)
 
     args = arg_parser.parse_args(arg_list)
     if args.filenames[0].suffix == ".json":
@@ -66,6 +67,7 @@ def main(arg_list: List[str]) -> None:
         args.splits_file = args.filenames[0]
         args.filenames = []
     predictor = get_predictor(arg_parser, args)
+    dispatcher = get_dispatcher(args)
     base = Path(os.path.dirname(os.path.abspath(__file__)))
 
     os.makedirs(str(args.output_dir), exist_ok=True)
@@ -109,16 +111,20 @@ def main(arg_list: List[str]) -> None:
         remove_already_done_jobs(args)
         solved_jobs = []
     os.makedirs(str(args.output_dir / args.workers_output_dir), exist_ok=True)
-    get_all_jobs_cluster(args)
+    get_all_jobs_cluster(args, dispatcher)
     with open(args.output_dir / "all_jobs.txt") as f:
         jobs = [ReportJob(*json.loads(line)) for line in f]
         assert len(jobs) > 0
     if len(solved_jobs) < len(jobs):
+        if args.run_time_budget is not None and args.run_deadline is None:
+            args.run_deadline = start_time.timestamp() + args.run_time_budget
         setup_jobsstate(args.output_dir, jobs, solved_jobs)
-        dispatch_workers(args, arg_list)
-        with util.sighandler_context(signal.SIGINT, functools.partial(interrupt_early, args)):
+        dispatch_workers(args, dispatcher, arg_list)
+        with util.sighandler_context(signal.SIGINT,
+                                     functools.partial(interrupt_early, args,
+                                                       dispatcher)):
             show_progress(args)
-        cancel_workers(args)
+        cancel_workers(dispatcher)
         with open(args.output_dir / "time_so_far.txt", 'w') as f:
             time_taken = datetime.now() - start_time
             print(str(time_taken), file=f)
@@ -129,7 +135,8 @@ def main(arg_list: List[str]) -> None:
 
 
 
-def get_all_jobs_cluster(args: argparse.Namespace) -> None:
+def get_all_jobs_cluster(args: argparse.Namespace,
+                         dispatcher: Dispatcher) -> None:
     if (args.output_dir / "all_jobs.txt").exists():
         return
     project_dicts = project_dicts_from_args(args)
@@ -157,12 +164,10 @@ def get_all_jobs_cluster(args: argparse.Namespace) -> None:
         worker_args.append(f"--proof={args.proof}")
     elif args.proofs_file:
         worker_args.append(f"--proofs-file={str(args.proofs_file)}")
-    cur_dir = os.path.realpath(os.path.dirname(__file__))
-    subprocess.run([f"{cur_dir}/sbatch-retry.sh",
-                    "-o", str(args.output_dir / args.workers_output_dir /
-                              "file-scanner-%a.out"),
-                    f"--array=0-{args.num_workers-1}",
-                    f"{cur_dir}/job_getting_worker.sh"] + worker_args)
+    dispatcher.dispatch("proverbot9001-scanner", "job_getting_worker",
+                        worker_args, args.num_workers,
+                        args.output_dir / args.workers_output_dir /
+                        "file-scanner-%a.out")
 
     with tqdm(desc="Getting jobs", total=len(projfiles), dynamic_ncols=True) as bar:
         num_files_scanned = 0
@@ -183,55 +188,82 @@ def setup_jobsstate(output_dir: Path, all_jobs: List[ReportJob],
             if job not in solved_jobs:
                 print(json.dumps(job), file=f)
         print("", end="", flush=True, file=f)
-def dispatch_workers(args: argparse.Namespace, rest_args: List[str]) -> None:
+def dispatch_workers(args: argparse.Namespace, dispatcher: Dispatcher,
+                     rest_args: List[str]) -> None:
     with (args.output_dir / "num_workers_dispatched.txt").open("w") as f:
         print(args.num_workers, file=f)
     with (args.output_dir / "workers_scheduled.txt").open("w") as f:
         pass
-    cur_dir = os.path.realpath(os.path.dirname(__file__))
-    # If you have a different cluster management software, that still allows
-    # dispatching jobs through the command line and uses a shared filesystem,
-    # modify this line.
-    subprocess.run([f"{cur_dir}/sbatch-retry.sh",
-                    "-J", "proverbot9001-worker",
-                    "-p", args.partition,
-                    "-t", str(args.worker_timeout),
-                    "--cpus-per-task", str(args.num_threads),
-                    "-o", str(args.output_dir / args.workers_output_dir
-                              / "worker-%a.out"),
-                    "--mem", args.mem,
-                    f"--array=0-{args.num_workers-1}",
-                    f"{cur_dir}/search_file_cluster_worker.sh"] + rest_args)
-
-def interrupt_early(args: argparse.Namespace, *rest_args) -> None:
-    cancel_workers(args)
+    # Workers can start long after each other, so they're all given the
+    # deadline of the run instead of counting their budget from their start.
+    if args.run_deadline is not None:
+        rest_args = rest_args + [f"--run-deadline={args.run_deadline}"]
+    # To run workers some other way, add a Dispatcher to cluster_dispatch.py.
+    dispatcher.dispatch("proverbot9001-worker", "search_file_cluster_worker",
+                        rest_args, args.num_workers,
+                        args.output_dir / args.workers_output_dir
+                        / "worker-%a.out")
+
+def interrupt_early(args: argparse.Namespace, dispatcher: Dispatcher,
+                    *rest_args) -> None:
+    cancel_workers(dispatcher)
     with open(args.output_dir / "time_so_far.txt", 'w') as f:
         time_taken = datetime.now() - start_time
         print(str(time_taken), file=f)
     sys.exit()
-def cancel_workers(args: argparse.Namespace) -> None:
-    subprocess.run(["scancel -u $USER -n proverbot9001-worker"], shell=True)
+def cancel_workers(dispatcher: Dispatcher) -> None:
+    dispatcher.cancel("proverbot9001-worker")
+
+class LineCounter:
+    """
+    Counts the lines in a set of files that are only ever appended to,
+    reading just what's been added since the last count.
+    """
+    _offsets: Dict[Path, int]
+    num_lines: int
+
+    def __init__(self, paths: List[Path]) -> None:
+        self._offsets = {path: 0 for path in paths}
+        self.num_lines = 0
+
+    def update(self) -> int:
+        for path, offset in self._offsets.items():
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                continue
+            if size <= offset:
+                continue
+            with path.open('rb') as f:
+                f.seek(offset)
+                new_data = f.read(size - offset)
+            # Leave a partly written line to be counted once it's finished.
+            complete_length = new_data.rfind(b"\n") + 1
+            self.num_lines += new_data.count(b"\n", 0, complete_length)
+            self._offsets[path] = offset + complete_length
+        return self.num_lines
 
 def show_progress(args: argparse.Namespace) -> None:
-    num_jobs_done = len(get_already_done_jobs(args))
+    jobs_done_counter = LineCounter(get_proofs_files(args))
+    workers_scheduled_counter = LineCounter(
+        [args.output_dir / "workers_scheduled.txt"])
+    num_jobs_done = jobs_done_counter.update()
     with (args.output_dir / "all_jobs.txt").open('r') as f:
         num_jobs_total = len([line for line in f])
     with (args.output_dir / "num_workers_dispatched.txt").open('r') as f:
         num_workers_total = int(f.read())
-    with (args.output_dir / "workers_scheduled.txt").open('r') as f:
-        num_workers_scheduled = len([line for line in f])
+    num_workers_scheduled = workers_scheduled_counter.update()
 
     with tqdm(desc="Jobs finished", total=num_jobs_total,
               initial=num_jobs_done, dynamic_ncols=True) as bar, \
          tqdm(desc="Workers scheduled", total=num_workers_total,
               initial=num_workers_scheduled, dynamic_ncols=True) as wbar:
         while num_jobs_done < num_jobs_total:
-            new_jobs_done = len(get_already_done_jobs(args))
+            new_jobs_done = jobs_done_counter.update()
             bar.update(new_jobs_done - num_jobs_done)
             num_jobs_done = new_jobs_done
 
-            with (args.output_dir / "workers_scheduled.txt").open('r') as f:
-                new_workers_scheduled = len([line for line in f])
+            new_workers_scheduled = workers_scheduled_counter.update()
             wbar.update(new_workers_scheduled - num_workers_scheduled)
             num_workers_scheduled = new_workers_scheduled
 
@@ -27,13 +27,14 @@ import json
 import sys
 import multiprocessing
 import re
-from os import environ
 from typing import List, Optional
 
 from pathlib import Path
 import torch
 
 from search_file import (add_args_to_parser, get_predictor, Worker)
+from search_budget import SearchBudget
+from cluster_dispatch import add_dispatch_args, get_worker_id
 import coq_serapy
 from coq_serapy.contexts import ProofContext
 from models.tactic_predictor import TacticPredictor
@@ -51,6 +52,7 @@ def main(arg_list: List[str]) -> None:
     arg_parser.add_argument("--worker-timeout", default="6:00:00")
     arg_parser.add_argument("-p", "--partition", default="defq")
     arg_parser.add_argument("--mem", default="2G")
+    add_dispatch_args(arg_parser)
     args = arg_parser.parse_args(arg_list)
     if args.filenames[0].suffix == ".json":
         assert args.splits_file == None
@@ -58,10 +60,7 @@ def main(arg_list: List[str]) -> None:
         args.splits_file = args.filenames[0]
         args.filenames = []
 
-    if 'SLURM_ARRAY_TASK_ID' in environ:
-        workerid = int(environ['SLURM_ARRAY_TASK_ID'])
-    else:
-        assert False, 'SLURM_ARRAY_TASK_ID must be set'
+    workerid = get_worker_id()
 
     sys.setrecursionlimit(100000)
     if util.use_cuda:
@@ -83,6 +82,7 @@ def main(arg_list: List[str]) -> None:
 
 def run_worker(args: argparse.Namespace, workerid: int,
                predictor: TacticPredictor) -> None:
+    util.configure_inference(args.inference_threads, args.inference_dtype)
     with (args.output_dir / "jobs.txt").open('r') as f:
         all_jobs = [json.loads(line) for line in f]
 
@@ -93,20 +93,20 @@ def run_worker(args: argparse.Namespace, workerid: int,
             switch_dict = {item["project_name"]: item["switch"]
                            for item in project_dicts}
 
-    with Worker(args, workerid, predictor, switch_dict) as worker:
+    # Every thread of every worker searches one lemma at a time, and the
+    # lemmas not yet claimed are the ones in jobs.txt past the claim count.
+    budget = SearchBudget(args, args.num_workers * args.num_threads,
+                          lambda: len(all_jobs) - util.read_index(
+                              args.output_dir / "taken.txt"))
+    with Worker(args, workerid, predictor, switch_dict, budget) as worker:
         while True:
-            with (args.output_dir / "taken.txt").open('r+') as f, FileLock(f):
-                taken_jobs = [json.loads(line) for line in f]
-                current_job = None
-                for job in all_jobs:
-                    if job not in taken_jobs:
-                        current_job = job
-                        break
-                if current_job:
-                    print(json.dumps(current_job), file=f, flush=True)
-                    eprint(f"Starting job {current_job}")
-                else:
-                    break
+            # taken.txt counts how many of the jobs in jobs.txt have been
+            # claimed, so claiming one doesn't depend on how many there are.
+            job_idx = util.claim_next_index(args.output_dir / "taken.txt")
+            if job_idx >= len(all_jobs):
+                break
+            current_job = all_jobs[job_idx]
+            eprint(f"Starting job {current_job}")
             solution = worker.run_job(current_job)
             job_project, job_file, _, _ = current_job
             with (args.output_dir / job_project /
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+import contextlib
+import json
+from pathlib import Path
+from typing import Any, Dict, IO, Iterator, List, Optional
+
+import pygraphviz as pgv
+from tqdm import tqdm
+
+from coq_serapy.contexts import FullContext
+from util import nostderr
+
+# Search graphs are recorded as an append-only log of json events while the
+# search runs, one per line:
+#
+#   {"style": "dfs" | "bfs"}                  (first line)
+#   {"node": id, "parent": id or null, "tactic": str, "value": float,
+#    "time": float or null, "tooltip": str}
+#   {"node": id, "color": str}
+#   {"node": id, "score": float}
+#
+# and only laid out with dot afterwards, if at all.
+
+events_suffix = ".events.jsonl"
+
+
+class SearchGraphLog:
+    _file: Optional[IO[str]]
+    _next_node_id: int
+
+    def __init__(self, path: Optional[Path], style: str) -> None:
+        self.path = path
+        self._next_node_id = 0
+        if path is None:
+            self._file = None
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open('w')
+        self._write({"style": style})
+
+    def _write(self, event: Dict[str, Any]) -> None:
+        if self._file:
+            self._file.write(json.dumps(event))
+            self._file.write("\n")
+
+    def add_node(self, parent_id: Optional[int], tactic: str, value: float,
+                 time_taken: Optional[float],
+                 context_before: FullContext) -> int:
+        node_id = self._next_node_id
+        self._next_node_id += 1
+        if self._file:
+            tooltip = ""
+            for hyp in context_before.obligations.focused_hyps:
+                tooltip += hyp[:64] + "&#10;"
+            tooltip += "-" * 64 + "&#10;"
+            tooltip += context_before.obligations.focused_goal[:64]
+            self._write({"node": node_id, "parent": parent_id,
+                         "tactic": tactic, "value": value,
+                         "time": time_taken, "tooltip": tooltip})
+        return node_id
+
+    def set_color(self, node_id: int, color: str) -> None:
+        self._write({"node": node_id, "color": color})
+
+    def set_score(self, node_id: int, score: float) -> None:
+        self._write({"node": node_id, "score": score})
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def finish(self, graph_mode: str) -> None:
+        """
+        Close the log, and if we're producing svgs, render it next to the
+        log and remove the log.
+        """
+        self.close()
+        if self.path is None or graph_mode != "svg":
+            return
+        render_search_graph(self.path, svg_path(self.path))
+        self.path.unlink()
+
+    @contextlib.contextmanager
+    def finishing(self, graph_mode: str) -> Iterator[None]:
+        """
+        Finish the log once the search in the block returns. If it's
+        interrupted instead, just close the log, leaving the events to be
+        rendered later with render-search-graphs if they're wanted.
+        """
+        try:
+            yield
+        except BaseException:
+            self.close()
+            raise
+        self.finish(graph_mode)
+
+
+def graph_log_path(graph_mode: str, output_dir: Path,
+                   graph_name: str) -> Optional[Path]:
+    if graph_mode == "none":
+        return None
+    return output_dir / (graph_name + events_suffix)
+
+
+def svg_path(events_path: Path) -> Path:
+    return events_path.with_name(events_path.name[:-len(events_suffix)]
+                                 + ".svg")
+
+
+def render_search_graph(events_path: Path, svg_file: Path) -> None:
+    graph = pgv.AGraph(directed=True)
+    style = "dfs"
+    labels: Dict[int, List[Any]] = {}
+    colors: Dict[int, List[str]] = {}
+    with events_path.open('r') as f:
+        for line in f:
+            event = json.loads(line)
+            if "style" in event:
+                style = event["style"]
+            elif "tactic" in event:
+                node_id = event["node"]
+                labels[node_id] = [event["tactic"], event["value"]]
+                colors[node_id] = []
+                graph.add_node(node_id, tooltip=event["tooltip"])
+                if event["parent"] is not None:
+                    graph.add_edge(event["parent"], node_id)
+            elif "color" in event:
+                colors[event["node"]].append(event["color"])
+            else:
+                assert "score" in event, event
+                labels[event["node"]][1] = event["score"]
+    for node_id, (tactic, value) in labels.items():
+        node_handle = graph.get_node(node_id)
+        if style == "dfs":
+            node_handle.attr["label"] = f"{tactic}\n({value:.2f})"
+        else:
+            node_handle.attr["label"] = f"{tactic}\n{value:.2e}"
+        if colors[node_id]:
+            node_handle.attr["fillcolor"] = ":".join(colors[node_id])
+            node_handle.attr["style"] = "filled"
+        elif style == "bfs":
+            node_handle.attr["fillcolor"] = "lightgrey"
+    svg_file.parent.mkdir(parents=True, exist_ok=True)
+    with nostderr():
+        graph.draw(str(svg_file), prog="dot")
+
+
+def main(arg_list: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Render the search graph event logs left by "
+        "--search-graphs=events as svgs")
+    parser.add_argument("--keep-events", action='store_true')
+    parser.add_argument("paths", nargs="+", type=Path,
+                        help="Event logs, or report directories to search "
+                        "for them")
+    args = parser.parse_args(arg_list)
+
+    events_paths: List[Path] = []
+    for path in args.paths:
+        if path.is_dir():
+            events_paths += path.glob(f"**/*{events_suffix}")
+        else:
+            events_paths.append(path)
+    for events_path in tqdm(events_paths, desc="Rendering search graphs"):
+        render_search_graph(events_path, svg_path(events_path))
+        if not args.keep_events:
+            events_path.unlink()
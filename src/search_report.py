@@ -163,7 +163,8 @@ def blocks_from_scrape_and_sols(
             else:
                 return ProofBlock(cur_lemma_stmt, sm_prefix,
                                   result.status, result.commands,
-                                  batch_without_brackets)
+                                  batch_without_brackets,
+                                  result.time_breakdown)
             tactics_interactions_batch = []
 
         for interaction in interactions:
@@ -244,9 +245,17 @@ def write_csv(args: argparse.Namespace,
         rowwriter = csv.writer(csvfile, lineterminator=os.linesep)
         for block in doc_blocks:
             if isinstance(block, ProofBlock):
-                rowwriter.writerow([block.lemma_statement.strip(),
-                                    block.status,
-                                    len(block.original_tactics)])
+                row = [block.lemma_statement.strip(),
+                       block.status,
+                       len(block.original_tactics)]
+                # Lemmas that weren't searched, and results from before
+                # times were recorded, leave the timing columns empty.
+                for category in ["coq", "model", "other", "total"]:
+                    if block.time_breakdown:
+                        row.append(f"{block.time_breakdown[category]:.2f}")
+                    else:
+                        row.append("")
+                rowwriter.writerow(row)
 
 
 def write_html(args: argparse.Namespace,
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from enum import Enum, auto
-from typing import NamedTuple, Optional, List, Union
+from typing import NamedTuple, Optional, List, Union, Dict
 from coq_serapy import ProofContext
 
 class ReportStats(NamedTuple):
@@ -36,6 +36,8 @@ class TacticInteraction(NamedTuple):
 class SearchResult(NamedTuple):
     status: SearchStatus
     commands: Optional[List[TacticInteraction]]
+    # Seconds spent in coq, the model, and everything else, and in total.
+    time_breakdown: Optional[Dict[str, float]] = None
 
     @classmethod
     def from_dict(cls, data):
@@ -45,12 +47,15 @@ class SearchResult(NamedTuple):
         else:
             commands = list(map(TacticInteraction.from_dict,
                                 data['commands']))
-        return cls(status, commands)
+        return cls(status, commands, data.get('time_breakdown'))
 
     def to_dict(self):
-        return {'status': self.status.name,
-                'commands': list(map(TacticInteraction.to_dict,
-                                     self.commands))}
+        result = {'status': self.status.name,
+                  'commands': list(map(TacticInteraction.to_dict,
+                                       self.commands))}
+        if self.time_breakdown is not None:
+            result['time_breakdown'] = self.time_breakdown
+        return result
 
 class VernacBlock(NamedTuple):
     commands: List[str]
@@ -61,6 +66,7 @@ class ProofBlock(NamedTuple):
     status: SearchStatus
     predicted_tactics: List[TacticInteraction]
     original_tactics: List[TacticInteraction]
+    time_breakdown: Optional[Dict[str, float]] = None
 
 DocumentBlock = Union[VernacBlock, ProofBlock]
 
@@ -7,12 +7,12 @@ import sys
 import pickle
 import heapq
 import math
-from typing import Dict, List, Tuple, Optional, IO, NamedTuple, cast
+from typing import (Any, Dict, List, Tuple, Optional, IO, NamedTuple, cast,
+                    ContextManager, TYPE_CHECKING)
 from dataclasses import dataclass, field
 from pathlib import Path
 
-import pygraphviz as pgv
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 if sys.version_info >= (3, 10):
     from lemma_models import Lemma, UnhandledExpr
@@ -22,11 +22,15 @@ from coq_serapy.contexts import TacticContext, FullContext, ProofContext, trunca
 import tokenizer
 from models.tactic_predictor import Prediction, TacticPredictor
 from search_results import TacticInteraction, SearchResult, SearchStatus
-from util import nostderr, unwrap, eprint, mybarfmt
+from util import unwrap, eprint, mybarfmt
+from transposition_table import TranspositionTable, CachedFailure, context_key
+from search_graphs import SearchGraphLog, graph_log_path
+from search_budget import lemma_clock
 
 from value_estimator import Estimator
 
-unnamed_goal_number: int = 0
+if TYPE_CHECKING:
+    from tactic_pool import TacticPool
 
 class FeaturesExtractor:
     tactic_map: Dict[str, int]
@@ -97,6 +101,30 @@ class FeaturesExtractor:
         return [self._num_tactics, self._num_tokens * 2 + 2], [1.0]
 
 
+# Each node keeps a bloom-style mask of the goals of its ancestors, so that
+# checking whether a context has been seen on the path is usually a single
+# bitwise and. contextSurjective can only hold when every goal of the older
+# context appears in the newer one, so it's enough for each ancestor to
+# contribute the fingerprint of one of its goals.
+goalMaskBits = 1024
+
+def goalFingerprint(goal: str) -> int:
+    return 1 << (1 + hash(goal) % (goalMaskBits - 1))
+
+
+def contextFingerprint(context: ProofContext) -> int:
+    if len(context.all_goals) == 0:
+        return 1
+    return goalFingerprint(context.all_goals[0].goal)
+
+
+def contextMayBeInMask(context: ProofContext, mask: int) -> bool:
+    if len(context.all_goals) == 0:
+        return mask & 1 != 0
+    return any(goalFingerprint(obligation.goal) & mask
+               for obligation in context.all_goals)
+
+
 @dataclass(init=True)
 class LabeledNode:
     prediction: str
@@ -106,23 +134,21 @@ class LabeledNode:
     context_before: FullContext
     previous: Optional["LabeledNode"]
     children: List["LabeledNode"]
+    ancestor_goal_mask: int = 0
 
 
 class SearchGraph:
-    __graph: pgv.AGraph
-    __next_node_id: int
+    __log: SearchGraphLog
     feature_extractor: Optional[FeaturesExtractor]
     start_node: LabeledNode
 
     def __init__(self, tactics_file: Path, tokens_file: Path, lemma_name: str,
-                 features_json: bool) -> None:
-        self.__graph = pgv.AGraph(directed=True)
-        self.__next_node_id = 0
+                 features_json: bool, graph_log: SearchGraphLog) -> None:
+        self.__log = graph_log
         self.start_node = self.mkNode(Prediction(lemma_name, 1.0),
                                       FullContext(
                                           [], [], ProofContext([], [], [], [])),
-                                      None)
-        self.start_node.time_taken = 0.0
+                                      None, 0.0)
         if features_json:
             self.feature_extractor = FeaturesExtractor(str(tactics_file),
                                                        str(tokens_file))
@@ -130,35 +156,27 @@ class SearchGraph:
 
     def mkNode(self, prediction: Prediction, context_before: FullContext,
                previous_node: Optional[LabeledNode],
-               **kwargs) -> LabeledNode:
-
-        tooltip = ""
-        for hyp in context_before.obligations.focused_hyps:
-            tooltip += hyp[:64] + "&#10;"
-        tooltip += "-" * 64 + "&#10;"
-        tooltip += context_before.obligations.focused_goal[:64]
-
-        self.__graph.add_node(self.__next_node_id,
-                              label="{}\n({:.2f})".format(
-                                  prediction.prediction,
-                                  prediction.certainty),
-                              tooltip=tooltip,
-                              **kwargs)
-        self.__next_node_id += 1
+               time_taken: Optional[float] = None) -> LabeledNode:
+        node_id = self.__log.add_node(
+            previous_node.node_id if previous_node else None,
+            prediction.prediction, prediction.certainty, time_taken,
+            context_before)
+        ancestor_goal_mask = contextFingerprint(context_before.obligations)
+        if previous_node:
+            ancestor_goal_mask |= previous_node.ancestor_goal_mask
         newNode = LabeledNode(prediction.prediction, prediction.certainty,
-                              None, self.__next_node_id-1,
-                              context_before, previous_node, [])
+                              time_taken, node_id,
+                              context_before, previous_node, [],
+                              ancestor_goal_mask)
         if previous_node:
-            self.__graph.add_edge(previous_node.node_id,
-                                  newNode.node_id, **kwargs)
             previous_node.children.append(newNode)
         return newNode
 
     def mkQED(self, predictionNode: LabeledNode):
-        self.mkNode(Prediction("QED", 1.0), FullContext(
+        qed_node = self.mkNode(Prediction("QED", 1.0), FullContext(
             [], [], ProofContext([], [], [], [])),
-                    predictionNode,
-                    fillcolor="green", style="filled")
+                               predictionNode)
+        self.setNodeColor(qed_node, "green")
         cur_node = predictionNode
         cur_path = []
         while cur_node != self.start_node:
@@ -171,17 +189,13 @@ class SearchGraph:
         pass
 
     def setNodeColor(self, node: LabeledNode, color: str) -> None:
-        node_handle = self.__graph.get_node(node.node_id)
-        if node_handle.attr["fillcolor"] != None and node_handle.attr["fillcolor"] != "":
-            node_handle.attr["fillcolor"] += (":" + color)
-        else:
-            node_handle.attr["fillcolor"] = color
-            node_handle.attr["style"] = "filled"
+        self.__log.set_color(node.node_id, color)
 
-    def draw(self, filename: str) -> None:
-        Path(filename).parent.mkdir(parents=True, exist_ok=True)
-        with nostderr():
-            self.__graph.draw(filename, prog="dot")
+    def finish(self, graph_mode: str) -> None:
+        self.__log.finish(graph_mode)
+
+    def finishing(self, graph_mode: str) -> ContextManager[None]:
+        return self.__log.finishing(graph_mode)
 
     def write_feat_json(self, filename: str) -> None:
         assert self.feature_extractor
@@ -225,10 +239,17 @@ class SubSearchResult (NamedTuple):
     solved_subgoals: int
 
 
-def contextInPath(full_context: ProofContext, path: List[LabeledNode]):
-    return any([coq_serapy.contextSurjective(full_context,
-                                             n.context_before.obligations)
-                for n in path])
+def contextInPath(full_context: ProofContext, node: LabeledNode,
+                  path_start: LabeledNode) -> bool:
+    if not contextMayBeInMask(full_context, node.ancestor_goal_mask):
+        return False
+    cur_node: Optional[LabeledNode] = node
+    while cur_node is not None and cur_node is not path_start:
+        if coq_serapy.contextSurjective(full_context,
+                                        cur_node.context_before.obligations):
+            return True
+        cur_node = cur_node.previous
+    return False
 
 
 def numNodesInTree(branching_factor: int, depth: int):
@@ -295,6 +316,148 @@ def tryPrediction(args: argparse.Namespace,
             subgoals_opened, error, time_taken, unshelved)
 
 
+def tryPredictionInTable(args: argparse.Namespace,
+                         coq: coq_serapy.SerapiInstance,
+                         prediction: str,
+                         previousTime: float,
+                         table: TranspositionTable,
+                         state_key: int) \
+                         -> Tuple[ProofContext, int, int, int,
+                                  Optional[Exception], float, bool]:
+    if table.known_failure(state_key, prediction):
+        return (unwrap(coq.proof_context), 0, 0, 0,
+                CachedFailure(prediction), 0.0, False)
+    with lemma_clock().track("coq"):
+        result = tryPrediction(args, coq, prediction, previousTime)
+    error = result[4]
+    # Timeouts depend on how much time is left on the path, so they don't
+    # say anything about the state itself.
+    if error and not isinstance(error, (coq_serapy.TimeoutError,
+                                        RecursionError)):
+        table.record_failure(state_key, prediction)
+    return result
+
+
+def predictKTacticsInTable(args: argparse.Namespace,
+                           predictor: TacticPredictor,
+                           full_context: FullContext,
+                           table: TranspositionTable,
+                           state_key: int) -> List[Prediction]:
+    predictions = table.predictions(state_key, full_context.prev_tactics,
+                                    args.max_attempts)
+    if predictions is None:
+        with lemma_clock().track("model"):
+            predictions = predictor.predictKTactics(
+                truncate_tactic_context(full_context.as_tcontext(),
+                                        args.max_term_length),
+                args.max_attempts)
+        table.record_predictions(state_key, full_context.prev_tactics,
+                                 args.max_attempts, predictions)
+    return predictions
+
+
+class GoalScorer:
+    """
+    Scores proof states with a pickled lemma difficulty model. Each goal is
+    only parsed and run through the model once per search, and goals that
+    haven't been seen yet are predicted on together.
+    """
+    model: Any
+    _goal_scores: Dict[str, float]
+
+    def __init__(self, model: Any) -> None:
+        self.model = model
+        self._goal_scores = {}
+
+    def needs_sexp_goals(self, context: ProofContext) -> bool:
+        return any(obligation.goal not in self._goal_scores
+                   for obligation in context.all_goals)
+
+    def score(self, states: List[Tuple[ProofContext, Optional[List[Any]]]]) \
+            -> List[float]:
+        new_goals: Dict[str, Any] = {}
+        for context, sexp_goals in states:
+            for idx, obligation in enumerate(context.all_goals):
+                if obligation.goal not in self._goal_scores and \
+                   obligation.goal not in new_goals:
+                    new_goals[obligation.goal] = unwrap(sexp_goals)[idx]
+        if new_goals:
+            lemmas = [Lemma("", sexp_goal) for sexp_goal in new_goals.values()]
+            with lemma_clock().track("model"):
+                try:
+                    if hasattr(self.model, "predict_batch"):
+                        scores = self.model.predict_batch(lemmas)
+                    else:
+                        scores = [float(self.model.predict(lemma))
+                                  for lemma in lemmas]
+                except UnhandledExpr:
+                    # Find the goal the model choked on, so we can report it.
+                    for goal, lemma in zip(new_goals, lemmas):
+                        try:
+                            self.model.predict(lemma)
+                        except UnhandledExpr:
+                            print(f"Goal failed to be handled: {goal}")
+                            raise
+                    raise
+            self._goal_scores.update(zip(new_goals, scores))
+        return [sum(self._goal_scores[obligation.goal]
+                    for obligation in context.all_goals)
+                for context, _ in states]
+
+
+class TacticTrial(NamedTuple):
+    context_after: ProofContext
+    num_stmts: int
+    subgoals_closed: int
+    subgoals_opened: int
+    error: Optional[Exception]
+    time_taken: float
+    unshelved: bool
+    completed: bool
+    prev_tactics: List[str]
+    sexp_goals: Optional[List[Any]]
+
+
+def runTrial(args: argparse.Namespace,
+             coq: coq_serapy.SerapiInstance,
+             prediction: str,
+             previousTime: float,
+             table: TranspositionTable,
+             state_key: int,
+             scorer: Optional[GoalScorer] = None) -> TacticTrial:
+    """
+    Try a prediction, and record everything the search needs to know about
+    the resulting state before cancelling back to where we started. The
+    sexp goals are only fetched for the scorer if it hasn't seen them all.
+    """
+    context_after, num_stmts, subgoals_closed, subgoals_opened, \
+        error, time_taken, unshelved = \
+        tryPredictionInTable(args, coq, prediction, previousTime,
+                             table, state_key)
+    if error:
+        return TacticTrial(context_after, num_stmts, subgoals_closed,
+                           subgoals_opened, error, time_taken, unshelved,
+                           False, [], None)
+    with lemma_clock().track("coq"):
+        completed = completed_proof(coq)
+        prev_tactics = coq.prev_tactics
+        if scorer and not completed and \
+           scorer.needs_sexp_goals(context_after):
+            sexp_goals: Optional[List[Any]] = coq.get_all_sexp_goals()
+        else:
+            sexp_goals = None
+        cancelStatements(coq, num_stmts)
+    return TacticTrial(context_after, num_stmts, subgoals_closed,
+                       subgoals_opened, error, time_taken, unshelved,
+                       completed, prev_tactics, sexp_goals)
+
+
+def cancelStatements(coq: coq_serapy.SerapiInstance, num_stmts: int) -> None:
+    with lemma_clock().track("coq"):
+        for _ in range(num_stmts):
+            coq.cancel_last()
+
+
 goalBignessLimit = 3000
 maxHyps = 32
 
@@ -338,186 +501,204 @@ def dfs_proof_search_with_graph(lemma_name: str,
                                 predictor: TacticPredictor) \
                                 -> SearchResult:
     g = SearchGraph(args.tactics_file, args.tokens_file, lemma_name,
-                    args.features_json)
-
-    def cleanupSearch(num_stmts: int, msg: Optional[str] = None):
-        if msg:
-            eprint(f"Cancelling {num_stmts} statements "
-                   f"because {msg}.", guard=args.verbose >= 2)
-        for _ in range(num_stmts):
-            coq.cancel_last()
-    hasUnexploredNode = False
+                    args.features_json,
+                    SearchGraphLog(graph_log_path(args.search_graphs,
+                                                  output_dir,
+                                                  f"{module_prefix}{lemma_name}"),
+                                   "dfs"))
+    with g.finishing(args.search_graphs):
+
+        def cleanupSearch(num_stmts: int, msg: Optional[str] = None):
+            if msg:
+                eprint(f"Cancelling {num_stmts} statements "
+                       f"because {msg}.", guard=args.verbose >= 2)
+            cancelStatements(coq, num_stmts)
+        hasUnexploredNode = False
+        table = TranspositionTable(not args.no_transposition_table)
+        # Counts the cutoffs which depend on the path taken to a state rather
+        # than the state itself, so we know when a failed subsearch means the
+        # state is dead.
+        num_path_cutoffs = 0
+
+        def search(pbar: tqdm, current_path: List[LabeledNode],
+                   subgoal_distance_stack: List[int],
+                   extra_depth: int) -> SubSearchResult:
+            nonlocal hasUnexploredNode
+            nonlocal relevant_lemmas
+            nonlocal num_path_cutoffs
+            full_context_before = FullContext(relevant_lemmas,
+                                              coq.prev_tactics,
+                                              unwrap(coq.proof_context))
+            state_key = context_key(full_context_before.obligations)
+            predictions = predictKTacticsInTable(args, predictor,
+                                                 full_context_before,
+                                                 table, state_key)
+            assert len(predictions) == args.max_attempts
+            if coq.use_hammer:
+                predictions = [Prediction(prediction.prediction[:-1] + "; try hammer.",
+                                          prediction.certainty)
+                               for prediction in predictions]
+            num_successful_predictions = 0
+            for _prediction_idx, prediction in enumerate(predictions):
+                if num_successful_predictions >= args.search_width:
+                    break
+                try:
+                    context_after, num_stmts, \
+                        subgoals_closed, subgoals_opened, \
+                        error, time_taken, unshelved = \
+                        tryPredictionInTable(args, coq, prediction.prediction,
+                                             time_on_path(current_path[-1]),
+                                             table, state_key)
+                    if error:
+                        if isinstance(error, coq_serapy.TimeoutError):
+                            num_path_cutoffs += 1
+                        if args.count_failing_predictions:
+                            num_successful_predictions += 1
+                        if args.show_failing_predictions:
+                            predictionNode = g.mkNode(prediction,
+                                                      full_context_before,
+                                                      current_path[-1],
+                                                      time_taken)
+                            if isinstance(error, RecursionError):
+                                g.setNodeColor(predictionNode, "grey75")
+                            else:
+                                g.setNodeColor(predictionNode, "red")
+                        continue
+                    num_successful_predictions += 1
+                    pbar.update(1)
+                    assert cast(TqdmSpy, pbar).n > 0
 
-    def search(pbar: tqdm, current_path: List[LabeledNode],
-               subgoal_distance_stack: List[int],
-               extra_depth: int) -> SubSearchResult:
-        nonlocal hasUnexploredNode
-        nonlocal relevant_lemmas
-        global unnamed_goal_number
-        full_context_before = FullContext(relevant_lemmas,
-                                          coq.prev_tactics,
-                                          unwrap(coq.proof_context))
-        predictions = predictor.predictKTactics(
-            truncate_tactic_context(full_context_before.as_tcontext(),
-                                    args.max_term_length),
-                    args.max_attempts)
-        assert len(predictions) == args.max_attempts
-        if coq.use_hammer:
-            predictions = [Prediction(prediction.prediction[:-1] + "; try hammer.",
-                                      prediction.certainty)
-                           for prediction in predictions]
-        num_successful_predictions = 0
-        for _prediction_idx, prediction in enumerate(predictions):
-            if num_successful_predictions >= args.search_width:
-                break
-            try:
-                context_after, num_stmts, \
-                    subgoals_closed, subgoals_opened, \
-                    error, time_taken, unshelved = \
-                    tryPrediction(args, coq, prediction.prediction,
-                                  time_on_path(current_path[-1]))
-                if error:
-                    if args.count_failing_predictions:
-                        num_successful_predictions += 1
-                    if args.show_failing_predictions:
-                        predictionNode = g.mkNode(prediction,
-                                                  full_context_before,
-                                                  current_path[-1])
-                        predictionNode.time_taken = time_taken
-                        if isinstance(error, RecursionError):
-                            g.setNodeColor(predictionNode, "grey75")
-                        else:
-                            g.setNodeColor(predictionNode, "red")
-                    continue
-                num_successful_predictions += 1
-                pbar.update(1)
-                assert cast(TqdmSpy, pbar).n > 0
-
-                predictionNode = g.mkNode(prediction,
-                                          full_context_before,
-                                          current_path[-1])
-                predictionNode.time_taken = time_taken
-                if unshelved:
-                    predictionNode = g.mkNode(Prediction("Unshelve.", 1.0),
+                    predictionNode = g.mkNode(prediction,
                                               full_context_before,
-                                              predictionNode)
-                    predictionNode.time_taken = 0
+                                              current_path[-1],
+                                              time_taken)
+                    if unshelved:
+                        predictionNode = g.mkNode(Prediction("Unshelve.", 1.0),
+                                                  full_context_before,
+                                                  predictionNode, 0.0)
 
-                # ### 1.
-                if subgoal_distance_stack:
-                    new_distance_stack = (subgoal_distance_stack[:-1] +
-                                          [subgoal_distance_stack[-1]+1])
-                else:
-                    new_distance_stack = []
-
-                # ### 2.
-                new_extra_depth = extra_depth
-                for _ in range(subgoals_closed):
-                    closed_goal_distance = new_distance_stack.pop()
-                    new_extra_depth += closed_goal_distance
-
-                # ### 3.
-                new_distance_stack += [0] * subgoals_opened
-
-                #############
-                if completed_proof(coq):
-                    solution = g.mkQED(predictionNode)
-                    return SubSearchResult(solution, subgoals_closed)
-                elif contextInPath(context_after,
-                                   current_path[1:] + [predictionNode]):
-                    if not args.count_softfail_predictions:
-                        num_successful_predictions -= 1
-                    g.setNodeColor(predictionNode, "orange")
-                    cleanupSearch(num_stmts,
-                                  "resulting context is in current path")
-                elif contextIsBig(context_after):
-                    g.setNodeColor(predictionNode, "orange4")
-                    cleanupSearch(num_stmts,
-                                  "resulting context has too big a goal")
-                elif len(current_path) < args.search_depth + new_extra_depth \
-                        and len(current_path) < args.hard_depth_limit:
-                    if subgoals_closed > 0:
-                        g.setNodeColor(predictionNode, "blue")
-                    sub_search_result = search(pbar,
-                                               current_path + [predictionNode],
-                                               new_distance_stack,
-                                               new_extra_depth)
-                    cleanupSearch(num_stmts, "we finished subsearch")
-                    if sub_search_result.solution or \
-                       sub_search_result.solved_subgoals > subgoals_opened:
-                        new_subgoals_closed = \
-                            subgoals_closed + \
-                            sub_search_result.solved_subgoals - \
-                            subgoals_opened
-                        return SubSearchResult(sub_search_result.solution,
-                                               new_subgoals_closed)
-                    if subgoals_closed > 0:
-                        return SubSearchResult(None, subgoals_closed)
-                else:
-                    hasUnexploredNode = True
-                    cleanupSearch(num_stmts, "we hit the depth limit")
-                    if subgoals_closed > 0:
-                        # depth = (args.search_depth + new_extra_depth + 1) \
-                        #     - len(current_path)
-                        return SubSearchResult(None, subgoals_closed)
-            except coq_serapy.CoqAnomaly:
-                predictionNode = g.mkNode(prediction,
-                                          full_context_before,
-                                          current_path[-1])
-                g.setNodeColor(predictionNode, "grey25")
-                if lemma_name == "":
-                    unnamed_goal_number += 1
-                    g.draw(f"{output_dir}/{module_prefix}"
-                           f"{unnamed_goal_number}.svg")
-                else:
+                    # ### 1.
+                    if subgoal_distance_stack:
+                        new_distance_stack = (subgoal_distance_stack[:-1] +
+                                              [subgoal_distance_stack[-1]+1])
+                    else:
+                        new_distance_stack = []
+
+                    # ### 2.
+                    new_extra_depth = extra_depth
+                    for _ in range(subgoals_closed):
+                        closed_goal_distance = new_distance_stack.pop()
+                        new_extra_depth += closed_goal_distance
+
+                    # ### 3.
+                    new_distance_stack += [0] * subgoals_opened
+
+                    #############
+                    key_after = context_key(context_after)
+                    prev_tactics_after = coq.prev_tactics
+                    if completed_proof(coq):
+                        solution = g.mkQED(predictionNode)
+                        return SubSearchResult(solution, subgoals_closed)
+                    elif contextInPath(context_after, predictionNode,
+                                       current_path[0]):
+                        num_path_cutoffs += 1
+                        if not args.count_softfail_predictions:
+                            num_successful_predictions -= 1
+                        g.setNodeColor(predictionNode, "orange")
+                        cleanupSearch(num_stmts,
+                                      "resulting context is in current path")
+                    elif table.is_dead(key_after, prev_tactics_after):
+                        if not args.count_softfail_predictions:
+                            num_successful_predictions -= 1
+                        g.setNodeColor(predictionNode, "orange")
+                        cleanupSearch(num_stmts,
+                                      "resulting context was already searched "
+                                      "exhaustively")
+                    elif contextIsBig(context_after):
+                        g.setNodeColor(predictionNode, "orange4")
+                        cleanupSearch(num_stmts,
+                                      "resulting context has too big a goal")
+                    elif len(current_path) < args.search_depth + new_extra_depth \
+                            and len(current_path) < args.hard_depth_limit:
+                        if subgoals_closed > 0:
+                            g.setNodeColor(predictionNode, "blue")
+                        cutoffs_before = num_path_cutoffs
+                        sub_search_result = search(pbar,
+                                                   current_path + [predictionNode],
+                                                   new_distance_stack,
+                                                   new_extra_depth)
+                        cleanupSearch(num_stmts, "we finished subsearch")
+                        if sub_search_result.solution is None and \
+                           sub_search_result.solved_subgoals == 0 and \
+                           num_path_cutoffs == cutoffs_before:
+                            table.mark_dead(key_after, prev_tactics_after)
+                        if sub_search_result.solution or \
+                           sub_search_result.solved_subgoals > subgoals_opened:
+                            new_subgoals_closed = \
+                                subgoals_closed + \
+                                sub_search_result.solved_subgoals - \
+                                subgoals_opened
+                            return SubSearchResult(sub_search_result.solution,
+                                                   new_subgoals_closed)
+                        if subgoals_closed > 0:
+                            return SubSearchResult(None, subgoals_closed)
+                    else:
+                        hasUnexploredNode = True
+                        num_path_cutoffs += 1
+                        cleanupSearch(num_stmts, "we hit the depth limit")
+                        if subgoals_closed > 0:
+                            # depth = (args.search_depth + new_extra_depth + 1) \
+                            #     - len(current_path)
+                            return SubSearchResult(None, subgoals_closed)
+                except coq_serapy.CoqAnomaly:
+                    predictionNode = g.mkNode(prediction,
+                                              full_context_before,
+                                              current_path[-1])
+                    g.setNodeColor(predictionNode, "grey25")
                     if args.features_json:
                         g.write_feat_json(f"{output_dir}/{module_prefix}"
                                           f"{lemma_name}.json")
-                    g.draw(f"{output_dir}/{module_prefix}"
-                           f"{lemma_name}.svg")
-
-                raise
-        return SubSearchResult(None, 0)
-    total_nodes = numNodesInTree(args.search_width,
-                                 args.search_depth + 2) - 1
-    desc_name = lemma_name
-    if len(desc_name) > 25:
-        desc_name = desc_name[:22] + "..."
-    if coq.count_fg_goals() > 1:
-        coq.run_stmt("{")
-        subgoals_stack_start = [0]
-    else:
-        subgoals_stack_start = []
-
-    with TqdmSpy(total=total_nodes, unit="pred", file=sys.stdout,
-                 desc=desc_name, disable=(not args.progress),
-                 leave=False,
-                 position=bar_idx + 1,
-                 dynamic_ncols=True, bar_format=mybarfmt) as pbar:
-        if args.search_prefix is None:
-            command_list, _ = search(pbar, [g.start_node], subgoals_stack_start, 0)
+
+                    raise
+            return SubSearchResult(None, 0)
+        total_nodes = numNodesInTree(args.search_width,
+                                     args.search_depth + 2) - 1
+        desc_name = lemma_name
+        if len(desc_name) > 25:
+            desc_name = desc_name[:22] + "..."
+        if coq.count_fg_goals() > 1:
+            coq.run_stmt("{")
+            subgoals_stack_start = [0]
         else:
-            next_node = g.start_node
-            for command in coq_serapy.read_commands(args.search_prefix):
-                full_context_before = FullContext(relevant_lemmas,
-                                                  coq.prev_tactics,
-                                                  unwrap(coq.proof_context))
-                next_node = g.mkNode(Prediction(command, 1.0),
-                                     full_context_before,
-                                     next_node)
-                next_node.time_taken = 0.0
-                coq.run_stmt(command)
-            command_list, _ = search(pbar, [next_node], subgoals_stack_start, 0)
-        pbar.clear()
-    g.draw(f"{output_dir}/{module_prefix}{lemma_name}.svg")
-    if args.features_json:
-        g.write_feat_json(f"{output_dir}/{module_prefix}"
-                          f"{lemma_name}.json")
-    if command_list:
-        return SearchResult(SearchStatus.SUCCESS, command_list)
-    if hasUnexploredNode:
-        return SearchResult(SearchStatus.INCOMPLETE, None)
-    return SearchResult(SearchStatus.FAILURE, None)
+            subgoals_stack_start = []
+
+        with TqdmSpy(total=total_nodes, unit="pred", file=sys.stdout,
+                     desc=desc_name, disable=(not args.progress),
+                     leave=False,
+                     position=bar_idx + 1,
+                     dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+            if args.search_prefix is None:
+                command_list, _ = search(pbar, [g.start_node], subgoals_stack_start, 0)
+            else:
+                next_node = g.start_node
+                for command in coq_serapy.read_commands(args.search_prefix):
+                    full_context_before = FullContext(relevant_lemmas,
+                                                      coq.prev_tactics,
+                                                      unwrap(coq.proof_context))
+                    next_node = g.mkNode(Prediction(command, 1.0),
+                                         full_context_before,
+                                         next_node, 0.0)
+                    coq.run_stmt(command)
+                command_list, _ = search(pbar, [next_node], subgoals_stack_start, 0)
+            pbar.clear()
+        if args.features_json:
+            g.write_feat_json(f"{output_dir}/{module_prefix}"
+                              f"{lemma_name}.json")
+        if command_list:
+            return SearchResult(SearchStatus.SUCCESS, command_list)
+        if hasUnexploredNode:
+            return SearchResult(SearchStatus.INCOMPLETE, None)
+        return SearchResult(SearchStatus.FAILURE, None)
 
 
 def completed_proof(coq: coq_serapy.SerapiInstance) -> bool:
@@ -537,10 +718,14 @@ class BFSNode:
     previous: Optional["BFSNode"]
     children: List["BFSNode"]
     color: Optional[str]
+    ancestor_goal_mask: int
+    graph_log: Optional[SearchGraphLog]
+    node_id: int
 
     def __init__(self, prediction: Prediction, score: float, time_taken: float,
                  postfix: List[str], context_before: FullContext, previous: Optional["BFSNode"],
-                 color: Optional[str] = None) -> None:
+                 color: Optional[str] = None,
+                 graph_log: Optional[SearchGraphLog] = None) -> None:
         self.prediction = prediction
         self.score = score
         self.time_taken = time_taken
@@ -548,10 +733,21 @@ class BFSNode:
         self.context_before = context_before
         self.previous = previous
         self.children = []
+        self.ancestor_goal_mask = contextFingerprint(context_before.obligations)
         if self.previous:
             self.previous.children.append(self)
-        self.color = color
-        pass
+            self.ancestor_goal_mask |= self.previous.ancestor_goal_mask
+            graph_log = self.previous.graph_log
+        # Nodes are written to the search graph log as they're made, rather
+        # than kept around in a graph to draw at the end.
+        self.graph_log = graph_log
+        if graph_log:
+            self.node_id = graph_log.add_node(
+                self.previous.node_id if self.previous else None,
+                prediction.prediction, score, time_taken, context_before)
+        self.color = None
+        if color:
+            self.setNodeColor(color)
 
     def setNodeColor(self, color: str) -> None:
         assert color
@@ -559,6 +755,13 @@ class BFSNode:
             self.color = (unwrap(self.color) + ":" + color)
         else:
             self.color = color
+        if self.graph_log:
+            self.graph_log.set_color(self.node_id, color)
+
+    def setScore(self, score: float) -> None:
+        self.score = score
+        if self.graph_log:
+            self.graph_log.set_score(self.node_id, score)
 
     def mkQED(self) -> None:
         qed_node = BFSNode(Prediction("QED", 1.0), 100, 0, [],
@@ -570,40 +773,6 @@ class BFSNode:
             cur_node.setNodeColor("palegreen1")
             cur_node = unwrap(cur_node.previous)
 
-    def draw_graph(self, path: str) -> None:
-        graph = pgv.AGraph(directed=True)
-        next_node_id = 0
-        def add_subgraph(root: "BFSNode") -> int:
-            nonlocal graph
-            nonlocal next_node_id
-            label=f"{root.prediction.prediction}\n{root.score:.2e}"
-            if root.color:
-                fillcolor = root.color
-                style="filled"
-            else:
-                fillcolor = "lightgrey"
-                style=""
-
-            tooltip = ""
-            for hyp in root.context_before.obligations.focused_hyps:
-                tooltip += hyp[:64] + "&#10;"
-            tooltip += "-" * 64 + "&#10;"
-            tooltip += root.context_before.obligations.focused_goal[:64]
-
-
-            graph.add_node(next_node_id, label=label, fillcolor=fillcolor, style=style,
-                           tooltip=tooltip)
-
-            root_node_id = next_node_id
-            next_node_id += 1
-            for child in root.children:
-                child_id = add_subgraph(child)
-                graph.add_edge(root_node_id, child_id)
-            return root_node_id
-        add_subgraph(self)
-        with nostderr():
-            graph.draw(path, prog="dot")
-
     def pp(self) -> str:
         if not self.previous:
             return f" -> {self.prediction.prediction}"
@@ -622,37 +791,54 @@ class BFSNode:
                    self.path())
 
     def path(self) -> List['BFSNode']:
-        if self.previous is None:
-            return [self]
-        else:
-            return self.previous.path() + [self]
+        nodes = []
+        cur_node: Optional[BFSNode] = self
+        while cur_node is not None:
+            nodes.append(cur_node)
+            cur_node = cur_node.previous
+        nodes.reverse()
+        return nodes
 
     def traverse_to(self, coq: coq_serapy.SerapiInstance, initial_history_len: int) -> None:
-        # Get both the current and target histories
-        full_cur_history = coq.tactic_history.getFullHistory()[initial_history_len:]
-        full_node_history = [item for replay_node in self.path()[1:]
-                             for item in [replay_node.prediction.prediction] + replay_node.postfix]
-        # Get the number of commands common to the beginning of the current
-        # history and the history of the target node
-        common_prefix_len = 0
-        for item1, item2, in zip(full_node_history, full_cur_history):
-            if item1 != item2:
-                break
-            common_prefix_len += 1
+        traverse_to_history(coq, initial_history_len, node_history(self))
+
+
+def node_history(node: BFSNode) -> List[str]:
+    return [item for replay_node in node.path()[1:]
+            for item in [replay_node.prediction.prediction] + replay_node.postfix]
+
+
+def traverse_to_history(coq: coq_serapy.SerapiInstance,
+                        initial_history_len: int,
+                        full_node_history: List[str]) -> None:
+    full_cur_history = coq.tactic_history.getFullHistory()[initial_history_len:]
+    # Get the number of commands common to the beginning of the current
+    # history and the history of the target node
+    common_prefix_len = 0
+    for item1, item2, in zip(full_node_history, full_cur_history):
+        if item1 != item2:
+            break
+        common_prefix_len += 1
+    with lemma_clock().track("coq"):
         # Return to the place where the current history and the history of
         # the target node diverged.
-        while len(coq.tactic_history.getFullHistory()) > initial_history_len + common_prefix_len:
+        for _ in range(len(full_cur_history) - common_prefix_len):
             coq.cancel_last()
         # Run the next nodes history from that point.
         for cmd in full_node_history[common_prefix_len:]:
             coq.run_stmt(cmd)
-        return
 
 
-def contextInHistory(full_context: ProofContext, node: BFSNode):
-    return any([coq_serapy.contextSurjective(full_context,
-                                                  n.context_before.obligations)
-                for n in node.path()[1:]])
+def contextInHistory(full_context: ProofContext, node: BFSNode) -> bool:
+    if not contextMayBeInMask(full_context, node.ancestor_goal_mask):
+        return False
+    cur_node = node
+    while cur_node.previous is not None:
+        if coq_serapy.contextSurjective(full_context,
+                                        cur_node.context_before.obligations):
+            return True
+        cur_node = cur_node.previous
+    return False
 
 def get_leaf_descendents(node: BFSNode) -> List[BFSNode]:
     if len(node.children) == 0:
@@ -682,182 +868,202 @@ def bfs_beam_proof_search(lemma_name: str,
                           predictor: TacticPredictor) \
                           -> SearchResult:
     hasUnexploredNode = False
-    graph_file = f"{args.output_dir}/{module_prefix}{lemma_name}.svg"
-
-    features_extractor = FeaturesExtractor(args.tactics_file, args.tokens_file)
-    if args.scoring_function == "lstd":
-        state_estimator = Estimator(args.beta_file)
-    elif args.scoring_function == "pickled":
-        with args.pickled_estimator.open('rb') as f:
-            john_model = pickle.load(f)
-
-    initial_history_len = len(coq.tactic_history.getFullHistory())
-    start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
-                         FullContext([], [],
-                                     ProofContext([], [], [], [])), None)
-    search_start_node = start_node
-    if args.search_prefix:
-        for command in coq_serapy.read_commands(args.search_prefix):
-            full_context_before = FullContext(relevant_lemmas,
-                                              coq.prev_tactics,
-                                              unwrap(coq.proof_context))
-            search_start_node = BFSNode(Prediction(command, 1.0), 1.0, 0.0, [],
-                                 full_context_before, search_start_node)
-    if coq.count_fg_goals() > 1:
-        coq.run_stmt("{")
-        subgoals_stack_start = [0]
-    else:
-        subgoals_stack_start = []
-    nodes_todo: List[Tuple[BFSNode, List[int], int]] = \
-        [(search_start_node, subgoals_stack_start, 0)]
-
-    total_nodes = numNodesInTree(args.search_width,
-                                 args.search_depth + 2) - 1
-    with tqdm(total=total_nodes, unit="pred", file=sys.stdout,
-              desc=lemma_name, disable=(not args.progress),
-              leave=False,
-              position=bar_idx + 1,
-              dynamic_ncols=True, bar_format=mybarfmt) as pbar:
-        while len(nodes_todo) > 0:
-            next_nodes_todo: List[Tuple[BFSNode, List[int], int]] = []
-            while len(nodes_todo) > 0:
-                next_node, subgoal_distance_stack, extra_depth = nodes_todo.pop()
-                pbar.update()
-                next_node.traverse_to(coq, initial_history_len)
-
+    graph_log = SearchGraphLog(graph_log_path(args.search_graphs,
+                                              Path(args.output_dir),
+                                              f"{module_prefix}{lemma_name}"),
+                               "bfs")
+    with graph_log.finishing(args.search_graphs):
+
+        features_extractor = FeaturesExtractor(args.tactics_file, args.tokens_file)
+        if args.scoring_function == "lstd":
+            state_estimator = Estimator(args.beta_file)
+        elif args.scoring_function == "pickled":
+            assert sys.version_info >= (3, 10), "Pickled estimators only supported in python 3.10 or newer"
+            with args.pickled_estimator.open('rb') as f:
+                scorer = GoalScorer(pickle.load(f))
+
+        initial_history_len = len(coq.tactic_history.getFullHistory())
+        table = TranspositionTable(not args.no_transposition_table)
+        start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
+                             FullContext([], [],
+                                         ProofContext([], [], [], [])), None,
+                             graph_log=graph_log)
+        search_start_node = start_node
+        if args.search_prefix:
+            for command in coq_serapy.read_commands(args.search_prefix):
                 full_context_before = FullContext(relevant_lemmas,
                                                   coq.prev_tactics,
                                                   unwrap(coq.proof_context))
-                num_successful_predictions = 0
-                predictions = predictor.predictKTactics(
-                    truncate_tactic_context(full_context_before.as_tcontext(),
-                                            args.max_term_length),
-                            args.max_attempts)
-                for prediction in predictions:
-                    if num_successful_predictions >= args.search_width:
-                        break
-                    context_after, num_stmts, \
-                        subgoals_closed, subgoals_opened, \
-                        error, time_taken, unshelved = \
-                        tryPrediction(args, coq, prediction.prediction,
-                                      next_node.total_time())
-
-                    postfix = []
-                    if unshelved:
-                        postfix.append("Unshelve.")
-                    postfix += ["}"] * subgoals_closed
-                    postfix += ["{"] * subgoals_opened
-
-
-                    prediction_node = BFSNode(
-                        prediction,
-                        0,
-                        time_taken, postfix, full_context_before, next_node)
-                    if error:
-                        if args.count_failing_predictions:
-                            num_successful_predictions += 1
-                        prediction_node.setNodeColor("red")
-                        continue
-                    if contextIsBig(context_after) or \
-                            contextInHistory(context_after, prediction_node):
-                        if args.count_softfail_predictions:
-                            num_successful_predictions += 1
-                        eprint(f"Prediction in history or too big", guard=args.verbose >= 2)
-                        prediction_node.setNodeColor("orange")
-                        for _ in range(num_stmts):
-                            coq.cancel_last()
-                        continue
-                    if len(coq.proof_context.all_goals) > args.max_subgoals:
-                        if args.count_softfail_predictions:
-                            num_successful_predictions += 1
-                        prediction_node.setNodeColor("orange")
-                        for _ in range(num_stmts):
-                            coq.cancel_last()
-                        continue
-                    if completed_proof(coq):
-                        prediction_node.mkQED()
-                        start_node.draw_graph(graph_file)
-                        return SearchResult(SearchStatus.SUCCESS,
-                                            prediction_node.interactions()[1:])
-
-                    if args.scoring_function == "certainty":
-                        prediction_node.score = next_node.score * prediction.certainty
-                    elif args.scoring_function == "pickled":
-                        assert sys.version_info >= (3, 10), "Pickled estimators only supported in python 3.10 or newer"
-                        score = 0.
-                        for idx, goal in enumerate(coq.get_all_sexp_goals()):
-                            try:
-                                score += -float(john_model.predict(Lemma("", goal)))
-                            except UnhandledExpr:
-                                print(f"Couldn't handle goal {coq.proof_context.all_goals[idx]}")
-                                raise
-                        prediction_node.score = score
-                    elif args.scoring_function == "const":
-                        prediction_node.score = 1.0
-                    else:
-                        assert args.scoring_function == "lstd"
-                        prediction_node.score = state_estimator.estimateVal(
-                                          features_extractor.state_features(
-                                              TacticContext(full_context_before.relevant_lemmas,
-                                                            full_context_before.prev_tactics,
-                                                            context_after.focused_hyps,
-                                                            context_after.focused_goal)))
-
-                    num_successful_predictions += 1
+                search_start_node = BFSNode(Prediction(command, 1.0), 1.0, 0.0, [],
+                                     full_context_before, search_start_node)
+        if coq.count_fg_goals() > 1:
+            coq.run_stmt("{")
+            subgoals_stack_start = [0]
+        else:
+            subgoals_stack_start = []
+        nodes_todo: List[Tuple[BFSNode, List[int], int]] = \
+            [(search_start_node, subgoals_stack_start, 0)]
+
+        total_nodes = numNodesInTree(args.search_width,
+                                     args.search_depth + 2) - 1
+        with tqdm(total=total_nodes, unit="pred", file=sys.stdout,
+                  desc=lemma_name, disable=(not args.progress),
+                  leave=False,
+                  position=bar_idx + 1,
+                  dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+            while len(nodes_todo) > 0:
+                next_nodes_todo: List[Tuple[BFSNode, List[int], int]] = []
+                while len(nodes_todo) > 0:
+                    next_node, subgoal_distance_stack, extra_depth = nodes_todo.pop()
+                    pbar.update()
+                    next_node.traverse_to(coq, initial_history_len)
+
+                    full_context_before = FullContext(relevant_lemmas,
+                                                      coq.prev_tactics,
+                                                      unwrap(coq.proof_context))
+                    state_key = context_key(full_context_before.obligations)
+                    num_successful_predictions = 0
+                    predictions = predictKTacticsInTable(args, predictor,
+                                                         full_context_before,
+                                                         table, state_key)
+                    # Children waiting on the pickled scorer, which scores all
+                    # the children of a node at once.
+                    unscored_children: List[Tuple[BFSNode, ProofContext,
+                                                  Optional[List[Any]]]] = []
+                    for prediction in predictions:
+                        if num_successful_predictions >= args.search_width:
+                            break
+                        context_after, num_stmts, \
+                            subgoals_closed, subgoals_opened, \
+                            error, time_taken, unshelved = \
+                            tryPredictionInTable(args, coq, prediction.prediction,
+                                                 next_node.total_time(),
+                                                 table, state_key)
+
+                        postfix = []
+                        if unshelved:
+                            postfix.append("Unshelve.")
+                        postfix += ["}"] * subgoals_closed
+                        postfix += ["{"] * subgoals_opened
+
+
+                        prediction_node = BFSNode(
+                            prediction,
+                            0,
+                            time_taken, postfix, full_context_before, next_node)
+                        if error:
+                            if args.count_failing_predictions:
+                                num_successful_predictions += 1
+                            prediction_node.setNodeColor("red")
+                            continue
+                        if contextIsBig(context_after) or \
+                                contextInHistory(context_after, prediction_node) or \
+                                table.is_dead(context_key(context_after),
+                                              coq.prev_tactics) or \
+                                not table.visit(context_key(context_after),
+                                                len(prediction_node.path())):
+                            if args.count_softfail_predictions:
+                                num_successful_predictions += 1
+                            eprint(f"Prediction in history, too big, "
+                                   "or already explored", guard=args.verbose >= 2)
+                            prediction_node.setNodeColor("orange")
+                            cancelStatements(coq, num_stmts)
+                            continue
+                        if len(coq.proof_context.all_goals) > args.max_subgoals:
+                            if args.count_softfail_predictions:
+                                num_successful_predictions += 1
+                            prediction_node.setNodeColor("orange")
+                            cancelStatements(coq, num_stmts)
+                            continue
+                        if completed_proof(coq):
+                            prediction_node.mkQED()
+                            return SearchResult(SearchStatus.SUCCESS,
+                                                prediction_node.interactions()[1:])
+
+                        if args.scoring_function == "certainty":
+                            prediction_node.setScore(next_node.score * prediction.certainty)
+                        elif args.scoring_function == "pickled":
+                            if scorer.needs_sexp_goals(context_after):
+                                with lemma_clock().track("coq"):
+                                    sexp_goals: Optional[List[Any]] = \
+                                        coq.get_all_sexp_goals()
+                            else:
+                                sexp_goals = None
+                            unscored_children.append((prediction_node,
+                                                      context_after, sexp_goals))
+                        elif args.scoring_function == "const":
+                            prediction_node.setScore(1.0)
+                        else:
+                            assert args.scoring_function == "lstd"
+                            prediction_node.setScore(state_estimator.estimateVal(
+                                              features_extractor.state_features(
+                                                  TacticContext(full_context_before.relevant_lemmas,
+                                                                full_context_before.prev_tactics,
+                                                                context_after.focused_hyps,
+                                                                context_after.focused_goal))))
 
-                    if subgoals_closed > 0:
-                        prediction_node.setNodeColor("blue")
-                        # Prune unexplored nodes from the tree that are trying to
-                        # solve the subgoal(s) we just solved.
-                        prunable_nodes = get_prunable_nodes(prediction_node)
-                        # Prune them from nodes_todo, which are nodes at the
-                        # current level which we haven't explored yet.
-                        nodes_todo = [node for node in nodes_todo if node[0] not in prunable_nodes]
-                        # Prune them from next_nodes_todo, which are new children
-                        # of nodes at the current level which we already explored.
-                        next_nodes_todo = [node for node in next_nodes_todo if node[0] not in prunable_nodes]
+                        num_successful_predictions += 1
 
-                    # ### 1.
-                    if subgoal_distance_stack:
-                        new_distance_stack = (subgoal_distance_stack[:-1] +
-                                              [subgoal_distance_stack[-1]+1])
+                        if subgoals_closed > 0:
+                            prediction_node.setNodeColor("blue")
+                            # Prune unexplored nodes from the tree that are trying to
+                            # solve the subgoal(s) we just solved.
+                            prunable_nodes = get_prunable_nodes(prediction_node)
+                            # Prune them from nodes_todo, which are nodes at the
+                            # current level which we haven't explored yet.
+                            nodes_todo = [node for node in nodes_todo if node[0] not in prunable_nodes]
+                            # Prune them from next_nodes_todo, which are new children
+                            # of nodes at the current level which we already explored.
+                            next_nodes_todo = [node for node in next_nodes_todo if node[0] not in prunable_nodes]
+
+                        # ### 1.
+                        if subgoal_distance_stack:
+                            new_distance_stack = (subgoal_distance_stack[:-1] +
+                                                  [subgoal_distance_stack[-1]+1])
+                        else:
+                            new_distance_stack = []
+
+                        # ### 2.
+                        new_extra_depth = extra_depth
+                        for _ in range(subgoals_closed):
+                            closed_goal_distance = new_distance_stack.pop()
+                            new_extra_depth += closed_goal_distance
+
+                        # ### 3.
+                        new_distance_stack += [0] * subgoals_opened
+
+                        next_nodes_todo.append((prediction_node, new_distance_stack,
+                                                new_extra_depth))
+
+                        cancelStatements(coq, num_stmts)
+                        if subgoals_closed > 0:
+                            break
+                    if unscored_children:
+                        scores = scorer.score([(context, sexp_goals) for
+                                               _, context, sexp_goals
+                                               in unscored_children])
+                        for (child, _, _), score in zip(unscored_children, scores):
+                            child.setScore(-score)
+                next_nodes_todo.sort(key=lambda n: n[0].score, reverse=True)
+                while len(nodes_todo) < args.beam_width and len(next_nodes_todo) > 0:
+                    next_node, subgoal_distance_stack, extra_depth = next_nodes_todo.pop(0)
+                    if len(next_node.path()) <= args.search_depth + extra_depth:
+                        nodes_todo.append((next_node, subgoal_distance_stack, extra_depth))
                     else:
-                        new_distance_stack = []
-
-                    # ### 2.
-                    new_extra_depth = extra_depth
-                    for _ in range(subgoals_closed):
-                        closed_goal_distance = new_distance_stack.pop()
-                        new_extra_depth += closed_goal_distance
-
-                    # ### 3.
-                    new_distance_stack += [0] * subgoals_opened
-
-                    next_nodes_todo.append((prediction_node, new_distance_stack,
-                                            new_extra_depth))
-
-                    for _ in range(num_stmts):
-                        coq.cancel_last()
-                    if subgoals_closed > 0:
-                        break
-            next_nodes_todo.sort(key=lambda n: n[0].score, reverse=True)
-            while len(nodes_todo) < args.beam_width and len(next_nodes_todo) > 0:
-                next_node, subgoal_distance_stack, extra_depth = next_nodes_todo.pop(0)
-                if len(next_node.path()) <= args.search_depth + extra_depth:
-                    nodes_todo.append((next_node, subgoal_distance_stack, extra_depth))
-                else:
-                    hasUnexploredNode = True
+                        hasUnexploredNode = True
 
-    start_node.draw_graph(graph_file)
-    if hasUnexploredNode:
-        return SearchResult(SearchStatus.INCOMPLETE, None)
-    else:
-        return SearchResult(SearchStatus.FAILURE, None)
+        if hasUnexploredNode:
+            return SearchResult(SearchStatus.INCOMPLETE, None)
+        else:
+            return SearchResult(SearchStatus.FAILURE, None)
 
 @dataclass(order=True)
 class AStarTask:
     f_score: float
     node: BFSNode=field(compare=False)
+    # The context at the end of the node, if we already know it. This lets us
+    # predict on frontier nodes without traversing to them first.
+    context: Optional[FullContext]=field(default=None, compare=False)
 
 
 def best_first_proof_search(lemma_name: str,
@@ -866,144 +1072,237 @@ def best_first_proof_search(lemma_name: str,
                        coq: coq_serapy.SerapiInstance,
                        args: argparse.Namespace,
                        bar_idx: int,
-                       predictor: TacticPredictor) \
+                       predictor: TacticPredictor,
+                       pool: Optional["TacticPool"] = None) \
                        -> SearchResult:
     assert args.scoring_function in ["pickled", "const"] or args.search_type != "astar", "only pickled and const scorers are currently compatible with A* search"
+    scorer: Optional[GoalScorer] = None
     if args.scoring_function == "pickled":
+        assert sys.version_info >= (3, 10), "Pickled estimators only supported in python 3.10 or newer"
         with args.pickled_estimator.open('rb') as f:
-            john_model = pickle.load(f)
-    graph_file = f"{args.output_dir}/{module_prefix}{lemma_name}.svg"
-    initial_history_len = len(coq.tactic_history.getFullHistory())
-    start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
-                         FullContext([], [],
-                                     ProofContext([], [], [], [])), None)
-    search_start_node = start_node
-    if args.search_prefix:
-        for command in coq_serapy.read_commands(args.search_prefix):
-            full_context_before = FullContext(relevant_lemmas,
-                                              coq.prev_tactics,
-                                              unwrap(coq.proof_context))
-            search_start_node = BFSNode(Prediction(command, 1.0), 1.0, 0.0, [],
-                                        full_context_before, search_start_node)
-    nodes_todo: List[AStarTask] = [AStarTask(1.0, search_start_node)]
-
-    desc_name = lemma_name
-    if len(desc_name) > 25:
-        desc_name = desc_name[:22] + "..."
-    for _step in trange(args.astar_steps, unit="pred", file=sys.stdout,
-                       desc=desc_name, disable=(not args.progress),
-                       leave=False, position=bar_idx + 1,
-                       dynamic_ncols=True, bar_format=mybarfmt):
-        if len(nodes_todo) == 0:
-            break
-        next_node = heapq.heappop(nodes_todo)
-        next_node.node.traverse_to(coq, initial_history_len)
-
-        full_context_before = FullContext(relevant_lemmas,
-                                          coq.prev_tactics,
-                                          unwrap(coq.proof_context))
-        num_successful_predictions = 0
-        predictions = predictor.predictKTactics(
-            truncate_tactic_context(full_context_before.as_tcontext(),
-                                    args.max_term_length),
-            args.max_attempts)
-
-        for prediction in predictions:
-            if num_successful_predictions >= args.search_width:
-                break
-            context_after, num_stmts, \
-                subgoals_closed, subgoals_opened, \
-                error, time_taken, unshelved = \
-                tryPrediction(args, coq, prediction.prediction,
-                             next_node.node.total_time())
-
-            postfix = []
-            if unshelved:
-                postfix.append("Unshelve.")
-            postfix += ["}"] * subgoals_closed
-            postfix += ["{"] * subgoals_opened
-
-            prediction_node = BFSNode(
-                prediction,
-                0,
-                time_taken, postfix, full_context_before, next_node.node)
-            if error:
-                if args.count_failing_predictions:
-                    num_successful_predictions += 1
-                prediction_node.setNodeColor("red")
-                continue
-            else:
-                num_successful_predictions += 1
-            # Check if we've gone in circles
-            if contextInHistory(context_after, prediction_node):
-                if args.count_softfail_predictions:
-                    num_successful_predictions += 1
-                eprint(f"Prediction in history", guard=args.verbose >= 2)
-                prediction_node.setNodeColor("orange")
-                for _ in range(num_stmts):
-                    coq.cancel_last()
-                continue
-            # Check if the resulting context is too big
-            if len(coq.proof_context.all_goals) > args.max_subgoals or \
-              contextIsBig(context_after):
-                if args.count_softfail_predictions:
-                    num_successful_predictions += 1
-                prediction_node.setNodeColor("orange")
-                for _ in range(num_stmts):
-                    coq.cancel_last()
-                continue
-            # Check if the proof is done
-            if completed_proof(coq):
-                prediction_node.mkQED()
-                start_node.draw_graph(graph_file)
-                return SearchResult(SearchStatus.SUCCESS,
-                                    prediction_node.interactions()[1:])
-            if args.scoring_function == "const":
-                h_score = 1.
-            elif args.scoring_function == "certainty":
-                h_score = -abs(next_node.f_score * prediction.certainty)
-            elif args.scoring_function == "norm-certainty":
-                h_score = -math.sqrt(abs(next_node.f_score * prediction.certainty))
-            else:
-                assert args.scoring_function == "pickled"
-                h_score = 0.
-                for idx, goal in enumerate(coq.get_all_sexp_goals()):
-                    try:
-                        h_score += john_model.predict(Lemma("", goal))
-                    except UnhandledExpr:
-                        print(f"Goal failed to be handled: {coq.proof_context.all_goals[idx]}")
-                        raise
-            if args.search_type == "astar":
-                # Calculate the A* f_score
-                g_score = len(prediction_node.path())
-                score = g_score + h_score
-            else:
-                score = h_score
-
-            prediction_node.score = score
-
-            # Put our new prediction node in our priority queue
-            heapq.heappush(nodes_todo, AStarTask(score, prediction_node))
-            # Return us to before running the prediction, so we're ready for
-            # the next one.
-            for _ in range(num_stmts):
-                coq.cancel_last()
-            # If we solved the subgoal...
-            if subgoals_closed > 0:
-                prediction_node.setNodeColor("blue")
-                # Get unexplored nodes from the tree that are trying to
-                # solve the subgoal(s) we just solved.
-                prunable_nodes = get_prunable_nodes(prediction_node)
-                # Prune them from the frontier nodes
-                nodes_todo = [node for node in nodes_todo
-                              if node.node not in prunable_nodes]
-                heapq.heapify(nodes_todo)
-                # Don't run the rest of the predictions at this state
-                break
-
-    hasUnexploredNode = len(nodes_todo) > 0
-    start_node.draw_graph(graph_file)
-    if hasUnexploredNode:
-        return SearchResult(SearchStatus.INCOMPLETE, None)
-    else:
-        return SearchResult(SearchStatus.FAILURE, None)
+            scorer = GoalScorer(pickle.load(f))
+    graph_log = SearchGraphLog(graph_log_path(args.search_graphs,
+                                              Path(args.output_dir),
+                                              f"{module_prefix}{lemma_name}"),
+                               "bfs")
+    with graph_log.finishing(args.search_graphs):
+        initial_history_len = len(coq.tactic_history.getFullHistory())
+        table = TranspositionTable(not args.no_transposition_table)
+        start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
+                             FullContext([], [],
+                                         ProofContext([], [], [], [])), None,
+                             graph_log=graph_log)
+        search_start_node = start_node
+        if args.search_prefix:
+            for command in coq_serapy.read_commands(args.search_prefix):
+                full_context_before = FullContext(relevant_lemmas,
+                                                  coq.prev_tactics,
+                                                  unwrap(coq.proof_context))
+                search_start_node = BFSNode(Prediction(command, 1.0), 1.0, 0.0, [],
+                                            full_context_before, search_start_node)
+        nodes_todo: List[AStarTask] = [AStarTask(1.0, search_start_node)]
+
+        desc_name = lemma_name
+        if len(desc_name) > 25:
+            desc_name = desc_name[:22] + "..."
+        num_steps_taken = 0
+        with tqdm(total=args.astar_steps, unit="pred", file=sys.stdout,
+                  desc=desc_name, disable=(not args.progress),
+                  leave=False, position=bar_idx + 1,
+                  dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+            while num_steps_taken < args.astar_steps and len(nodes_todo) > 0:
+                # Pop up to frontier-batch-size nodes, and predict on all of
+                # them at once, so that the model overhead is paid once per
+                # batch.
+                batch = [heapq.heappop(nodes_todo) for _ in
+                         range(min(args.frontier_batch_size, len(nodes_todo),
+                                   args.astar_steps - num_steps_taken))]
+                num_steps_taken += len(batch)
+                pbar.update(len(batch))
+                # Visit the batch in history order, so consecutive traversals
+                # share as long a prefix as possible.
+                batch.sort(key=lambda task: node_history(task.node))
+                for task in batch:
+                    if task.context is None:
+                        task.node.traverse_to(coq, initial_history_len)
+                        task.context = FullContext(relevant_lemmas,
+                                                   coq.prev_tactics,
+                                                   unwrap(coq.proof_context))
+                state_keys = [context_key(unwrap(task.context).obligations)
+                              for task in batch]
+                predictions_batch = [table.predictions(
+                    state_key, unwrap(task.context).prev_tactics,
+                    args.max_attempts)
+                                     for state_key, task in zip(state_keys, batch)]
+                # Only run the predictor on states we haven't predicted on yet.
+                missing_idxs = [idx for idx, predictions
+                                in enumerate(predictions_batch)
+                                if predictions is None]
+                truncated_contexts = [truncate_tactic_context(
+                    unwrap(batch[idx].context).as_tcontext(), args.max_term_length)
+                                      for idx in missing_idxs]
+                with lemma_clock().track("model"):
+                    if len(missing_idxs) == 1:
+                        new_predictions = [predictor.predictKTactics(
+                            truncated_contexts[0], args.max_attempts)]
+                    elif len(missing_idxs) > 1:
+                        new_predictions = predictor.predictKTactics_batch(
+                            truncated_contexts, args.max_attempts)
+                    else:
+                        new_predictions = []
+                for idx, predictions in zip(missing_idxs, new_predictions):
+                    predictions_batch[idx] = predictions
+                    table.record_predictions(
+                        state_keys[idx], unwrap(batch[idx].context).prev_tactics,
+                        args.max_attempts, predictions)
+
+                pruned_nodes: List[BFSNode] = []
+                for next_node, state_key, predictions in \
+                        zip(batch, state_keys, predictions_batch):
+                    # A node earlier in the batch might have solved the subgoal
+                    # this node was working on.
+                    if next_node.node in pruned_nodes:
+                        continue
+                    next_node.node.traverse_to(coq, initial_history_len)
+                    full_context_before = unwrap(next_node.context)
+                    num_successful_predictions = 0
+
+                    remaining_predictions = list(unwrap(predictions))
+                    solved_subgoal = False
+                    # Surviving children, with their heuristic scores if they
+                    # don't need the pickled scorer. They're scored and queued
+                    # once all the predictions at this node have been checked.
+                    new_children: List[Tuple[BFSNode, TacticTrial,
+                                             Optional[float]]] = []
+                    while remaining_predictions and not solved_subgoal and \
+                            num_successful_predictions < args.search_width:
+                        # With a tactic pool, try as many predictions at once as
+                        # we could still need, one per Coq instance.
+                        if pool:
+                            wave_size = min(pool.num_instances,
+                                            args.search_width -
+                                            num_successful_predictions)
+                            wave = remaining_predictions[:wave_size]
+                            with lemma_clock().track("coq"):
+                                trials = pool.run_trials(
+                                    args, node_history(next_node.node),
+                                    [prediction.prediction for prediction in wave],
+                                    next_node.node.total_time(), table, state_key,
+                                    scorer)
+                        else:
+                            wave = remaining_predictions[:1]
+                            trials = [runTrial(args, coq, wave[0].prediction,
+                                               next_node.node.total_time(),
+                                               table, state_key, scorer)]
+                        remaining_predictions = remaining_predictions[len(wave):]
+                        for prediction, trial in zip(wave, trials):
+                            if num_successful_predictions >= args.search_width:
+                                break
+                            postfix = []
+                            if trial.unshelved:
+                                postfix.append("Unshelve.")
+                            postfix += ["}"] * trial.subgoals_closed
+                            postfix += ["{"] * trial.subgoals_opened
+
+                            prediction_node = BFSNode(
+                                prediction,
+                                0,
+                                trial.time_taken, postfix, full_context_before,
+                                next_node.node)
+                            if trial.error:
+                                if args.count_failing_predictions:
+                                    num_successful_predictions += 1
+                                prediction_node.setNodeColor("red")
+                                continue
+                            else:
+                                num_successful_predictions += 1
+                            context_after = trial.context_after
+                            # Check if we've gone in circles
+                            if contextInHistory(context_after, prediction_node):
+                                if args.count_softfail_predictions:
+                                    num_successful_predictions += 1
+                                eprint(f"Prediction in history", guard=args.verbose >= 2)
+                                prediction_node.setNodeColor("orange")
+                                continue
+                            # Check if we've already reached this state some other
+                            # way, at least as quickly.
+                            if table.is_dead(context_key(context_after),
+                                             trial.prev_tactics) or \
+                               not table.visit(context_key(context_after),
+                                               len(prediction_node.path())):
+                                if args.count_softfail_predictions:
+                                    num_successful_predictions += 1
+                                eprint(f"Prediction leads to an explored state",
+                                       guard=args.verbose >= 2)
+                                prediction_node.setNodeColor("orange")
+                                continue
+                            # Check if the resulting context is too big
+                            if len(context_after.all_goals) > args.max_subgoals or \
+                              contextIsBig(context_after):
+                                if args.count_softfail_predictions:
+                                    num_successful_predictions += 1
+                                prediction_node.setNodeColor("orange")
+                                continue
+                            # Check if the proof is done
+                            if trial.completed:
+                                prediction_node.mkQED()
+                                return SearchResult(SearchStatus.SUCCESS,
+                                                    prediction_node.interactions()[1:])
+                            if args.scoring_function == "const":
+                                h_score: Optional[float] = 1.
+                            elif args.scoring_function == "certainty":
+                                h_score = -abs(next_node.f_score * prediction.certainty)
+                            elif args.scoring_function == "norm-certainty":
+                                h_score = -math.sqrt(abs(next_node.f_score * prediction.certainty))
+                            else:
+                                assert args.scoring_function == "pickled"
+                                h_score = None
+                            new_children.append((prediction_node, trial, h_score))
+                            # If we solved the subgoal...
+                            if trial.subgoals_closed > 0:
+                                prediction_node.setNodeColor("blue")
+                                # Get unexplored nodes from the tree that are trying to
+                                # solve the subgoal(s) we just solved.
+                                prunable_nodes = get_prunable_nodes(prediction_node)
+                                pruned_nodes += prunable_nodes
+                                # Prune them from the frontier nodes
+                                nodes_todo = [node for node in nodes_todo
+                                              if node.node not in prunable_nodes]
+                                heapq.heapify(nodes_todo)
+                                # Don't run the rest of the predictions at this state
+                                solved_subgoal = True
+                                break
+
+                    if scorer and new_children:
+                        pickled_scores = scorer.score(
+                            [(trial.context_after, trial.sexp_goals)
+                             for _, trial, _ in new_children])
+                        new_children = [(child, trial, h_score)
+                                        for (child, trial, _), h_score
+                                        in zip(new_children, pickled_scores)]
+                    for prediction_node, trial, h_score in new_children:
+                        # Solving a subgoal can prune this child's siblings.
+                        if prediction_node in pruned_nodes:
+                            continue
+                        if args.search_type == "astar":
+                            # Calculate the A* f_score
+                            g_score = len(prediction_node.path())
+                            score = g_score + unwrap(h_score)
+                        else:
+                            score = unwrap(h_score)
+
+                        prediction_node.setScore(score)
+
+                        # Put our new prediction node in our priority queue,
+                        # along with the context it leads to.
+                        heapq.heappush(nodes_todo,
+                                       AStarTask(score, prediction_node,
+                                                 FullContext(relevant_lemmas,
+                                                             trial.prev_tactics,
+                                                             trial.context_after)))
+
+        hasUnexploredNode = len(nodes_todo) > 0
+        if hasUnexploredNode:
+            return SearchResult(SearchStatus.INCOMPLETE, None)
+        else:
+            return SearchResult(SearchStatus.FAILURE, None)
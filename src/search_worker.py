@@ -13,6 +13,10 @@ from coq_serapy.contexts import ProofContext
 from models.tactic_predictor import TacticPredictor
 from search_results import SearchResult, KilledException, SearchStatus, TacticInteraction
 from search_strategies import best_first_proof_search, bfs_beam_proof_search, dfs_proof_search_with_graph
+from subgoal_search import subgoal_proof_search
+from tactic_pool import TacticPool
+from search_budget import SearchBudget, lemma_clock, start_lemma_clock
+from prefix_snapshots import PrefixSnapshots, MIN_SNAPSHOT_SKIP
 
 from util import unwrap, eprint, escape_lemma_name
 
@@ -30,6 +34,9 @@ class Worker:
     predictor: TacticPredictor
     coq: Optional[coq_serapy.SerapiInstance]
     switch_dict: Optional[Dict[str, str]]
+    pool: Optional[TacticPool]
+    budget: SearchBudget
+    snapshots: Optional[PrefixSnapshots]
 
     # File-local state
     cur_project: Optional[str]
@@ -38,10 +45,18 @@ class Worker:
     lemmas_encountered: List[ReportJob]
     remaining_commands: List[str]
     axioms_already_added: bool
+    # The commands sent to Coq for this file so far, and the number of the
+    # file's commands, for taking snapshots of the prefix.
+    executed_commands: List[str]
+    num_file_commands: int
+    # The local lemmas of the snapshot the file was entered from, which Coq
+    # doesn't list as local anymore.
+    prefix_lemmas: List[str]
 
     def __init__(self, args: argparse.Namespace, worker_idx: int,
                  predictor: TacticPredictor,
-                 switch_dict: Optional[Dict[str, str]] = None) -> None:
+                 switch_dict: Optional[Dict[str, str]] = None,
+                 budget: Optional[SearchBudget] = None) -> None:
         self.args = args
         self.widx = worker_idx
         self.predictor = predictor
@@ -53,9 +68,24 @@ class Worker:
         self.remaining_commands: List[str] = []
         self.switch_dict = switch_dict
         self.axioms_already_added = False
+        self.pool = None
+        self.budget = budget if budget else SearchBudget(args)
+        self.executed_commands = []
+        self.num_file_commands = 0
+        self.prefix_lemmas = []
+        if args.prefix_snapshot_dir:
+            self.snapshots = PrefixSnapshots(args.prefix_snapshot_dir,
+                                             args.prelude, args.verbose)
+        else:
+            self.snapshots = None
+
+    def sertop_command(self) -> List[str]:
+        if self.snapshots:
+            return ['sertop', '--implicit'] + self.snapshots.sertop_flags()
+        return ['sertop', '--implicit']
 
     def __enter__(self) -> 'Worker':
-        self.coq = coq_serapy.SerapiInstance(['sertop', '--implicit'],
+        self.coq = coq_serapy.SerapiInstance(self.sertop_command(),
                                     None, str(self.args.prelude),
                                     use_hammer=self.args.use_hammer)
         self.coq.quiet = True
@@ -63,26 +93,33 @@ class Worker:
         return self
     def __exit__(self, type, value, traceback) -> None:
         assert self.coq
+        if self.pool:
+            self.pool.__exit__(type, value, traceback)
+            self.pool = None
         self.coq.kill()
         self.coq = None
 
-    def set_switch_from_proj(self) -> None:
+    def get_switch(self) -> Optional[str]:
         assert self.cur_project
-        assert self.coq
         try:
             with (self.args.prelude / self.cur_project / "switch.txt").open('r') as sf:
-                switch = sf.read().strip()
+                return sf.read().strip()
         except FileNotFoundError:
             if self.switch_dict is not None:
-                switch = self.switch_dict[self.cur_project]
+                return self.switch_dict[self.cur_project]
             else:
-                return
-        self.coq.set_switch(switch)
+                return None
+
+    def set_switch_from_proj(self) -> None:
+        assert self.coq
+        switch = self.get_switch()
+        if switch is not None:
+            self.coq.set_switch(switch)
 
     def restart_coq(self) -> None:
         assert self.coq
         self.coq.kill()
-        self.coq = coq_serapy.SerapiInstance(['sertop', '--implicit'],
+        self.coq = coq_serapy.SerapiInstance(self.sertop_command(),
                                     None, str(self.args.prelude / self.cur_project),
                                     use_hammer=self.args.use_hammer)
         self.coq.quiet = True
@@ -93,15 +130,51 @@ class Worker:
         self.lemmas_encountered = []
         self.remaining_commands = []
         self.axioms_already_added = False
+        self.executed_commands = []
+        self.prefix_lemmas = []
 
-    def enter_file(self, filename: str) -> None:
+    def enter_file(self, filename: str, job: Optional[ReportJob] = None) -> None:
         assert self.coq
+        assert self.cur_project
         self.cur_file = filename
         module_name = coq_serapy.get_module_from_filename(filename)
-        self.coq.run_stmt(f"Module {module_name}.")
-        self.remaining_commands = coq_serapy.load_commands_preserve(
+        file_commands = coq_serapy.load_commands_preserve(
             self.args, 1, self.args.prelude / self.cur_project / filename)
+        self.num_file_commands = len(file_commands)
         self.axioms_already_added = False
+        if self.snapshots and job:
+            snapshot = self.snapshots.find(self.cur_project, filename, job)
+            if snapshot:
+                try:
+                    self.coq.run_stmt(f"Require {snapshot.module}.")
+                    self.coq.run_stmt(f"Module {module_name}.")
+                    self.coq.run_stmt(f"Import {snapshot.module}.")
+                    for command in snapshot.env_commands:
+                        self.coq.run_stmt(command)
+                except coq_serapy.CoqExn:
+                    eprint(f"Couldn't load snapshot {snapshot.module}, "
+                           "discarding it", guard=self.args.verbose >= 1)
+                    self.snapshots.discard(snapshot)
+                    self.exit_cur_file()
+                else:
+                    eprint(f"Entered {filename} from a snapshot, skipping "
+                           f"{len(snapshot.lemmas)} lemmas",
+                           guard=self.args.verbose >= 2)
+                    self.remaining_commands = \
+                        file_commands[snapshot.commands_consumed:]
+                    self.lemmas_encountered = [ReportJob(*lemma) for lemma
+                                               in snapshot.lemmas]
+                    self.last_program_statement = \
+                        snapshot.last_program_statement
+                    self.prefix_lemmas = snapshot.local_lemmas
+                    # Snapshots taken from here on build on this one.
+                    self.executed_commands = [f"Require Import {snapshot.module}."] \
+                        + snapshot.env_commands
+                    return
+        self.coq.run_stmt(f"Module {module_name}.")
+        self.remaining_commands = file_commands
+        self.executed_commands = []
+        self.prefix_lemmas = []
 
     def exit_cur_file(self) -> None:
         for sec_or_mod, _ in reversed(self.coq.sm_stack):
@@ -111,6 +184,9 @@ class Worker:
         assert self.coq
         assert job not in self.lemmas_encountered, "Jobs are out of order!"
         job_project, job_file, job_module, job_lemma = job
+        # Snapshots admit the proofs that careful mode is there to run, so
+        # careful mode always replays the file from the start.
+        snapshot_job = None if careful else job
         # If we need to change projects, we'll have to reset the coq instance
         # to load new includes, and set the opam switch
         if job_project != self.cur_project:
@@ -118,12 +194,14 @@ class Worker:
             self.cur_project = job_project
             self.set_switch_from_proj()
             self.restart_coq()
-            self.enter_file(job_file)
+            self.enter_file(job_file, snapshot_job)
         # If the job is in a different file load the jobs file from scratch.
         if job_file != self.cur_file:
             if self.cur_file:
                 self.exit_cur_file()
-            self.enter_file(job_file)
+            self.reset_file_state()
+            self.enter_file(job_file, snapshot_job)
+        lemmas_skipped = 0
 
         # This loop has three exit cases.  Either it will hit the correct job
         # and return, hit an error or assert before getting to the correct job,
@@ -140,7 +218,7 @@ class Worker:
                 if restart:
                     self.restart_coq()
                     self.reset_file_state()
-                    self.enter_file(job_file)
+                    self.enter_file(job_file, snapshot_job)
                     eprint(f"Hit a coq anomaly! Restarting...",
                            guard=self.args.verbose >= 1)
                     self.run_into_job(job, False, careful)
@@ -180,8 +258,24 @@ class Worker:
             self.remaining_commands = rest_commands
             if unique_lemma_statement == job_lemma and \
               self.coq.sm_prefix == job_module:
+                # Only the file's own module is open, so the prefix can be
+                # compiled on its own.
+                if self.snapshots and not careful \
+                   and lemmas_skipped >= MIN_SNAPSHOT_SKIP \
+                   and len(self.coq.sm_stack) == 1 \
+                   and unique_lemma_statement == lemma_statement:
+                    self.snapshots.save(
+                        job_project, job_file, self.get_switch(),
+                        self.num_file_commands - len(rest_commands) - 1,
+                        self.executed_commands + run_commands[:-1],
+                        [tuple(lemma) for lemma in self.lemmas_encountered],
+                        self.prefix_lemmas + self.coq.local_lemmas[:-1],
+                        self.last_program_statement)
+                self.executed_commands += run_commands
                 return
             else:
+                self.executed_commands += run_commands
+                lemmas_skipped += 1
                 self.skip_proof(lemma_statement, careful)
                 self.lemmas_encountered.append(ReportJob(self.cur_project,
                                                          unwrap(self.cur_file),
@@ -208,8 +302,10 @@ class Worker:
                 coq_serapy.kill_comments(lemma_statement))) or \
             careful
         if proof_relevant:
-            self.remaining_commands, _ = unwrap(self.coq.finish_proof(
-                self.remaining_commands)) # type: ignore
+            self.remaining_commands, proof_commands = \
+                unwrap(self.coq.finish_proof(
+                    self.remaining_commands)) # type: ignore
+            self.executed_commands += proof_commands
         else:
             try:
                 coq_serapy.admit_proof(self.coq, lemma_statement, ending_command)
@@ -223,12 +319,12 @@ class Worker:
                 self.remaining_commands.pop(0)
             # Pop the actual Qed/Defined/Save
             self.remaining_commands.pop(0)
+            self.executed_commands.append("Admitted.")
 
-    def run_job(self, job: ReportJob, restart: bool = True) -> SearchResult:
+    def enter_job(self, job: ReportJob, restart: bool = True) -> None:
         assert self.coq
         self.run_into_job(job, restart, self.args.careful)
-        job_project, job_file, job_module, job_lemma = job
-        initial_context: ProofContext = unwrap(self.coq.proof_context)
+        job_lemma = job.lemma_statement
         if self.args.add_axioms and not self.axioms_already_added:
             self.axioms_already_added = True
             # Cancel the lemma statement so we can run the axiom
@@ -244,18 +340,52 @@ class Worker:
                         eprint(f"Couldn't declare axiom {axiom_name} "
                                f"at this point in the proof")
             self.coq.run_stmt(job_lemma)
+
+    def finish_job(self, job: ReportJob) -> None:
+        assert self.coq
+        while not coq_serapy.ending_proof(self.remaining_commands[0]):
+            self.remaining_commands.pop(0)
+        # Pop the actual Qed/Defined/Save
+        ending_command = self.remaining_commands.pop(0)
+        coq_serapy.admit_proof(self.coq, job.lemma_statement, ending_command)
+        self.executed_commands.append("Admitted.")
+
+        self.lemmas_encountered.append(job)
+
+    def run_job(self, job: ReportJob, restart: bool = True) -> SearchResult:
+        assert self.coq
+        self.enter_job(job, restart)
+        job_project, job_file, job_module, job_lemma = job
+        initial_context: ProofContext = unwrap(self.coq.proof_context)
+        if self.args.parallel_tactic_workers > 0 and self.pool is None:
+            if self.args.search_type in ["best-first", "astar"]:
+                self.pool = TacticPool(
+                    self.args,
+                    lambda: Worker(self.args, self.widx, self.predictor,
+                                   self.switch_dict),
+                    self.args.parallel_tactic_workers).__enter__()
+            else:
+                eprint("Parallel tactic workers are only supported in "
+                       "best-first and A* search, ignoring",
+                       guard=self.args.verbose >= 1)
+        if self.pool:
+            self.pool.enter_job(job, self.coq)
         empty_context = ProofContext([], [], [], [])
+        start_lemma_clock()
         try:
-            search_status, tactic_solution = \
+            search_status, tactic_solution, _ = \
               attempt_search(self.args, job_lemma,
                              self.coq.sm_prefix,
                              self.coq,
                              self.args.output_dir / self.cur_project,
-                             self.widx, self.predictor)
+                             self.widx, self.predictor, self.pool,
+                             self.budget, self.prefix_lemmas)
         except KilledException:
             tactic_solution = None
             search_status = SearchStatus.INCOMPLETE
         except coq_serapy.CoqAnomaly:
+            if self.pool:
+                self.pool.abandon_job()
             if self.args.hardfail:
                 raise
             if self.args.log_anomalies:
@@ -265,7 +395,7 @@ class Worker:
                     traceback.print_exc(file=f)
             self.restart_coq()
             self.reset_file_state()
-            self.enter_file(job_file)
+            self.enter_file(job_file, None if self.args.careful else job)
             if restart:
                 eprint("Hit an anomaly, restarting job", guard=self.args.verbose >= 2)
                 return self.run_job(job, restart=False)
@@ -283,8 +413,11 @@ class Worker:
                 eprint(f"Skipping job {job_file}:{coq_serapy.lemma_name_from_statement(job_lemma)} "
                        "due to multiple failures",
                        guard=self.args.verbose >= 1)
-                return SearchResult(search_status, solution)
+                return SearchResult(search_status, solution,
+                                    lemma_clock().breakdown())
         except Exception:
+            if self.pool:
+                self.pool.abandon_job()
             eprint(f"FAILED in file {job_file}, lemma {job_lemma}")
             raise
         if not tactic_solution:
@@ -297,14 +430,11 @@ class Worker:
                 + tactic_solution +
                 [TacticInteraction("Qed.", empty_context)])
 
-        while not coq_serapy.ending_proof(self.remaining_commands[0]):
-            self.remaining_commands.pop(0)
-        # Pop the actual Qed/Defined/Save
-        ending_command = self.remaining_commands.pop(0)
-        coq_serapy.admit_proof(self.coq, job_lemma, ending_command)
-
-        self.lemmas_encountered.append(job)
-        return SearchResult(search_status, solution)
+        self.finish_job(job)
+        if self.pool:
+            self.pool.finish_job(job)
+        return SearchResult(search_status, solution,
+                            lemma_clock().breakdown())
 
 def get_lemma_declaration_from_name(coq: coq_serapy.SerapiInstance,
                                     lemma_name: str) -> str:
@@ -312,6 +442,14 @@ def get_lemma_declaration_from_name(coq: coq_serapy.SerapiInstance,
 
 import _thread
 import threading
+import ctypes
+
+def interrupt_thread(thread_id: int) -> None:
+    # Like _thread.interrupt_main, but for searches running outside the main
+    # thread. The exception is raised the next time the thread runs python
+    # code.
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id), ctypes.py_object(KeyboardInterrupt))
 
 # This method attempts to complete proofs using search.
 def attempt_search(args: argparse.Namespace,
@@ -320,7 +458,10 @@ def attempt_search(args: argparse.Namespace,
                    coq: coq_serapy.SerapiInstance,
                    output_dir: Path,
                    bar_idx: int,
-                   predictor: TacticPredictor) \
+                   predictor: TacticPredictor,
+                   pool: Optional[TacticPool] = None,
+                   budget: Optional[SearchBudget] = None,
+                   prefix_lemmas: Optional[List[str]] = None) \
         -> SearchResult:
     global unnamed_goal_number
     if args.add_env_lemmas:
@@ -331,7 +472,7 @@ def attempt_search(args: argparse.Namespace,
     else:
         env_lemmas = []
     if args.relevant_lemmas == "local":
-        relevant_lemmas = coq.local_lemmas[:-1]
+        relevant_lemmas = (prefix_lemmas or []) + coq.local_lemmas[:-1]
     elif args.relevant_lemmas == "hammer":
         relevant_lemmas = coq.get_hammer_premises()
     elif args.relevant_lemmas == "searchabout":
@@ -348,8 +489,16 @@ def attempt_search(args: argparse.Namespace,
         unnamed_goal_number += 1
         lemma_name = f"Obligation{unnamed_goal_number}"
 
-    if args.max_search_time_per_lemma:
-        timer = threading.Timer(args.max_search_time_per_lemma, _thread.interrupt_main)
+    if budget:
+        time_limit = budget.lemma_time_limit()
+    else:
+        time_limit = args.max_search_time_per_lemma
+    if time_limit is not None:
+        if threading.current_thread() is threading.main_thread():
+            timer = threading.Timer(time_limit, _thread.interrupt_main)
+        else:
+            timer = threading.Timer(time_limit, interrupt_thread,
+                                    args=(threading.get_ident(),))
         timer.start()
     try:
         if args.search_type == 'dfs':
@@ -364,16 +513,20 @@ def attempt_search(args: argparse.Namespace,
         elif args.search_type == 'astar' or args.search_type == 'best-first':
             result = best_first_proof_search(lemma_name, module_prefix,
                                              env_lemmas + relevant_lemmas, coq,
-                                             args, bar_idx, predictor)
+                                             args, bar_idx, predictor, pool)
+        elif args.search_type == 'and-or':
+            result = subgoal_proof_search(lemma_name,
+                                          env_lemmas + relevant_lemmas, coq,
+                                          args, bar_idx, predictor)
         else:
             assert False, args.search_type
     except KeyboardInterrupt:
-        if args.max_search_time_per_lemma:
+        if time_limit is not None:
             raise KilledException("Lemma timeout")
         else:
             raise
     finally:
-        if args.max_search_time_per_lemma:
+        if time_limit is not None:
             timer.cancel()
     return result
 
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+import heapq
+import itertools
+import sys
+from typing import Dict, List, Optional, Set, Tuple
+
+from tqdm import tqdm
+
+import coq_serapy
+from coq_serapy.contexts import FullContext
+from models.tactic_predictor import TacticPredictor
+from search_results import SearchResult, SearchStatus, TacticInteraction
+from search_strategies import (completed_proof, contextIsBig,
+                               predictKTacticsInTable, traverse_to_history)
+from search_budget import lemma_clock
+from transposition_table import (TranspositionTable, context_key,
+                                 obligation_key)
+from util import unwrap, eprint, mybarfmt
+
+# An AND-OR search. Each focused goal is an OR node, searched best-first
+# on its own, with its own step budget (within one budget for the whole
+# lemma). A tactic that leaves several goals is an AND node: each of its
+# goals is focused with "{" and solved as its own subproblem, so failing on
+# one case never re-searches the cases before it. Solutions (and failures) are remembered per goal, so a goal
+# that comes up again in another case is only solved once.
+
+ObligationKey = Tuple[str, Tuple[str, ...]]
+
+
+class SubgoalSearch:
+    args: argparse.Namespace
+    coq: coq_serapy.SerapiInstance
+    predictor: TacticPredictor
+    relevant_lemmas: List[str]
+    pbar: tqdm
+    table: TranspositionTable
+    solved: Dict[ObligationKey, List[TacticInteraction]]
+    # The most depth each goal has been failed to be solved with.
+    failed: Dict[ObligationKey, int]
+    # Nodes expanded for the whole lemma, across all of its subgoals.
+    total_steps: int
+    hit_limit: bool
+
+    def __init__(self, args: argparse.Namespace,
+                 coq: coq_serapy.SerapiInstance,
+                 predictor: TacticPredictor,
+                 relevant_lemmas: List[str],
+                 pbar: tqdm) -> None:
+        self.args = args
+        self.coq = coq
+        self.predictor = predictor
+        self.relevant_lemmas = relevant_lemmas
+        self.pbar = pbar
+        self.table = TranspositionTable(not args.no_transposition_table)
+        self.solved = {}
+        self.failed = {}
+        self.total_steps = 0
+        self.hit_limit = False
+
+    def run_command(self, command: str) -> TacticInteraction:
+        context_before = unwrap(self.coq.proof_context)
+        with lemma_clock().track("coq"):
+            self.coq.run_stmt(command)
+        return TacticInteraction(command, context_before)
+
+    def cancel(self, num_stmts: int) -> None:
+        with lemma_clock().track("coq"):
+            for _ in range(num_stmts):
+                self.coq.cancel_last()
+
+    def try_tactic(self, tactic: str, state_key: int) \
+            -> Optional[List[TacticInteraction]]:
+        if self.table.known_failure(state_key, tactic):
+            return None
+        context_before = unwrap(self.coq.proof_context)
+        time_per_command = (self.coq.hammer_timeout + self.args.max_tactic_time
+                            if self.coq.use_hammer
+                            else self.args.max_tactic_time)
+        try:
+            with lemma_clock().track("coq"):
+                self.coq.run_stmt(tactic, timeout=time_per_command)
+        except (coq_serapy.TimeoutError, RecursionError):
+            return None
+        except (coq_serapy.ParseError, coq_serapy.CoqExn,
+                coq_serapy.OverflowError, coq_serapy.UnrecognizedError):
+            self.table.record_failure(state_key, tactic)
+            return None
+        step = [TacticInteraction(tactic, context_before)]
+        context_after = unwrap(self.coq.proof_context)
+        if len(context_after.fg_goals) == 0 and \
+           len(context_after.shelved_goals) > 0:
+            step.append(self.run_command("Unshelve."))
+        return step
+
+    def replay(self, script: List[TacticInteraction]) -> bool:
+        num_run = 0
+        try:
+            for interaction in script:
+                self.run_command(interaction.tactic)
+                num_run += 1
+        except (coq_serapy.CoqExn, coq_serapy.TimeoutError):
+            # The same goal can still behave differently in another place,
+            # for instance if it shares evars with its siblings.
+            self.cancel(num_run)
+            return False
+        if self.coq.count_fg_goals() != 0:
+            self.cancel(num_run)
+            return False
+        return True
+
+    def solve_focused(self, depth: int) -> Optional[List[TacticInteraction]]:
+        """
+        Solve the one focused goal, leaving Coq after its solution and
+        returning it, or leave Coq where it was and return None.
+        """
+        key = obligation_key(unwrap(self.coq.proof_context).fg_goals[0])
+        if key in self.solved:
+            if self.replay(self.solved[key]):
+                return self.solved[key]
+        if self.failed.get(key, -1) >= depth:
+            return None
+        script = self.search_focused(depth)
+        if script is None:
+            self.failed[key] = depth
+        else:
+            self.solved[key] = script
+        return script
+
+    def solve_all_focused(self, num_goals: int, depth: int) \
+            -> Optional[List[TacticInteraction]]:
+        """
+        Solve each of the focused goals in turn, each in its own "{" block.
+        """
+        script: List[TacticInteraction] = []
+        for _ in range(num_goals):
+            script.append(self.run_command("{"))
+            subscript = self.solve_focused(depth)
+            if subscript is None:
+                self.cancel(len(script))
+                return None
+            script += subscript
+            try:
+                script.append(self.run_command("}"))
+            except coq_serapy.CoqExn:
+                self.cancel(len(script))
+                return None
+        return script
+
+    def search_focused(self, depth: int) -> Optional[List[TacticInteraction]]:
+        start_len = len(self.coq.tactic_history.getFullHistory())
+        visited: Set[int] = {context_key(unwrap(self.coq.proof_context))}
+        counter = itertools.count()
+        # Nodes are ordered by the negated product of the certainties of the
+        # predictions on their path.
+        nodes_todo: List[Tuple[float, int, int, List[TacticInteraction]]] = \
+            [(-1.0, next(counter), 0, [])]
+        steps_taken = 0
+        while nodes_todo:
+            if steps_taken >= self.args.subgoal_steps or \
+               self.total_steps >= self.args.subgoal_total_steps:
+                self.hit_limit = True
+                break
+            neg_certainty, _, node_depth, interactions = \
+                heapq.heappop(nodes_todo)
+            steps_taken += 1
+            self.total_steps += 1
+            self.pbar.update()
+            traverse_to_history(self.coq, start_len,
+                                [interaction.tactic
+                                 for interaction in interactions])
+            full_context_before = FullContext(self.relevant_lemmas,
+                                              self.coq.prev_tactics,
+                                              unwrap(self.coq.proof_context))
+            state_key = context_key(full_context_before.obligations)
+            predictions = predictKTacticsInTable(self.args, self.predictor,
+                                                 full_context_before,
+                                                 self.table, state_key)
+            num_successful_predictions = 0
+            for prediction in predictions:
+                if num_successful_predictions >= self.args.search_width:
+                    break
+                step = self.try_tactic(prediction.prediction, state_key)
+                if step is None:
+                    if self.args.count_failing_predictions:
+                        num_successful_predictions += 1
+                    continue
+                num_successful_predictions += 1
+                context_after = unwrap(self.coq.proof_context)
+                num_goals = len(context_after.fg_goals)
+                if num_goals == 0:
+                    return interactions + step
+                if num_goals > 1:
+                    subscript = self.solve_all_focused(
+                        num_goals, depth - node_depth - 1)
+                    if subscript is not None:
+                        return interactions + step + subscript
+                elif node_depth + 1 >= depth:
+                    self.hit_limit = True
+                elif context_key(context_after) not in visited and \
+                        not contextIsBig(context_after):
+                    visited.add(context_key(context_after))
+                    heapq.heappush(nodes_todo,
+                                   (neg_certainty * prediction.certainty,
+                                    next(counter), node_depth + 1,
+                                    interactions + step))
+                else:
+                    eprint("Prediction in history, too big, "
+                           "or already explored", guard=self.args.verbose >= 2)
+                self.cancel(len(step))
+        traverse_to_history(self.coq, start_len, [])
+        return None
+
+
+def subgoal_proof_search(lemma_name: str,
+                         relevant_lemmas: List[str],
+                         coq: coq_serapy.SerapiInstance,
+                         args: argparse.Namespace,
+                         bar_idx: int,
+                         predictor: TacticPredictor) -> SearchResult:
+    desc_name = lemma_name
+    if len(desc_name) > 25:
+        desc_name = desc_name[:22] + "..."
+    with tqdm(total=None, unit="pred", file=sys.stdout,
+              desc=desc_name, disable=(not args.progress),
+              leave=False, position=bar_idx + 1,
+              dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+        search = SubgoalSearch(args, coq, predictor, relevant_lemmas, pbar)
+        num_goals = coq.count_fg_goals()
+        if num_goals == 1:
+            script = search.solve_focused(args.search_depth)
+        else:
+            script = search.solve_all_focused(num_goals, args.search_depth)
+    if script is not None and completed_proof(coq):
+        return SearchResult(SearchStatus.SUCCESS, script)
+    if search.hit_limit:
+        return SearchResult(SearchStatus.INCOMPLETE, None)
+    return SearchResult(SearchStatus.FAILURE, None)
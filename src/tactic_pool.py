@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import (Callable, List, Optional, Sequence, TypeVar,
+                    TYPE_CHECKING)
+
+import coq_serapy
+
+from search_strategies import (GoalScorer, TacticTrial, runTrial,
+                               traverse_to_history)
+from transposition_table import TranspositionTable
+from util import eprint, unwrap
+
+if TYPE_CHECKING:
+    from search_worker import Worker, ReportJob
+
+T = TypeVar('T')
+
+
+class TacticPool:
+    """
+    A set of extra Coq instances, each kept at the same lemma as a worker's
+    own instance, so that the candidate tactics at a search node can be
+    checked concurrently instead of one after another.
+
+    Instances that fail are dropped for the rest of the lemma and restarted
+    at the next one; trials they were running are rerun on the main
+    instance.
+    """
+    args: argparse.Namespace
+    make_worker: Callable[[], "Worker"]
+    size: int
+    helpers: List[Optional["Worker"]]
+    in_job: List[bool]
+    initial_history_lens: List[int]
+    main_coq: Optional[coq_serapy.SerapiInstance]
+    pending: List[Future]
+
+    def __init__(self, args: argparse.Namespace,
+                 make_worker: Callable[[], "Worker"], size: int) -> None:
+        self.args = args
+        self.make_worker = make_worker
+        self.size = size
+        self.helpers = [None] * size
+        self.in_job = [False] * size
+        self.initial_history_lens = [0] * size
+        self.main_coq = None
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+    def __enter__(self) -> 'TacticPool':
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        wait(self.pending)
+        for idx in range(self.size):
+            self._drop(idx)
+        self.executor.shutdown()
+
+    @property
+    def num_instances(self) -> int:
+        return 1 + sum(self.in_job)
+
+    def _drop(self, idx: int) -> None:
+        helper = self.helpers[idx]
+        self.helpers[idx] = None
+        self.in_job[idx] = False
+        if helper is not None:
+            try:
+                helper.__exit__(None, None, None)
+            except Exception:
+                pass
+
+    def _map_helpers(self, f: Callable[[int], T],
+                     idxs: Sequence[int]) -> List[Optional[T]]:
+        self.pending = [self.executor.submit(f, idx) for idx in idxs]
+        wait(self.pending)
+        results: List[Optional[T]] = []
+        for idx, future in zip(idxs, self.pending):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                eprint(f"Tactic pool instance {idx} failed with {e!r}, "
+                       "dropping it", guard=self.args.verbose >= 1)
+                self._drop(idx)
+                results.append(None)
+        self.pending = []
+        return results
+
+    def enter_job(self, job: "ReportJob",
+                  coq: coq_serapy.SerapiInstance) -> None:
+        self.main_coq = coq
+
+        def enter(idx: int) -> None:
+            if self.helpers[idx] is None:
+                self.helpers[idx] = self.make_worker().__enter__()
+            helper = unwrap(self.helpers[idx])
+            helper.enter_job(job, restart=False)
+            self.initial_history_lens[idx] = \
+                len(unwrap(helper.coq).tactic_history.getFullHistory())
+            self.in_job[idx] = True
+        self._map_helpers(enter, range(self.size))
+
+    def run_trials(self, args: argparse.Namespace,
+                   node_history: List[str],
+                   predictions: List[str],
+                   previousTime: float,
+                   table: TranspositionTable,
+                   state_key: int,
+                   scorer: Optional[GoalScorer] = None) -> List[TacticTrial]:
+        """
+        Try each prediction at the node with the given history, one per Coq
+        instance. The main instance is expected to already be at the node.
+        """
+        main_coq = unwrap(self.main_coq)
+        helper_idxs = [idx for idx in range(self.size)
+                       if self.in_job[idx]][:len(predictions) - 1]
+        helper_predictions = dict(zip(helper_idxs, predictions[1:]))
+
+        def trial(idx: int) -> TacticTrial:
+            helper_coq = unwrap(unwrap(self.helpers[idx]).coq)
+            traverse_to_history(helper_coq, self.initial_history_lens[idx],
+                                node_history)
+            return runTrial(args, helper_coq, helper_predictions[idx],
+                            previousTime, table, state_key, scorer)
+
+        self.pending = [self.executor.submit(trial, idx)
+                        for idx in helper_idxs]
+        try:
+            trials = [runTrial(args, main_coq, predictions[0], previousTime,
+                               table, state_key, scorer)]
+        finally:
+            # Never leave an instance running a tactic behind our back,
+            # even if we're being interrupted.
+            wait(self.pending)
+        for idx, future in zip(helper_idxs, self.pending):
+            try:
+                trials.append(future.result())
+            except Exception as e:
+                eprint(f"Tactic pool instance {idx} failed with {e!r}, "
+                       "dropping it", guard=args.verbose >= 1)
+                self._drop(idx)
+                trials.append(runTrial(args, main_coq,
+                                       helper_predictions[idx],
+                                       previousTime, table, state_key,
+                                       scorer))
+        self.pending = []
+        for prediction in predictions[1 + len(helper_idxs):]:
+            trials.append(runTrial(args, main_coq, prediction, previousTime,
+                                   table, state_key, scorer))
+        return trials
+
+    def finish_job(self, job: "ReportJob") -> None:
+        wait(self.pending)
+
+        def finish(idx: int) -> None:
+            unwrap(self.helpers[idx]).finish_job(job)
+            self.in_job[idx] = False
+        self._map_helpers(finish, [idx for idx in range(self.size)
+                                   if self.in_job[idx]])
+
+    def abandon_job(self) -> None:
+        # We don't know what state the instances are in, so start them over
+        # at the next job.
+        wait(self.pending)
+        for idx in range(self.size):
+            if self.in_job[idx]:
+                self._drop(idx)
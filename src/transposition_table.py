@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+##########################################################################
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from coq_serapy.contexts import ProofContext, Obligation
+from models.tactic_predictor import Prediction
+
+
+class CachedFailure(Exception):
+    pass
+
+
+def normalize_term(term: str) -> str:
+    return " ".join(term.split())
+
+
+def obligation_key(obligation: Obligation) -> Tuple[str, Tuple[str, ...]]:
+    return (normalize_term(obligation.goal),
+            tuple(sorted(normalize_term(hyp)
+                         for hyp in obligation.hypotheses)))
+
+
+def last_tactic(prev_tactics: List[str]) -> str:
+    return prev_tactics[-1] if prev_tactics else ""
+
+
+def context_key(context: ProofContext) -> int:
+    return hash(tuple(tuple(obligation_key(obligation)
+                            for obligation in goals)
+                      for goals in [context.fg_goals, context.bg_goals,
+                                    context.shelved_goals,
+                                    context.given_up_goals]))
+
+
+class TranspositionTable:
+    """
+    Remembers what the search has learned about each proof state, keyed on
+    a normalized hash of the proof context, so that a state reached through
+    a different branch isn't predicted on and checked in Coq again.
+    """
+    enabled: bool
+    _predictions: Dict[Tuple[int, str, int], List[Prediction]]
+    _failures: Dict[int, Set[str]]
+    _dead: Set[Tuple[int, str]]
+    _depths: Dict[int, int]
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._predictions = {}
+        self._failures = {}
+        self._dead = set()
+        self._depths = {}
+
+    # The predictor sees the previous tactic too, so predictions (and
+    # anything derived from them) are keyed on it as well as the state.
+    def predictions(self, key: int, prev_tactics: List[str],
+                    k: int) -> Optional[List[Prediction]]:
+        if not self.enabled:
+            return None
+        return self._predictions.get((key, last_tactic(prev_tactics), k))
+
+    def record_predictions(self, key: int, prev_tactics: List[str], k: int,
+                           predictions: List[Prediction]) -> None:
+        if not self.enabled:
+            return
+        self._predictions[(key, last_tactic(prev_tactics), k)] = predictions
+
+    def known_failure(self, key: int, tactic: str) -> bool:
+        return self.enabled and tactic in self._failures.get(key, ())
+
+    def record_failure(self, key: int, tactic: str) -> None:
+        if not self.enabled:
+            return
+        self._failures.setdefault(key, set()).add(tactic)
+
+    def is_dead(self, key: int, prev_tactics: List[str]) -> bool:
+        return self.enabled and \
+            (key, last_tactic(prev_tactics)) in self._dead
+
+    def mark_dead(self, key: int, prev_tactics: List[str]) -> None:
+        if not self.enabled:
+            return
+        self._dead.add((key, last_tactic(prev_tactics)))
+
+    def visit(self, key: int, depth: int) -> bool:
+        """
+        Record that a state was reached at depth, returning False if it
+        was already reached at the same depth or shallower.
+        """
+        if not self.enabled:
+            return True
+        if key in self._depths and self._depths[key] <= depth:
+            return False
+        self._depths[key] = depth
+        return True
@@ -27,6 +27,7 @@ import re
 import itertools
 import argparse
 import fcntl
+import os
 
 from typing import (List, Tuple, Iterable, Any, overload, TypeVar,
                     Callable, Optional, Pattern, Match, Union)
@@ -229,6 +230,30 @@ with silent():
     cuda_device = "cuda:0"
     # assert use_cuda
 
+# The lower precision type to run predictions in, if any.
+inference_dtype: Optional[torch.dtype] = None
+inference_dtypes = {"float32": None,
+                    "bfloat16": torch.bfloat16,
+                    "float16": torch.float16}
+
+def configure_inference(num_threads: Optional[int], dtype: str) -> None:
+    global inference_dtype
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    inference_dtype = inference_dtypes[dtype]
+    assert inference_dtype != torch.float16 or use_cuda, \
+        "float16 inference needs a GPU, use bfloat16 on the CPU"
+
+@contextlib.contextmanager
+def inference_context():
+    with torch.no_grad():
+        if inference_dtype is None:
+            yield
+        else:
+            with torch.autocast("cuda" if use_cuda else "cpu",
+                                dtype=inference_dtype):
+                yield
+
 import signal as sig
 @contextlib.contextmanager
 def sighandler_context(signal, f):
@@ -380,3 +405,27 @@ class FileLock:
 
     def __exit__(self, type, value, traceback):
         fcntl.flock(self.file_handle, fcntl.LOCK_UN)
+
+def claim_next_index(counter_file: Path) -> int:
+    """
+    Take the next index from a counter file shared between workers, so
+    that each index is only handed out once. An empty file counts as 0.
+    """
+    with counter_file.open('r+') as f, FileLock(f):
+        contents = f.read().strip()
+        index = int(contents) if contents else 0
+        f.seek(0)
+        f.truncate()
+        print(index + 1, file=f, flush=True)
+        os.fsync(f.fileno())
+    return index
+
+
+def read_index(counter_file: Path) -> int:
+    """
+    Read how many indices have been taken from a counter file, without
+    taking one.
+    """
+    with counter_file.open('r') as f, FileLock(f):
+        contents = f.read().strip()
+    return int(contents) if contents else 0